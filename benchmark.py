@@ -0,0 +1,374 @@
+"""
+Load-generation benchmark for the three services. Run it from the repository root:
+
+    python3 benchmark.py --train-sizes 16,200,1000 --coaches 1,8,16 --concurrency 16 --requests 2000
+
+It writes a fleet of synthetic trains (one per size and coach count combination),
+starts the train data service, the booking reference service and the ticket office
+on their usual ports (8081, 8082 and 8083, which must be free), then drives each
+endpoint in turn with concurrent requests:
+
+- train data:         GET  /data_for_train/<train_id>
+- booking reference:  GET  /booking_reference
+- ticket office:      POST /reserve
+
+Every train is reset before each endpoint is driven. The reservations are spread
+over as many copies of each train as it takes to keep them all under the 70% the
+ticket office allows, and to keep concurrent requests off the same train (see
+reservation_plan), so /reserve is timed making reservations, not refusing them.
+
+With --shards=N, the train data service runs as N processes on ports 8091 and up
+(see train_data_service/sharding.py), and both the benchmark and the ticket office
+send each train's requests to its shard.
+
+The results are printed to stdout as one json document, with requests/sec, the
+refusals and errors, and the p50/p99/p999 latencies in milliseconds of the
+requests served per endpoint, plus the commit and the
+settings used, so runs can be compared between commits:
+
+    python3 benchmark.py > before.json
+
+They also hold, for each train, the time it takes in this process to decode its
+document into the ticket office's seat map, and to encode it, with each json
+backend that is installed (see json_codec.py). --codec-only measures just that,
+without starting the services.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "train_data_service"))
+
+from generate_trains import coach_names  # noqa: E402
+from sharding import FIRST_SHARD_PORT, shard_for  # noqa: E402
+
+TRAIN_DATA_URL = "http://127.0.0.1:8081"
+BOOKING_REFERENCE_URL = "http://127.0.0.1:8082"
+TICKET_OFFICE_URL = "http://127.0.0.1:8083"
+
+
+def synthetic_trains(train_sizes, coach_counts):
+    trains = {}
+    for size in train_sizes:
+        for coach_count in coach_counts:
+            seats = {}
+            seats_per_coach = max(1, size // coach_count)
+            for coach in coach_names(coach_count):
+                for number in range(1, seats_per_coach + 1):
+                    seats["{0}{1}".format(number, coach)] = {
+                        "coach": coach,
+                        "seat_number": str(number),
+                        "booking_reference": "",
+                    }
+            trains["train_{0}_seats_{1}_coaches".format(size, coach_count)] = {"seats": seats}
+    return trains
+
+
+def percentile(sorted_latencies, fraction):
+    if not sorted_latencies:
+        return None
+    rank = max(0, min(len(sorted_latencies) - 1, int(round(fraction * len(sorted_latencies))) - 1))
+    return sorted_latencies[rank]
+
+
+def reservation_plan(trains, request_count, max_seat_count, rng, spread=1):
+    """(train_id, seat_count) reservation requests that the ticket office's business rules all accept
+
+    Each request is for a random train, with a group no larger than the emptiest coach holds while the
+    train is under 70% booked. The requests for a train go in turn to `spread` copies of it, so that as
+    many concurrent requests do not race for the same seats, and once the next group would take a copy
+    to 70%, a fresh copy takes its place. The copies are added to `trains`: the fleet grows with the
+    load, so the ticket office is timed making reservations rather than refusing them.
+    """
+    largest_groups = {}
+    for train_id, train in trains.items():
+        seat_count = len(train["seats"])
+        coach_size = seat_count // len({seat["coach"] for seat in train["seats"].values()})
+        # ceil(30% of a coach) is free in the emptiest coach of a train less than 70% booked
+        largest_group = min(max_seat_count, -(-3 * coach_size // 10), (7 * seat_count - 1) // 10)
+        if largest_group > 0:
+            largest_groups[train_id] = largest_group
+    train_ids = sorted(largest_groups)
+    copies = dict.fromkeys(train_ids, 0)
+    booked = {}
+
+    def new_copy(train_id):
+        copy_id = "{0}_copy_{1}".format(train_id, copies[train_id]) if copies[train_id] else train_id
+        copies[train_id] += 1
+        trains[copy_id] = trains[train_id]
+        booked[copy_id] = 0
+        return copy_id
+
+    lanes = {train_id: [new_copy(train_id) for _ in range(spread)] for train_id in train_ids}
+    turns = dict.fromkeys(train_ids, 0)
+    plan = []
+    for _ in range(request_count):
+        train_id = rng.choice(train_ids)
+        seat_count = rng.randint(1, largest_groups[train_id])
+        lane = turns[train_id] % spread
+        turns[train_id] += 1
+        copy_id = lanes[train_id][lane]
+        if 10 * (booked[copy_id] + seat_count) >= 7 * len(trains[train_id]["seats"]):
+            copy_id = lanes[train_id][lane] = new_copy(train_id)
+        booked[copy_id] += seat_count
+        plan.append((copy_id, seat_count))
+    return plan
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run_load(name, send, arguments, concurrency, refused=None):
+    """Call `send(session, argument)` for each argument from `concurrency` threads and summarise it
+
+    A request answered with anything but a 200 is an error, unless `refused(session, argument)`,
+    asked afterwards, says the service turned it down. Refusals are counted apart from the errors,
+    and the latency percentiles only time the requests served.
+    """
+    local = threading.local()
+    latencies = []
+    counts = {"refused": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def one_request(argument):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            ok = send(local.session, argument).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        if not ok:
+            try:
+                outcome = "refused" if refused and refused(local.session, argument) else "errors"
+            except requests.RequestException:
+                outcome = "errors"
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                counts[outcome] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, arguments))
+    wall_time = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "endpoint": name,
+        "requests": len(arguments),
+        "refused": counts["refused"],
+        "errors": counts["errors"],
+        "requests_per_second": round(len(arguments) / wall_time, 1),
+        "p50_ms": milliseconds(percentile(latencies, 0.50)),
+        "p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "p999_ms": milliseconds(percentile(latencies, 0.999)),
+    }
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError("service on port {0} did not start".format(port))
+
+
+def train_data_urls(shards):
+    if not shards:
+        return [TRAIN_DATA_URL]
+    return ["http://127.0.0.1:{0}".format(FIRST_SHARD_PORT + index) for index in range(shards)]
+
+
+def train_data_url_for(train_id, urls):
+    """The shard serving a train, see train_data_service/sharding.py"""
+    return urls[shard_for(train_id, len(urls))]
+
+
+def start_services(trains_file, shards=0):
+    train_data_ports = [int(url.rsplit(":", 1)[1]) for url in train_data_urls(shards)]
+    train_data_args = ["--shards={0}".format(shards)] if shards else []
+    services = [
+        (["train_data_service", "start_service.py"] + train_data_args + [trains_file], train_data_ports),
+        (["booking_reference_service", "booking_reference_service.py"], [8082]),
+        (["ticket_office_service", "ticket_office.py"], [8083]),
+    ]
+    environment = dict(os.environ, TICKET_OFFICE_TRAIN_DATA_URL=",".join(train_data_urls(shards)))
+    processes = []
+    for (directory, script, *args), ports in services:
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, script] + args,
+                cwd=os.path.join(ROOT, directory),
+                env=environment,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+        for port in ports:
+            wait_for_port(port)
+    return processes
+
+
+def codec_backends():
+    backends = {"json": (json.loads, lambda value: json.dumps(value).encode("utf-8"))}
+    if orjson is not None:
+        backends["orjson"] = (orjson.loads, orjson.dumps)
+    return backends
+
+
+def codec_benchmark(trains, repeat):
+    """Median time, in ms, to decode each train document into a seat map and to encode it"""
+    sys.path.insert(0, os.path.join(ROOT, "ticket_office_service"))
+    from train_services_adapters import seats_from_train_data
+
+    results = []
+    for train_id, train in sorted(trains.items()):
+        document = json.dumps(dict(train, version=1)).encode("utf-8")
+        for backend, (loads, dumps) in codec_backends().items():
+            decode_times = []
+            encode_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                seats_from_train_data(loads(document))
+                decode_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                dumps(train)
+                encode_times.append(time.perf_counter() - start)
+            results.append(
+                {
+                    "train": train_id,
+                    "backend": backend,
+                    "decode_to_seat_map_ms": round(sorted(decode_times)[repeat // 2] * 1000, 4),
+                    "encode_ms": round(sorted(encode_times)[repeat // 2] * 1000, 4),
+                }
+            )
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--train-sizes", default="16,200,1000", help="comma separated seat counts")
+    parser.add_argument("--coaches", default="1,8,16", help="comma separated coach counts")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--max-seat-count", type=int, default=4, help="largest group reserved at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=0, help="train data processes, 0 for a single unsharded one")
+    parser.add_argument("--codec-repeat", type=int, default=50, help="runs of each codec measurement")
+    parser.add_argument("--codec-only", action="store_true", help="only measure the json codecs")
+    options = parser.parse_args(args)
+
+    rng = random.Random(options.seed)
+    train_sizes = [int(size) for size in options.train_sizes.split(",")]
+    coach_counts = [int(count) for count in options.coaches.split(",")]
+    trains = synthetic_trains(train_sizes, coach_counts)
+    train_ids = sorted(trains)
+    codec_results = codec_benchmark(trains, options.codec_repeat)
+    if options.codec_only:
+        json.dump({"commit": current_commit(), "settings": vars(options), "codec": codec_results}, sys.stdout, indent=2)
+        print()
+        return
+
+    fleet = dict(trains)
+    plan = reservation_plan(fleet, options.requests, options.max_seat_count, rng, options.concurrency)
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as trains_file:
+        json.dump(fleet, trains_file)
+    processes = start_services(trains_file.name, options.shards)
+    urls = train_data_urls(options.shards)
+
+    def reset_fleet():
+        """Unbook every seat, so each phase starts from the trains as they were generated"""
+        with requests.Session() as session:
+            for train_id in sorted(fleet):
+                session.get(train_data_url_for(train_id, urls) + "/reset/" + train_id).raise_for_status()
+
+    def get_train_data(session, train_id):
+        return session.get(train_data_url_for(train_id, urls) + "/data_for_train/" + train_id)
+
+    def reserve(session, reservation_request):
+        train_id, seat_count = reservation_request
+        return session.post(TICKET_OFFICE_URL + "/reserve", data={"train_id": train_id, "seat_count": seat_count})
+
+    def quoted_as_refused(session, reservation_request):
+        """/reserve answers a refusal with a 500 like any failure: ask for a quote to tell them apart"""
+        train_id, seat_count = reservation_request
+        response = session.get(TICKET_OFFICE_URL + "/quote/" + train_id, params={"seat_count": seat_count})
+        quote = response.json() if response.status_code == 200 else {}
+        return quote is None or quote.get("bookable") is False
+
+    try:
+        results = []
+        reset_fleet()
+        results.append(
+            run_load(
+                "train_data /data_for_train",
+                get_train_data,
+                [rng.choice(train_ids) for _ in range(options.requests)],
+                options.concurrency,
+            )
+        )
+        reset_fleet()
+        results.append(
+            run_load(
+                "booking_reference /booking_reference",
+                lambda session, _: session.get(BOOKING_REFERENCE_URL + "/booking_reference"),
+                range(options.requests),
+                options.concurrency,
+            )
+        )
+        reset_fleet()
+        results.append(run_load("ticket_office /reserve", reserve, plan, options.concurrency, quoted_as_refused))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        os.unlink(trains_file.name)
+
+    json.dump(
+        {
+            "commit": current_commit(),
+            "settings": vars(options),
+            "trains": {train_id: len(trains[train_id]["seats"]) for train_id in train_ids},
+            "reserved_trains": len({train_id for train_id, _ in plan}),
+            "results": results,
+            "codec": codec_results,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
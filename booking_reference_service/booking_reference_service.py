@@ -12,29 +12,118 @@ You can use this service to get a unique booking reference. Make a GET request t
 This will return a string that looks a bit like this:
 
 	75bcd15
+
+To get several references in one request, make a GET request to:
+
+    http://localhost:8082/booking_references?count=100
+
+This will return a json list of consecutive references, for example:
+
+    ["75bcd15", "75bcd16", "75bcd17"]
+
+Request latencies are published in the Prometheus text format on:
+
+    http://localhost:8082/metrics
+
+References are never handed out twice, even across restarts: the service reserves
+them in blocks of 1000, recording the end of each block in a state file before
+using it, and resumes after the last reserved block when restarted. The unused end
+of the block in use when the service stops is skipped.
 """
 
 import cherrypy
-import itertools
+import json
+import os
+import threading
+
+from metrics import CONTENT_TYPE, METRICS
+
+BOOKING_REFERENCE_SECONDS = METRICS.histogram("booking_reference_service_booking_reference_seconds", "Time spent handing out one booking reference")
+BOOKING_REFERENCES_SECONDS = METRICS.histogram("booking_reference_service_booking_references_seconds", "Time spent handing out a batch of booking references")
 
 class BookingReferenceService(object):
-    def __init__(self, starting_point):
-        self.counter = itertools.count(starting_point)
+    MAX_BATCH_SIZE = 1000
+    BLOCK_SIZE = 1000
+
+    def __init__(self, starting_point, state_file=None, block_size=BLOCK_SIZE):
+        self.state_file = state_file
+        self.block_size = block_size
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as state:
+                starting_point = max(starting_point, int(state.read().strip(), 16))
+        self.next_number = starting_point
+        # the state file holds block_end: every number below it may have been handed out
+        self.block_end = starting_point
+        self.lock = threading.Lock()
+
+    def take_numbers(self, count):
+        with self.lock:
+            first_number = self.next_number
+            self.next_number += count
+            if self.state_file and self.next_number > self.block_end:
+                self.reserve_block(first_number + max(self.block_size, count))
+        return range(first_number, first_number + count)
+
+    def reserve_block(self, block_end):
+        """Durably record the end of the next block, before any of its references are handed out"""
+        temporary_file = self.state_file + ".tmp"
+        with open(temporary_file, "w") as state:
+            state.write(str(hex(block_end))[2:])
+            state.flush()
+            os.fsync(state.fileno())
+        os.replace(temporary_file, self.state_file)
+        # the new state file only survives a crash once the directory entry pointing to it is on disk too
+        directory = os.open(os.path.dirname(os.path.abspath(self.state_file)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.block_end = block_end
     
     def booking_reference(self):
-        next_number = next(self.counter)
-        return str(hex(next_number))[2:]
+        with BOOKING_REFERENCE_SECONDS.time():
+            (next_number,) = self.take_numbers(1)
+            return str(hex(next_number))[2:]
         
     booking_reference.exposed = True
+
+    def booking_references(self, count=1):
+        try:
+            count = int(count)
+        except ValueError:
+            count = 0
+        if not 1 <= count <= self.MAX_BATCH_SIZE:
+            raise cherrypy.HTTPError(400, "count must be between 1 and {0}".format(self.MAX_BATCH_SIZE))
+        with BOOKING_REFERENCES_SECONDS.time():
+            return json.dumps(self.references(count))
+
+    booking_references.exposed = True
+
+    def references(self, count):
+        """count consecutive references, as a list, for callers in the same process"""
+        return [str(hex(number))[2:] for number in self.take_numbers(count)]
+
+    def metrics(self):
+        cherrypy.response.headers["Content-Type"] = CONTENT_TYPE
+        return METRICS.render()
+
+    metrics.exposed = True
     
+STATE_FILE = "booking_reference_state.txt"
+
 def main(args):
+    state_file = STATE_FILE
+    for arg in list(args):
+        if arg.startswith("--state-file="):
+            state_file = arg[len("--state-file="):]
+            args.remove(arg)
     if args:
         starting_point = int(args[0], 16) + 1
     else:
         starting_point = 123456789
 
     cherrypy.config.update({"server.socket_port" : 8082})
-    cherrypy.quickstart(BookingReferenceService(starting_point))
+    cherrypy.quickstart(BookingReferenceService(starting_point, state_file))
 
 if __name__ == "__main__":
     import sys
@@ -47,8 +136,14 @@ The service will start on this url:
 
     http://localhost:8082/booking_reference
 
-If you have to restart the service, you can continue counting from the
-previous reference by passing it on the command line:
+When restarted, the service continues counting after the references it
+reserved in its state file, booking_reference_state.txt in the current
+directory. Choose another state file with:
+
+    python {0} --state-file=/var/lib/booking_reference/state.txt
+
+You can also make it continue counting after a given reference by passing
+it on the command line:
 
     python {0} 75bcd15
     """.format(sys.argv[0])
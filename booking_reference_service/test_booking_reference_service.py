@@ -1,5 +1,12 @@
 # Use py.test to run this test
 
+import json
+import os
+import stat
+
+import cherrypy
+import pytest
+
 from booking_reference_service import BookingReferenceService
 
 def test_booking_number_looks_like_a_suitable_string():
@@ -12,4 +19,63 @@ def test_booking_reference_is_unique():
     service = BookingReferenceService(123456789)
     booking_number1 = service.booking_reference()
     booking_number2 = service.booking_reference()
-    assert not booking_number1 == booking_number2
\ No newline at end of file
+    assert not booking_number1 == booking_number2
+
+def test_booking_references_are_a_contiguous_block():
+    service = BookingReferenceService(123456789)
+    references = json.loads(service.booking_references("3"))
+    assert references == ["75bcd15", "75bcd16", "75bcd17"]
+    assert service.booking_reference() == "75bcd18"
+
+def test_booking_references_count_is_bounded():
+    service = BookingReferenceService(123456789)
+    with pytest.raises(cherrypy.HTTPError):
+        service.booking_references("0")
+    with pytest.raises(cherrypy.HTTPError):
+        service.booking_references(str(BookingReferenceService.MAX_BATCH_SIZE + 1))
+
+def test_metrics_report_booking_reference_latency():
+    service = BookingReferenceService(123456789)
+    service.booking_reference()
+    assert "booking_reference_service_booking_reference_seconds_count" in service.metrics()
+
+def test_booking_references_are_unique_across_restarts(tmp_path):
+    state_file = str(tmp_path / "state.txt")
+    service = BookingReferenceService(123456789, state_file, block_size=10)
+    issued = [service.booking_reference() for _ in range(15)]
+    issued += json.loads(service.booking_references("12"))
+
+    restarted = BookingReferenceService(123456789, state_file, block_size=10)
+    assert restarted.booking_reference() not in issued
+    assert len(set(issued)) == len(issued)
+
+def test_state_file_is_written_once_per_block(tmp_path, monkeypatch):
+    state_file = str(tmp_path / "state.txt")
+    service = BookingReferenceService(123456789, state_file, block_size=1000)
+    writes = []
+    real_replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda source, target: writes.append(target) or real_replace(source, target))
+    for _ in range(1000):
+        service.booking_reference()
+    assert writes == [state_file]
+    with open(state_file) as state:
+        assert int(state.read(), 16) == 123456789 + 1000
+
+def test_state_file_directory_is_fsynced_after_the_replace(tmp_path, monkeypatch):
+    state_file = str(tmp_path / "state.txt")
+    service = BookingReferenceService(123456789, state_file, block_size=10)
+    events = []
+    real_replace = os.replace
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "replace", lambda source, target: events.append("replace") or real_replace(source, target))
+    def recording_fsync(descriptor):
+        events.append("fsync directory" if stat.S_ISDIR(os.fstat(descriptor).st_mode) else "fsync file")
+        real_fsync(descriptor)
+    monkeypatch.setattr(os, "fsync", recording_fsync)
+    service.booking_reference()
+    assert events == ["fsync file", "replace", "fsync directory"]
+
+def test_references_are_listed_for_callers_in_the_same_process():
+    service = BookingReferenceService(123456789)
+    assert service.references(2) == ["75bcd15", "75bcd16"]
+    assert service.booking_reference() == "75bcd17"
@@ -22,7 +22,7 @@ import pytest
 
 url = "http://127.0.0.1:8083"
 interpreter = "python3"
-reservation_script = os.path.join("python", "reserve.py")
+reservation_script = os.path.join("ticket_office_service", "reserve.py")
 
 class TrainReservationTest(unittest.TestCase):
 
@@ -40,9 +40,9 @@ class TrainReservationTest(unittest.TestCase):
         assert "75bcd15" == reservation["booking_reference"]
 
 
-    @pytest.mark.skip(reason="not implemented the command line interface for this service")
+    @pytest.mark.skip(reason="expects freshly started services, like the POST test: run one of the two")
     def test_reserve_seats_via_cmd(self):
-        response = subprocess.check_output([interpreter, reservation_script, "express2000", "4"], stderr=subprocess.STDOUT, universal_newlines = True)
+        response = subprocess.check_output([interpreter, reservation_script, "express_2000", "4"], stderr=subprocess.STDOUT, universal_newlines = True)
         reservation = json.loads(response)
         
         assert "express_2000" == reservation["train_id"]
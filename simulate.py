@@ -0,0 +1,186 @@
+"""
+Demand simulation for capacity planning. Run it from the repository root:
+
+    python3 simulate.py --fleet 1000 --curve opening --periods 30 --peak 5000
+
+It replays a demand curve through the ticket office, wired to a train data
+service and a booking reference service living in the same process (see
+ticket_office_service/in_process_adapters.py), so reservations run at in-memory
+speed, without HTTP or json in between. No service has to be started and
+nothing is written to disk.
+
+The trains are a fleet generated in memory (see generate_trains.py), or are
+loaded with --trains from a json or json-lines file. The demand curve gives the
+relative number of reservation requests in each period of the sales window,
+e.g. each day before departure:
+
+- flat:         the same demand in every period
+- opening:      a rush when sales open, tailing off
+- last_minute:  demand growing towards departure
+- or a file holding one number per line, one line per period
+
+The busiest period gets --peak requests and the others their share of it. Each
+request is for a random train and a group size drawn from --group-sizes.
+
+The results are printed to stdout as one json document, with for each period
+the requests made, the reservations and seats sold, the refusals and the load
+factor of the fleet, plus the totals and the reservations made per second.
+"""
+
+import argparse
+import importlib
+import json
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_service(directory, *module_names):
+    """Import modules of one service, which import each other by their bare names
+
+    Only the service's own directory is on sys.path meanwhile, and its modules are taken out of
+    sys.modules afterwards, so the next service imports its own copies of the modules they share,
+    such as metrics and json_codec, instead of reusing those of the previous one.
+    """
+    path = os.path.join(ROOT, directory)
+    sys.path.insert(0, path)
+    try:
+        return [importlib.import_module(name) for name in module_names]
+    finally:
+        sys.path.remove(path)
+        for name, module in list(sys.modules.items()):
+            if os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or os.sep)) == path:
+                del sys.modules[name]
+
+
+booking_reference_service, = import_service("booking_reference_service", "booking_reference_service")
+generate_trains, train_data_service = import_service("train_data_service", "generate_trains", "train_data_service")
+ticket_office, in_process_adapters, train_services_adapters = import_service(
+    "ticket_office_service", "ticket_office", "in_process_adapters", "train_services_adapters")
+
+CURVES = {
+    "flat": lambda period, periods: 1.0,
+    "opening": lambda period, periods: math.exp(-4.0 * period / periods),
+    "last_minute": lambda period, periods: math.exp(-4.0 * (periods - 1 - period) / periods),
+}
+
+
+def demand_curve(name, periods):
+    """Relative demand per period, the busiest one being 1"""
+    if name in CURVES:
+        curve = [CURVES[name](period, periods) for period in range(periods)]
+    else:
+        with open(name) as lines:
+            curve = [float(line) for line in lines if line.strip()]
+    busiest = max(curve)
+    return [demand / busiest for demand in curve]
+
+
+def parse_group_sizes(text):
+    """"1:50,2:30" gives ([1, 2], [50, 30]): group sizes and their weights"""
+    sizes, weights = [], []
+    for item in text.split(","):
+        size, _, weight = item.partition(":")
+        sizes.append(int(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def generated_fleet(train_count, seed, booked_share):
+    rng = random.Random(seed)
+    trains = {}
+    for index in range(train_count):
+        kind, seats = generate_trains.generate_train(rng, booked_share)
+        trains["{0}_{1}".format(kind, index)] = {"seats": seats}
+    return trains
+
+
+def simulate(ticket_office, train_ids, curve, peak, group_sizes, rng, total_seats, booked_seats):
+    sizes, weights = group_sizes
+    periods = []
+    start = time.perf_counter()
+    for period, demand in enumerate(curve):
+        period_start = time.perf_counter()
+        requests = int(round(peak * demand))
+        reservations = seats = 0
+        for _ in range(requests):
+            reservation = ticket_office.make_reservation(rng.choice(train_ids), rng.choices(sizes, weights)[0])
+            if reservation is not None:
+                reservations += 1
+                seats += len(reservation.seats)
+        booked_seats += seats
+        periods.append({
+            "period": period,
+            "requests": requests,
+            "reservations": reservations,
+            "refused": requests - reservations,
+            "seats_sold": seats,
+            "load_factor": round(booked_seats / total_seats, 4) if total_seats else 0.0,
+            "seconds": round(time.perf_counter() - period_start, 4),
+        })
+    seconds = time.perf_counter() - start
+    total_requests = sum(period["requests"] for period in periods)
+    total_reservations = sum(period["reservations"] for period in periods)
+    return {
+        "periods": periods,
+        "requests": total_requests,
+        "reservations": total_reservations,
+        "refused": total_requests - total_reservations,
+        "seats_sold": sum(period["seats_sold"] for period in periods),
+        "load_factor": periods[-1]["load_factor"] if periods else 0.0,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(total_requests / seconds, 1) if seconds else 0.0,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trains", help="json or json-lines trains file, instead of a generated fleet")
+    parser.add_argument("--fleet", type=int, default=1000, help="trains in the generated fleet")
+    parser.add_argument("--booked-share", type=float, default=0.1, help="share of the generated seats already booked")
+    parser.add_argument("--curve", default="opening", help="flat, opening, last_minute or a file")
+    parser.add_argument("--periods", type=int, default=30, help="periods of the built in curves")
+    parser.add_argument("--peak", type=int, default=1000, help="requests in the busiest period")
+    parser.add_argument("--group-sizes", default="1:50,2:30,3:10,4:10", help="comma separated size:weight")
+    parser.add_argument("--allocate-on-train-data-service", action="store_true",
+                        help="let the train data service pick the seats, see TicketOffice")
+    parser.add_argument("--vectorised-allocation", type=int, default=0,
+                        help="seat count from which trains are allocated with NumPy, 0 for never")
+    parser.add_argument("--no-cache", action="store_true", help="read every train again for each request")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args(args)
+
+    if options.trains:
+        train_data = train_data_service.TrainDataService.from_file(options.trains)
+    else:
+        train_data = train_data_service.TrainDataService(trains=generated_fleet(options.fleet, options.seed, options.booked_share))
+    train_ids = sorted(train_data.trains)
+    total_seats = booked_seats = 0
+    for train_id in train_ids:
+        availability = train_data.seat_availability(train_id)
+        total_seats += availability["total_seats"]
+        booked_seats += availability["total_seats"] - availability["free_seats"]
+
+    cache = None if options.no_cache else train_services_adapters.TrainSnapshotCache(max_size=len(train_ids), ttl=float("inf"))
+    office = ticket_office.TicketOffice(
+        in_process_adapters.InProcessTrainDataAdapter(train_data, cache),
+        in_process_adapters.InProcessBookingReferenceClient(booking_reference_service.BookingReferenceService(123456789)),
+        allocate_on_train_data_service=options.allocate_on_train_data_service,
+        vectorised_allocation=options.vectorised_allocation)
+
+    results = simulate(
+        office, train_ids, demand_curve(options.curve, options.periods), options.peak,
+        parse_group_sizes(options.group_sizes), random.Random(options.seed), total_seats, booked_seats)
+    results["settings"] = vars(options)
+    results["trains"] = len(train_ids)
+    results["total_seats"] = total_seats
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+"""
+Asyncio version of the ticket office, served as a plain ASGI application:
+
+    uvicorn async_ticket_office:app --port 8083
+
+It answers the same `POST /reserve` form as the Flask service in `ticket_office.py`.
+"""
+
+import asyncio
+from typing import Optional
+from urllib.parse import parse_qs
+import json_codec
+from metrics import CONTENT_TYPE, METRICS
+from ticket_office import Reservation, TicketOffice
+from async_train_services_adapters import (
+    AsyncTrainDataAdapter,
+    AsyncBookingReferenceClient,
+)
+from train_services_adapters import ReservationRejected
+
+
+class AsyncTicketOffice:
+    def __init__(
+        self,
+        train_service_adapter: AsyncTrainDataAdapter,
+        booking_reference_adapter: AsyncBookingReferenceClient,
+    ) -> None:
+        self.train_service_adapter = train_service_adapter
+        self.booking_reference_adapter = booking_reference_adapter
+
+    async def make_reservation(
+        self, train_id: str, seat_count: int
+    ) -> Optional[Reservation]:
+        if seat_count == 0:
+            return None
+
+        # The booking reference does not depend on the train data, so both
+        # upstream calls are in flight at the same time.
+        seats, booking_reference = await asyncio.gather(
+            self.train_service_adapter.get_train_data(train_id),
+            self.booking_reference_adapter.get_booking_reference(),
+        )
+        if not seats:
+            return None
+
+        seats_to_reserve = TicketOffice.allocate_seats(seats, seat_count)
+        if not seats_to_reserve:
+            return None
+
+        try:
+            await self.train_service_adapter.reserve(
+                train_id=train_id,
+                seats=seats_to_reserve,
+                booking_reference=booking_reference,
+            )
+        except ReservationRejected:
+            # the train changed since it was read: read it again and try once
+            # more, with the same booking reference
+            seats = await self.train_service_adapter.get_train_data(train_id)
+            if not seats:
+                return None
+            seats_to_reserve = TicketOffice.allocate_seats(seats, seat_count)
+            if not seats_to_reserve:
+                return None
+            try:
+                await self.train_service_adapter.reserve(
+                    train_id=train_id,
+                    seats=seats_to_reserve,
+                    booking_reference=booking_reference,
+                )
+            except ReservationRejected:
+                return None
+        return Reservation(
+            train_id, seats=seats_to_reserve, booking_reference=booking_reference
+        )
+
+    async def aclose(self) -> None:
+        await self.train_service_adapter.aclose()
+        await self.booking_reference_adapter.aclose()
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def _send_response(
+    send, status: int, body: str, content_type: str = "application/json"
+) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode("latin-1"))],
+        }
+    )
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+
+def create_asgi_app(ticket_office: Optional[AsyncTicketOffice] = None):
+    if ticket_office is None:
+        ticket_office = AsyncTicketOffice(
+            AsyncTrainDataAdapter(), AsyncBookingReferenceClient()
+        )
+
+    async def app(scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await ticket_office.aclose()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["path"] == "/metrics":
+            await _send_response(send, 200, METRICS.render(), CONTENT_TYPE)
+            return
+        if scope["path"] != "/reserve":
+            await _send_response(send, 404, json_codec.dumps("not found"))
+            return
+        if scope["method"] != "POST":
+            await _send_response(send, 405, json_codec.dumps("method not allowed"))
+            return
+
+        form = parse_qs((await _read_body(receive)).decode("ISO-8859-1"))
+        try:
+            train_id = form["train_id"][0]
+            seat_count = int(form["seat_count"][0])
+        except (KeyError, ValueError):
+            await _send_response(send, 400, json_codec.dumps("bad reservation request"))
+            return
+
+        reservation = await ticket_office.make_reservation(train_id, seat_count)
+        await _send_response(send, 200, json_codec.dumps(reservation))
+
+    return app
+
+
+app = create_asgi_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=8083)
@@ -0,0 +1,85 @@
+import json
+from typing import List, Optional
+import httpx
+import json_codec
+from train_services_adapters import (
+    DEFAULT_TIMEOUT,
+    ReservationRejected,
+    SeatMap,
+    Timeout,
+    TrainDataAdapter,
+    BookingReferenceClient,
+    seats_from_train_data,
+)
+
+# One event loop multiplexes many more in-flight reservations than a thread pool
+ASYNC_POOL_SIZE = 100
+
+
+def create_async_client(
+    timeout: Timeout = DEFAULT_TIMEOUT,
+    max_connections: int = ASYNC_POOL_SIZE,
+    max_keepalive_connections: int = ASYNC_POOL_SIZE,
+) -> httpx.AsyncClient:
+    """Build a keep-alive client with the same (connect, read) timeout
+    convention as the synchronous adapters."""
+    connect_timeout, read_timeout = timeout
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        ),
+    )
+
+
+class AsyncTrainDataAdapter:
+    URL = TrainDataAdapter.URL
+
+    def __init__(
+        self, client: Optional[httpx.AsyncClient] = None, url: Optional[str] = None
+    ) -> None:
+        self.url = url or self.URL
+        self.client = client or create_async_client()
+
+    async def get_train_data(self, train_id: str) -> Optional[SeatMap]:
+        response = await self.client.get(self.url + f"/data_for_train/{train_id}")
+        return seats_from_train_data(json_codec.loads(response.content))
+
+    async def reserve(
+        self, train_id: str, seats: List[str], booking_reference: str
+    ) -> str:
+        """Raises ReservationRejected when the train data service refuses the
+        seats, which it answers in plain text, e.g. "already booked"."""
+        form_data = {
+            "train_id": train_id,
+            "seats": json.dumps(seats),
+            "booking_reference": booking_reference,
+        }
+        response = await self.client.post(self.url + "/reserve", data=form_data)
+        response.raise_for_status()
+        try:
+            train_data = json_codec.loads(response.content)
+        except ValueError as error:
+            raise ReservationRejected(response.text) from error
+        return f"situation after reservation: {train_data}"
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class AsyncBookingReferenceClient:
+    URL = BookingReferenceClient.URL
+
+    def __init__(
+        self, client: Optional[httpx.AsyncClient] = None, url: Optional[str] = None
+    ) -> None:
+        self.url = url or self.URL
+        self.client = client or create_async_client()
+
+    async def get_booking_reference(self) -> str:
+        response = await self.client.get(self.url + "/booking_reference")
+        return response.text
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,129 @@
+"""
+Adapters calling a TrainDataService and a BookingReferenceService living in the
+same process, for batch simulations and capacity planning (see simulate.py at
+the root of the repository):
+
+    train_data = TrainDataService.from_file("trains.json")
+    booking_references = BookingReferenceService(123456789)
+    ticket_office = TicketOffice(
+        InProcessTrainDataAdapter(train_data),
+        InProcessBookingReferenceClient(booking_references),
+    )
+
+They have the methods of TrainDataAdapter and BookingReferenceClient, but pass
+python structures to the services' native methods instead of json over HTTP.
+The services are not imported here: any object with those methods will do.
+"""
+
+from typing import Any, Dict, List, Optional
+from train_services_adapters import ReservationRejected, SeatMap, TrainSnapshotCache
+
+
+class InProcessTrainDataAdapter:
+    def __init__(
+        self, service: Any, cache: Optional[TrainSnapshotCache] = None
+    ) -> None:
+        """With a `cache`, the seat maps read are kept and brought up to date
+        with the seats booked through this adapter, instead of being built
+        again from the service's train after each reservation."""
+        self.service = service
+        self.cache = cache
+
+    def get_train_data(self, train_id: str) -> Optional[SeatMap]:
+        if self.cache is not None:
+            seats = self.cache.get(train_id)
+            if seats is not None:
+                return seats
+        seats = self.download_train_data(train_id)
+        if self.cache is not None and seats is not None:
+            self.cache.put(train_id, seats)
+        return seats
+
+    def download_train_data(self, train_id: str) -> Optional[SeatMap]:
+        return self.service.read_train(train_id, SeatMap.from_train_data)
+
+    def get_changes(
+        self, train_id: str, since_version: int, wait: float = 0.0
+    ) -> Optional[dict]:
+        return self.service.changes_since(train_id, since_version, wait)
+
+    def get_availability(self, train_id: str) -> Optional[dict]:
+        return self.service.seat_availability(train_id)
+
+    def _booked(self, train_id: str, version: int, seats: Dict[str, str]) -> None:
+        """Keep the cached seat map in step with a booking made at `version`."""
+        if self.cache is None:
+            return
+        cached = self.cache.peek(train_id)
+        if isinstance(cached, SeatMap) and cached.version == version - 1:
+            self.cache.put(
+                train_id, cached.with_changes([{"version": version, "seats": seats}])
+            )
+        else:
+            self.cache.invalidate(train_id)
+
+    def reserve(
+        self,
+        train_id: str,
+        seats: List[str],
+        booking_reference: str,
+        expected_version: Optional[int] = None,
+    ) -> str:
+        """Raises ReservationRejected when the seats cannot be reserved."""
+        try:
+            version, changed_seats = self.service.book_reservations(
+                train_id, {booking_reference: seats}, expected_version
+            )
+        except ValueError as refusal:
+            if self.cache is not None:
+                self.cache.invalidate(train_id)
+            raise ReservationRejected(str(refusal)) from refusal
+        self._booked(train_id, version, changed_seats)
+        return f"situation after reservation: version {version}, seats {changed_seats}"
+
+    def reserve_batch(
+        self,
+        train_id: str,
+        reservations: Dict[str, List[str]],
+        expected_version: Optional[int] = None,
+    ) -> bool:
+        try:
+            version, changed_seats = self.service.book_reservations(
+                train_id, reservations, expected_version
+            )
+        except ValueError:
+            if self.cache is not None:
+                self.cache.invalidate(train_id)
+            return False
+        self._booked(train_id, version, changed_seats)
+        return True
+
+    def allocate(
+        self, train_id: str, seat_count: int, booking_reference: str
+    ) -> Optional[dict]:
+        allocation = self.service.allocate_and_book(
+            train_id, seat_count, booking_reference
+        )
+        if allocation and allocation["seats"]:
+            self._booked(
+                train_id,
+                allocation["version"],
+                dict.fromkeys(allocation["seats"], booking_reference),
+            )
+        return allocation
+
+    def reset(self, train_id: str) -> None:
+        self.service.reset_train(train_id)
+        if self.cache is not None:
+            self.cache.invalidate(train_id)
+
+
+class InProcessBookingReferenceClient:
+    def __init__(self, service: Any) -> None:
+        self.service = service
+
+    def get_booking_reference(self) -> str:
+        return self.service.booking_reference()
+
+    def get_booking_references(self, count: int) -> List[str]:
+        return self.service.references(count)
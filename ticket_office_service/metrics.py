@@ -0,0 +1,150 @@
+"""
+Latency histograms, rendered in the Prometheus text exposition format.
+
+Histograms are registered once at import time and timed with:
+
+    with RESERVE_SECONDS.time():
+        ...
+
+When the registry is disabled, `time()` hands back a shared no-op context manager,
+so instrumented code only pays for one attribute check. Counters count events:
+
+    RETRIES.inc()
+
+Each service ships its own copy of this file, so that it runs on its own: keep
+the copies identical, ticket_office_service/test_metrics.py checks they are.
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import Dict, List, Sequence, Union
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)  # fmt: skip
+
+
+class _NoOpTimer:
+    def __enter__(self) -> "_NoOpTimer":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+_NO_OP_TIMER = _NoOpTimer()
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "Histogram") -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        help_text: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def time(self) -> Union[_Timer, _NoOpTimer]:
+        if not self.registry.enabled:
+            return _NO_OP_TIMER
+        return _Timer(self)
+
+    def observe(self, seconds: float) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def render(self) -> str:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+        lines: List[str] = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{upper_bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    def __init__(self, registry: "MetricsRegistry", name: str, help_text: str) -> None:
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> str:
+        return (
+            f"# HELP {self.name} {self.help_text}\n"
+            f"# TYPE {self.name} counter\n"
+            f"{self.name} {self.value}\n"
+        )
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, Counter] = {}
+
+    def histogram(
+        self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(self, name, help_text, buckets)
+        return self.histograms[name]
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        if name not in self.counters:
+            self.counters[name] = Counter(self, name, help_text)
+        return self.counters[name]
+
+    def render(self) -> str:
+        return "".join(
+            metric.render()
+            for metric in [*self.histograms.values(), *self.counters.values()]
+        )
+
+
+# METRICS_ENABLED=0 switches the instrumentation off for the whole process
+METRICS = MetricsRegistry(enabled=os.environ.get("METRICS_ENABLED", "1") != "0")
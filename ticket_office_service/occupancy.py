@@ -0,0 +1,78 @@
+"""
+Occupancy of a large train computed with NumPy, when it is installed:
+
+    pip install numpy
+
+The booked state and the coach of every seat of a SeatMap are viewed as arrays,
+without copying, so the 70% rule of the train, the occupation of every coach and
+the best coach are worked out with vectorised operations instead of a Python
+loop over the seats. `best_coaches` scores many seat counts at once, e.g. for an
+availability quote.
+Building the arrays has a fixed cost, which one allocation only pays back from
+a few hundred seats: TICKET_OFFICE_VECTORISED_ALLOCATION=500 is a good start.
+
+The results are exactly those of TicketOffice.allocate_seats: the same floating
+point formulas are evaluated in the same order, and ties go to the first coach.
+`numpy` is None here when it is not installed, and the ticket office then keeps
+to its pure Python allocation.
+"""
+
+from typing import Iterable, List, Optional
+from train_services_adapters import SeatMap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TrainOccupancy:
+    def __init__(
+        self, seat_map: SeatMap, maximum_occupation_percentage: float = 70
+    ) -> None:
+        layout = seat_map.layout
+        self.seat_map = seat_map
+        self.maximum_occupation_percentage = maximum_occupation_percentage
+        self.booked = numpy.frombuffer(seat_map.booked, dtype=numpy.uint8)
+        self.coach_ids = numpy.frombuffer(
+            layout.coach_ids, dtype=layout.coach_ids.typecode
+        )
+        coach_sizes = numpy.frombuffer(
+            layout.coach_sizes, dtype=layout.coach_sizes.typecode
+        ).astype(numpy.int64)
+        self.free_seats = numpy.bincount(
+            self.coach_ids[self.booked == 0], minlength=len(coach_sizes)
+        )
+        self.total_free_seats = int(self.free_seats.sum())
+        # as CoachAvailability.occupation_percentage
+        self.coach_occupation = 100 * (1 - self.free_seats / coach_sizes)
+
+    def best_coaches(self, seat_counts: Iterable[int]) -> "numpy.ndarray":
+        """For each seat count, the number of the coach `allocate_seats` books
+        the seats in, or -1 when the train cannot take that many passengers.
+        Coach numbers index `seat_map.layout.coaches`."""
+        counts = numpy.fromiter(seat_counts, dtype=numpy.int64)
+        train_occupation = 100 * (
+            1 - (self.total_free_seats - counts) / len(self.booked)
+        )
+        # one row per seat count, one column per coach
+        occupation = numpy.where(
+            self.free_seats[None, :] >= counts[:, None],
+            self.coach_occupation[None, :],
+            numpy.inf,
+        )
+        best = occupation.argmin(axis=1)
+        best_occupation = occupation[numpy.arange(len(counts)), best]
+        allowed = (train_occupation <= self.maximum_occupation_percentage) & (
+            best_occupation < 100.0
+        )
+        return numpy.where(allowed, best, -1)
+
+    def allocate_seats(self, seat_count: int) -> Optional[List[str]]:
+        """The seats TicketOffice.allocate_seats picks, or None."""
+        coach = int(self.best_coaches([seat_count])[0])
+        if coach < 0:
+            return None
+        empty_seats = numpy.flatnonzero((self.coach_ids == coach) & (self.booked == 0))
+        seat_names = self.seat_map.layout.seat_names
+        return [seat_names[index] for index in empty_seats[:seat_count]]
@@ -0,0 +1,273 @@
+"""
+Command line ticket office. Reserve seats on one train:
+
+    python reserve.py express_2000 4
+
+which prints the reservation as json, with no seats and an empty booking
+reference when the seats cannot be reserved:
+
+    {"train_id": "express_2000", "seats": ["1A", "2A", "3A", "4A"], "booking_reference": "75bcd15"}
+
+Or replay a whole file of reservation requests, e.g. for a migration or a
+pre-sale:
+
+    python reserve.py --file bookings.csv --workers 8
+
+The file holds "train_id,seat_count" csv rows, with or without a header line,
+or json lines such as {"train_id": "express_2000", "seat_count": 4} when its name
+ends with .jsonl or with --format=jsonl. Use "-" to read stdin.
+
+Each train is handled by one of the workers only, so requests for the same
+train are made in file order and never compete for seats, while different
+trains are reserved in parallel. With --batch-size, a worker makes up to that
+many queued requests at once through TicketOffice.make_reservations.
+
+Results are written to stdout as json lines as they complete, each with the
+line of its request; a line that is not a request is reported there as an
+error, and a throughput summary is written to stderr at the end.
+The services are reached as configured by the TICKET_OFFICE_* environment
+variables, see Settings in ticket_office.py.
+"""
+
+import argparse
+import csv
+import queue
+import sys
+import time
+from dataclasses import asdict, dataclass, replace
+from threading import Lock, Thread
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple
+import json_codec
+from ticket_office import Reservation, Settings, TicketOffice, create_ticket_office
+from train_services_adapters import shard_for
+
+# (line number in the file, train id, seat count)
+ReservationRequest = Tuple[int, str, int]
+
+
+def read_requests(
+    lines: Iterable[str],
+    file_format: str,
+    malformed: Optional[Callable[[int, str], None]] = None,
+) -> Iterator[ReservationRequest]:
+    """The requests of a file. A line that is not a request is passed to
+    `malformed` with its line number and what is wrong with it, and skipped,
+    or raises ValueError without `malformed`."""
+
+    def skip(line_number: int, error: str) -> None:
+        if malformed is None:
+            raise ValueError(f"line {line_number}: {error}")
+        malformed(line_number, error)
+
+    if file_format == "jsonl":
+        for line_number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    request = json_codec.loads(line)
+                    train_id = request["train_id"]
+                    seat_count = int(request["seat_count"])
+                except (ValueError, TypeError, KeyError) as error:
+                    skip(line_number, f"malformed request: {error!r}")
+                    continue
+                yield line_number, train_id, seat_count
+        return
+    rows = csv.reader(lines)
+    first_row = True
+    for row in rows:
+        if not row or not "".join(row).strip():
+            continue
+        if len(row) < 2:
+            first_row = False
+            skip(rows.line_num, "expected train_id,seat_count")
+            continue
+        train_id, seat_count = row[0].strip(), row[1].strip()
+        if first_row and not seat_count.isdigit():
+            first_row = False
+            continue  # header line
+        first_row = False
+        if not seat_count.isdigit():
+            skip(rows.line_num, f"seat count is not a number: {seat_count!r}")
+            continue
+        yield rows.line_num, train_id, int(seat_count)
+
+
+def reservation_document(train_id: str, reservation: Optional[Reservation]) -> dict:
+    if reservation is None:
+        return {"train_id": train_id, "seats": [], "booking_reference": ""}
+    return asdict(reservation)
+
+
+@dataclass
+class RunSummary:
+    requests: int = 0
+    reserved: int = 0
+    refused: int = 0
+    errors: int = 0
+    seats: int = 0
+    seconds: float = 0.0
+
+    def render(self) -> str:
+        rate = self.requests / self.seconds if self.seconds else 0.0
+        return (
+            f"{self.requests} requests in {self.seconds:.2f}s ({rate:.1f}/s): "
+            f"{self.reserved} reserved ({self.seats} seats), "
+            f"{self.refused} refused, {self.errors} errors"
+        )
+
+
+class BulkReservationRunner:
+    """Make the reservations of a stream of requests with `workers` threads,
+    each one owning the trains that `shard_for` gives it."""
+
+    def __init__(
+        self,
+        ticket_office: TicketOffice,
+        output: IO[str],
+        workers: int = 4,
+        batch_size: int = 1,
+        queue_size: int = 1000,
+    ) -> None:
+        self.ticket_office = ticket_office
+        self.output = output
+        self.batch_size = batch_size
+        self.queues: List["queue.Queue[Optional[ReservationRequest]]"] = [
+            queue.Queue(maxsize=queue_size) for _ in range(workers)
+        ]
+        self.summary = RunSummary()
+        self._output_lock = Lock()
+
+    def run(self, reservation_requests: Iterable[ReservationRequest]) -> RunSummary:
+        start = time.perf_counter()
+        threads = [
+            Thread(target=self._work, args=(requests_queue,), daemon=True)
+            for requests_queue in self.queues
+        ]
+        for thread in threads:
+            thread.start()
+        for reservation_request in reservation_requests:
+            train_id = reservation_request[1]
+            # a full queue holds the reader back until its worker catches up
+            self.queues[shard_for(train_id, len(self.queues))].put(reservation_request)
+        for requests_queue in self.queues:
+            requests_queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.output.flush()
+        self.summary.seconds = time.perf_counter() - start
+        return self.summary
+
+    def _work(
+        self, requests_queue: "queue.Queue[Optional[ReservationRequest]]"
+    ) -> None:
+        while True:
+            reservation_request = requests_queue.get()
+            if reservation_request is None:
+                return
+            batch = [reservation_request]
+            while len(batch) < self.batch_size:
+                try:
+                    reservation_request = requests_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if reservation_request is None:
+                    self._reserve(batch)
+                    return
+                batch.append(reservation_request)
+            self._reserve(batch)
+
+    def _reserve(self, batch: List[ReservationRequest]) -> None:
+        try:
+            if len(batch) == 1:
+                _, train_id, seat_count = batch[0]
+                reservations = [
+                    self.ticket_office.make_reservation(train_id, seat_count)
+                ]
+            else:
+                reservations = self.ticket_office.make_reservations(
+                    [(train_id, seat_count) for _, train_id, seat_count in batch]
+                )
+        except Exception as error:
+            # whatever goes wrong, the worker has to go on draining its queue,
+            # or the reader would block on it for ever
+            self._write(
+                [
+                    {"line": line, "train_id": train_id, "error": str(error)}
+                    for line, train_id, _ in batch
+                ],
+                errors=len(batch),
+            )
+            return
+        documents = []
+        for (line, train_id, _), reservation in zip(batch, reservations):
+            documents.append(
+                dict(line=line, **reservation_document(train_id, reservation))
+            )
+        self._write(documents)
+
+    def report_malformed(self, line: int, error: str) -> None:
+        """Write a line of the file that is not a request as a failed one."""
+        self._write([{"line": line, "error": error}], errors=1)
+
+    def _write(self, documents: List[dict], errors: int = 0) -> None:
+        lines = "".join(json_codec.dumps(document) + "\n" for document in documents)
+        with self._output_lock:
+            self.output.write(lines)
+            summary = self.summary
+            summary.requests += len(documents)
+            summary.errors += errors
+            for document in documents:
+                if document.get("seats"):
+                    summary.reserved += 1
+                    summary.seats += len(document["seats"])
+                elif "error" not in document:
+                    summary.refused += 1
+
+
+def main(args: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("train_id", nargs="?")
+    parser.add_argument("seat_count", nargs="?", type=int)
+    parser.add_argument(
+        "--file", help="csv or json lines file of requests, - for stdin"
+    )
+    parser.add_argument("--format", choices=("csv", "jsonl"))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    options = parser.parse_args(args)
+    if (options.file is None) == (options.seat_count is None):
+        parser.error("give either a train id and a seat count, or --file")
+
+    settings = Settings.from_env()
+    settings = replace(settings, pool_size=max(settings.pool_size, options.workers))
+    ticket_office = create_ticket_office(settings)
+
+    if options.file is None:
+        reservation = ticket_office.make_reservation(
+            options.train_id, options.seat_count
+        )
+        print(json_codec.dumps(reservation_document(options.train_id, reservation)))
+        return 0
+
+    file_format = options.format or (
+        "jsonl" if options.file.endswith((".jsonl", ".ndjson")) else "csv"
+    )
+    runner = BulkReservationRunner(
+        ticket_office, sys.stdout, options.workers, options.batch_size
+    )
+    if options.file == "-":
+        summary = runner.run(
+            read_requests(sys.stdin, file_format, runner.report_malformed)
+        )
+    else:
+        with open(options.file, newline="") as lines:
+            summary = runner.run(
+                read_requests(lines, file_format, runner.report_malformed)
+            )
+    print(summary.render(), file=sys.stderr)
+    return 1 if summary.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+"""
+Resilient calls to the upstream services: a circuit breaker, bounded retries with
+jittered backoff, and hedged requests.
+
+Each upstream gets its own `Resilience` policy, handed to its adapter:
+
+    policy = Resilience("train_data", retries=2, failure_threshold=5, hedge_delay=0.05)
+    adapter = TrainDataAdapter(session, timeout, resilience=policy)
+
+Only GETs are retried or hedged: a POST that timed out may still have reserved
+seats. GETs that are not idempotent either, such as those handing out booking
+references, are called with `idempotent=False` and are not. Every call goes through the circuit breaker, which fails fast with
+`CircuitOpenError` once `failure_threshold` calls in a row have failed, until
+`reset_timeout` seconds have passed and a single probe call succeeds again. A call
+fails when it raises an exception or answers with a 5xx status, and only
+`requests` exceptions are retried.
+
+Retries, hedged requests, failures and calls refused by an open circuit are
+counted in metrics, as `<upstream>_retries_total` and so on. The default policy
+does none of this and calls the session directly.
+"""
+
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Callable, Optional
+import requests
+from metrics import METRICS, MetricsRegistry
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an upstream that keeps failing."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """`failure_threshold` 0 never opens the circuit."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless the upstream may be called. Once
+        `reset_timeout` has passed, one probe call is let through."""
+        if self.opened_at is None:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.probing or self.clock() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("circuit open, upstream keeps failing")
+            self.probing = True
+
+    def record_success(self) -> None:
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                self.failures = 0
+                self.opened_at = None
+                self.probing = False
+
+    def record_failure(self) -> None:
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+class Resilience:
+    def __init__(
+        self,
+        name: str = "upstream",
+        retries: int = 0,
+        backoff: float = 0.05,
+        max_backoff: float = 1.0,
+        failure_threshold: int = 0,
+        reset_timeout: float = 10.0,
+        hedge_delay: float = 0.0,
+        hedge_workers: int = 10,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """Retry a failed GET up to `retries` times, waiting a random time up
+        to `backoff` seconds, doubled at each retry and capped at
+        `max_backoff`. With `hedge_delay`, a GET still unanswered after that
+        many seconds is sent a second time, and the first answer wins."""
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_delay = hedge_delay
+        self.hedge_workers = hedge_workers
+        self.sleep = sleep
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self.enabled = bool(retries or failure_threshold or hedge_delay)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = Lock()
+
+        # the default policy is shared by every adapter and has nothing to count
+        registry = METRICS if self.enabled else MetricsRegistry(enabled=False)
+        self.retried = registry.counter(
+            f"{name}_retries_total", f"GETs to {name} sent again after a failure"
+        )
+        self.hedged = registry.counter(
+            f"{name}_hedged_requests_total", f"Slow GETs to {name} sent a second time"
+        )
+        self.failed = registry.counter(
+            f"{name}_failures_total", f"Calls to {name} that failed"
+        )
+        self.rejected = registry.counter(
+            f"{name}_circuit_open_total", f"Calls to {name} refused by the open circuit"
+        )
+
+    def get(
+        self,
+        session: requests.Session,
+        url: str,
+        hedge: bool = True,
+        idempotent: bool = True,
+        **kwargs,
+    ) -> requests.Response:
+        """GET `url` through the circuit breaker, with retries and, unless
+        `hedge` is False (e.g. for long polls), hedging. A GET that is not
+        `idempotent` is sent once, like a POST."""
+        if not self.enabled:
+            return session.get(url, **kwargs)
+        retries = self.retries if idempotent else 0
+        hedge = hedge and idempotent
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                if hedge and self.hedge_delay:
+                    response = self._hedged_get(session, url, kwargs)
+                else:
+                    response = session.get(url, **kwargs)
+            except requests.RequestException:
+                self._record_failure()
+                if attempt >= retries:
+                    raise
+            except Exception:
+                # not worth a retry, but it must not leave a probe in flight
+                self._record_failure()
+                raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self._record_failure()
+                if attempt >= retries:
+                    return response
+            self.retried.inc()
+            self.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    def post(self, session: requests.Session, url: str, **kwargs) -> requests.Response:
+        """POST `url` through the circuit breaker, once."""
+        if not self.enabled:
+            return session.post(url, **kwargs)
+        self._before_call()
+        try:
+            response = session.post(url, **kwargs)
+        except Exception:
+            self._record_failure()
+            raise
+        if response.status_code < 500:
+            self.breaker.record_success()
+        else:
+            self._record_failure()
+        return response
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Full jitter: retries of many clients spread out instead of
+        hitting the recovering upstream at the same time."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _before_call(self) -> None:
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.rejected.inc()
+            raise
+
+    def _record_failure(self) -> None:
+        self.failed.inc()
+        self.breaker.record_failure()
+
+    def _hedged_get(
+        self, session: requests.Session, url: str, kwargs: dict
+    ) -> requests.Response:
+        executor = self._get_executor()
+        first = executor.submit(session.get, url, **kwargs)
+        done, _ = wait([first], timeout=self.hedge_delay)
+        if done:
+            return first.result()
+        self.hedged.inc()
+        pending = {first, executor.submit(session.get, url, **kwargs)}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if not pending:
+                return done.pop().result()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.hedge_workers,
+                    thread_name_prefix=f"{self.name}-hedge",
+                )
+            return self._executor
+
+
+NO_RESILIENCE = Resilience()
@@ -0,0 +1,149 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+import httpx
+import pytest
+from async_ticket_office import AsyncTicketOffice, create_asgi_app
+from async_train_services_adapters import AsyncTrainDataAdapter
+from ticket_office import Reservation
+from train_services_adapters import ReservationRejected, Seat
+
+
+def make_ticket_office(train_data):
+    train_service_adapter = AsyncMock()
+    train_service_adapter.get_train_data.return_value = train_data
+    booking_reference_adapter = AsyncMock()
+    booking_reference_adapter.get_booking_reference.return_value = "75bcd15"
+    return AsyncTicketOffice(train_service_adapter, booking_reference_adapter)
+
+
+def call_asgi_app(app, method, path, body=b""):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app({"type": "http", "method": method, "path": path}, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def test_should_reserve_seats_asynchronously():
+    ticket_office = make_ticket_office(
+        [
+            Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+            Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+            Seat(seat_name="3A", seat_number="3", coach="A", booking_reference=""),
+        ]
+    )
+
+    result = asyncio.run(ticket_office.make_reservation("express_2000", 2))
+
+    assert result == Reservation(
+        train_id="express_2000", seats=["1A", "2A"], booking_reference="75bcd15"
+    )
+    ticket_office.train_service_adapter.reserve.assert_awaited_once_with(
+        train_id="express_2000", seats=["1A", "2A"], booking_reference="75bcd15"
+    )
+
+
+def test_should_return_none_asynchronously_when_train_not_found():
+    ticket_office = make_ticket_office(None)
+
+    result = asyncio.run(ticket_office.make_reservation("fake_train", 1))
+
+    assert result is None
+    ticket_office.train_service_adapter.reserve.assert_not_awaited()
+
+
+def test_asgi_app_returns_reservation_as_json():
+    ticket_office = make_ticket_office(
+        [Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="")]
+        + [
+            Seat(seat_name=f"{n}B", seat_number=str(n), coach="B", booking_reference="")
+            for n in range(1, 4)
+        ]
+    )
+    app = create_asgi_app(ticket_office)
+
+    status, reservation = call_asgi_app(
+        app, "POST", "/reserve", b"train_id=express_2000&seat_count=2"
+    )
+
+    assert status == 200
+    assert reservation == {
+        "train_id": "express_2000",
+        "seats": ["1B", "2B"],
+        "booking_reference": "75bcd15",
+    }
+
+
+def test_asgi_app_rejects_malformed_requests():
+    app = create_asgi_app(make_ticket_office(None))
+
+    assert call_asgi_app(app, "POST", "/reserve", b"train_id=x")[0] == 400
+    assert call_asgi_app(app, "GET", "/reserve")[0] == 405
+    assert call_asgi_app(app, "POST", "/unknown")[0] == 404
+
+
+def test_rejected_reservation_raises_reservation_rejected():
+    def handler(request):
+        if request.url.path == "/reserve":
+            return httpx.Response(200, text="already booked with reference: 75bcd00")
+        return httpx.Response(503, text="<html>Service Unavailable</html>")
+
+    async def reserve(path):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        adapter = AsyncTrainDataAdapter(client, url="http://train_data" + path)
+        try:
+            await adapter.reserve("express_2000", ["1A"], "75bcd15")
+        finally:
+            await adapter.aclose()
+
+    with pytest.raises(ReservationRejected):
+        asyncio.run(reserve(""))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(reserve("/down"))
+
+
+def test_reservation_rejected_on_a_changed_train_is_retried_on_a_fresh_read():
+    ticket_office = make_ticket_office(None)
+    ticket_office.train_service_adapter.get_train_data.side_effect = [
+        [
+            Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+            Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+        ],
+        [
+            Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="x"),
+            Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+            Seat(seat_name="3A", seat_number="3", coach="A", booking_reference=""),
+            Seat(seat_name="4A", seat_number="4", coach="A", booking_reference=""),
+        ],
+    ]
+    ticket_office.train_service_adapter.reserve.side_effect = [
+        ReservationRejected("already booked with reference: x"),
+        "situation after reservation: {}",
+    ]
+
+    result = asyncio.run(ticket_office.make_reservation("express_2000", 1))
+
+    assert result == Reservation(
+        train_id="express_2000", seats=["2A"], booking_reference="75bcd15"
+    )
+
+
+def test_reservation_rejected_twice_is_refused_asynchronously():
+    ticket_office = make_ticket_office(
+        [
+            Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+            Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+        ]
+    )
+    ticket_office.train_service_adapter.reserve.side_effect = ReservationRejected(
+        "already booked with reference: x"
+    )
+
+    assert asyncio.run(ticket_office.make_reservation("express_2000", 1)) is None
+    assert ticket_office.train_service_adapter.reserve.await_count == 2
@@ -0,0 +1,75 @@
+from unittest.mock import MagicMock
+import pytest
+from in_process_adapters import (
+    InProcessBookingReferenceClient,
+    InProcessTrainDataAdapter,
+)
+from ticket_office import TicketOffice
+from train_services_adapters import Seat, SeatMap, TrainSnapshotCache
+
+SEATS = {
+    "1A": {"coach": "A", "seat_number": "1", "booking_reference": ""},
+    "2A": {"coach": "A", "seat_number": "2", "booking_reference": ""},
+}
+
+
+def train_data_service(version=3):
+    service = MagicMock()
+    service.read_train.side_effect = lambda train_id, reader: reader(SEATS, version)
+    return service
+
+
+def test_get_train_data_reads_the_service_seats_without_json():
+    adapter = InProcessTrainDataAdapter(train_data_service())
+
+    seats = adapter.get_train_data("express_2000")
+
+    assert seats == SeatMap.from_train_data(SEATS)
+    assert seats.version == 3
+
+
+def test_cached_seat_map_follows_the_reservations_made_through_the_adapter():
+    service = train_data_service()
+    service.book_reservations.return_value = (4, {"1A": "75bcd15"})
+    adapter = InProcessTrainDataAdapter(service, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    adapter.reserve("express_2000", ["1A"], "75bcd15")
+
+    seats = adapter.get_train_data("express_2000")
+    assert seats[0] == Seat("1A", "1", "A", "75bcd15")
+    assert seats.version == 4
+    assert service.read_train.call_count == 1
+    assert (adapter.cache.hits, adapter.cache.misses) == (1, 1)
+    service.book_reservations.assert_called_once_with(
+        "express_2000", {"75bcd15": ["1A"]}, None
+    )
+
+
+def test_refused_reservation_raises_and_invalidates_the_cache():
+    service = train_data_service()
+    service.book_reservations.side_effect = ValueError("already booked")
+    adapter = InProcessTrainDataAdapter(service, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    with pytest.raises(ValueError):
+        adapter.reserve("express_2000", ["1A"], "75bcd15")
+    assert adapter.reserve_batch("express_2000", {"75bcd15": ["1A"]}) is False
+
+    assert len(adapter.cache) == 0
+
+
+def test_ticket_office_reserves_through_the_in_process_adapters():
+    service = train_data_service()
+    service.book_reservations.return_value = (4, {"1A": "75bcd15"})
+    booking_reference_service = MagicMock()
+    booking_reference_service.booking_reference.return_value = "75bcd15"
+    booking_reference_service.references.return_value = ["75bcd16", "75bcd17"]
+    booking_references = InProcessBookingReferenceClient(booking_reference_service)
+    ticket_office = TicketOffice(InProcessTrainDataAdapter(service), booking_references)
+
+    reservation = ticket_office.make_reservation("express_2000", 1)
+
+    assert reservation.seats == ["1A"]
+    assert reservation.booking_reference == "75bcd15"
+    assert booking_references.get_booking_references(2) == ["75bcd16", "75bcd17"]
@@ -0,0 +1,44 @@
+import importlib
+import os
+import pytest
+import json_codec
+from ticket_office import Reservation
+
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    monkeypatch.setenv("JSON_CODEC", request.param)
+    yield importlib.reload(json_codec)
+    monkeypatch.undo()
+    importlib.reload(json_codec)
+
+
+def test_codec_backend_can_be_chosen(codec):
+    assert codec.BACKEND == os.environ["JSON_CODEC"]
+
+
+def test_codec_decodes_bytes_and_str(codec):
+    document = {"seats": {"1A": {"coach": "A", "booking_reference": ""}}}
+
+    assert codec.loads(codec.dumps(document).encode("utf-8")) == document
+    assert codec.loads(codec.dumps(document)) == document
+
+
+def test_codec_writes_dataclasses(codec):
+    reservation = Reservation("express_2000", ["1A", "2A"], "75bcd15")
+
+    assert codec.loads(codec.dumps([reservation, None])) == [
+        {
+            "train_id": "express_2000",
+            "seats": ["1A", "2A"],
+            "booking_reference": "75bcd15",
+        },
+        None,
+    ]
+
+
+def test_codec_rejects_invalid_json_with_value_error(codec):
+    with pytest.raises(ValueError):
+        codec.loads(b"already booked")
@@ -0,0 +1,101 @@
+import os
+from unittest.mock import patch
+import pytest
+import json_codec
+import metrics
+from metrics import METRICS, MetricsRegistry
+from ticket_office import TicketOffice, app
+from train_services_adapters import Seat
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("stage_seconds", "Time spent", buckets=(0.1, 1))
+
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == (
+        "# HELP stage_seconds Time spent\n"
+        "# TYPE stage_seconds histogram\n"
+        'stage_seconds_bucket{le="0.1"} 1\n'
+        'stage_seconds_bucket{le="1"} 2\n'
+        'stage_seconds_bucket{le="+Inf"} 3\n'
+        "stage_seconds_sum 5.55\n"
+        "stage_seconds_count 3\n"
+    )
+
+
+def test_counter_renders_its_total():
+    registry = MetricsRegistry()
+    counter = registry.counter("retries_total", "Retried calls")
+
+    counter.inc()
+    counter.inc(2)
+
+    assert registry.render() == (
+        "# HELP retries_total Retried calls\n"
+        "# TYPE retries_total counter\n"
+        "retries_total 3\n"
+    )
+
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry(enabled=False)
+    histogram = registry.histogram("stage_seconds", "Time spent")
+
+    with histogram.time():
+        pass
+
+    assert histogram.counts == [0] * len(histogram.counts)
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_reservation_stages_are_exposed_on_metrics_endpoint(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+        Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+    ]
+    mock_booking_ref_adapter.return_value.get_booking_reference.return_value = "75bcd15"
+    ticket_office = TicketOffice(
+        train_service_adapter=mock_train_data_adapter.return_value,
+        booking_reference_adapter=mock_booking_ref_adapter.return_value,
+    )
+    reserve_count = METRICS.histograms["ticket_office_reserve_seconds"].counts[:]
+
+    ticket_office.make_reservation(train_id="express_2000", seat_count=1)
+
+    assert sum(METRICS.histograms["ticket_office_reserve_seconds"].counts) == (
+        sum(reserve_count) + 1
+    )
+    response = app.test_client().get("/metrics")
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    for stage in (
+        "reservation",
+        "get_train_data",
+        "allocate_seats",
+        "get_booking_reference",
+        "reserve",
+    ):
+        assert f"ticket_office_{stage}_seconds_count" in response.text
+
+
+@pytest.mark.parametrize(
+    "module, services",
+    [
+        (metrics, ["booking_reference_service", "train_data_service"]),
+        (json_codec, ["train_data_service"]),
+    ],
+)
+def test_every_service_ships_the_same_shared_modules(module, services):
+    with open(module.__file__, "rb") as source_file:
+        source = source_file.read()
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(module.__file__)))
+    file_name = os.path.basename(module.__file__)
+    for service in services:
+        with open(os.path.join(repository, service, file_name), "rb") as copy:
+            assert copy.read() == source, f"{service}/{file_name} differs"
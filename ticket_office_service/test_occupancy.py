@@ -0,0 +1,83 @@
+import random
+from unittest.mock import MagicMock
+import pytest
+from ticket_office import TicketOffice, build_coach_index
+from train_services_adapters import SeatMap
+
+numpy = pytest.importorskip("numpy")
+from occupancy import TrainOccupancy  # noqa: E402
+
+
+def random_train(rng, coach_count, seats_per_coach, booked_share):
+    seats = {}
+    for coach in "ABCDEFGHIJKLMNOPQRST"[:coach_count]:
+        for number in range(1, seats_per_coach + 1):
+            booked = rng.random() < booked_share
+            seats[f"{number}{coach}"] = {
+                "coach": coach,
+                "seat_number": str(number),
+                "booking_reference": "75bcd15" if booked else "",
+            }
+    return SeatMap.from_train_data(seats)
+
+
+def test_should_pick_the_same_seats_as_the_python_allocation():
+    rng = random.Random(0)
+    for _ in range(200):
+        seat_map = random_train(
+            rng, rng.randint(1, 12), rng.randint(1, 20), rng.random() * 0.9
+        )
+        occupancy = TrainOccupancy(seat_map)
+
+        for seat_count in range(0, 25):
+            assert occupancy.allocate_seats(seat_count) == TicketOffice.allocate_seats(
+                seat_map, seat_count
+            )
+
+
+def test_should_score_many_seat_counts_at_once():
+    seat_map = random_train(random.Random(1), 4, 10, 0.3)
+    coach_index = build_coach_index(seat_map)
+
+    best_coaches = TrainOccupancy(seat_map).best_coaches(range(1, 11))
+
+    for seat_count, coach in zip(range(1, 11), best_coaches):
+        seats = TicketOffice.allocate_seats(seat_map, seat_count)
+        if seats is None:
+            assert coach == -1
+        else:
+            coach_name = seat_map.layout.coaches[coach]
+            assert set(seats) <= set(coach_index[coach_name].empty_seats)
+
+
+def test_should_break_ties_on_the_first_coach():
+    seat_map = random_train(random.Random(2), 3, 10, 0.0)
+
+    assert list(TrainOccupancy(seat_map).best_coaches([1, 10, 11])) == [0, 0, -1]
+
+
+def test_ticket_office_uses_the_vectorised_allocation_for_large_trains():
+    seat_map = random_train(random.Random(3), 8, 50, 0.2)
+    train_data_adapter = MagicMock()
+    train_data_adapter.get_train_data.return_value = seat_map
+    ticket_office = TicketOffice(
+        train_data_adapter, MagicMock(), vectorised_allocation=100
+    )
+
+    reservation = ticket_office.make_reservation("express_2000", 3)
+
+    assert reservation.seats == TicketOffice.allocate_seats(seat_map, 3)
+
+
+def test_vectorised_quote_matches_the_python_quote():
+    rng = random.Random(4)
+    python_office = TicketOffice(MagicMock(), MagicMock())
+    vectorised_office = TicketOffice(MagicMock(), MagicMock(), vectorised_allocation=1)
+    for _ in range(100):
+        seat_map = random_train(
+            rng, rng.randint(1, 12), rng.randint(1, 20), rng.random() * 0.9
+        )
+
+        assert vectorised_office.best_coaches(seat_map) == python_office.best_coaches(
+            seat_map
+        )
@@ -0,0 +1,153 @@
+from io import StringIO
+from threading import current_thread
+from unittest.mock import MagicMock, patch
+import json
+from reserve import BulkReservationRunner, main, read_requests
+from ticket_office import Reservation
+
+
+def test_should_read_csv_requests_with_or_without_header():
+    with_header = ["train_id,seat_count\n", "express_2000,4\n", "\n", "local_1000,2\n"]
+    without_header = ["express_2000,4\n"]
+
+    assert list(read_requests(with_header, "csv")) == [
+        (2, "express_2000", 4),
+        (4, "local_1000", 2),
+    ]
+    assert list(read_requests(without_header, "csv")) == [(1, "express_2000", 4)]
+
+
+def test_should_skip_a_header_after_leading_blank_lines():
+    lines = ["\n", "train_id,seat_count\n", "express_2000,4\n"]
+
+    assert list(read_requests(lines, "csv")) == [(3, "express_2000", 4)]
+
+
+def test_should_read_json_lines_requests():
+    lines = ['{"train_id": "express_2000", "seat_count": 4}\n', "\n"]
+
+    assert list(read_requests(lines, "jsonl")) == [(1, "express_2000", 4)]
+
+
+def reserving_office(refused_train_id=None):
+    threads = {}
+
+    def make_reservation(train_id, seat_count):
+        threads.setdefault(train_id, set()).add(current_thread().name)
+        if train_id == refused_train_id:
+            return None
+        return Reservation(train_id, [f"{n}A" for n in range(seat_count)], "ref")
+
+    ticket_office = MagicMock()
+    ticket_office.make_reservation.side_effect = make_reservation
+    return ticket_office, threads
+
+
+def test_should_reserve_each_train_on_its_own_worker_in_file_order():
+    ticket_office, threads = reserving_office(refused_train_id="full_train")
+    output = StringIO()
+    requests = [(n, f"train_{n % 5}", 1) for n in range(100)] + [(100, "full_train", 2)]
+
+    summary = BulkReservationRunner(ticket_office, output, workers=3).run(requests)
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert len(results) == 101
+    assert all(len(names) == 1 for names in threads.values())
+    for train_id in threads:
+        lines = [result["line"] for result in results if result["train_id"] == train_id]
+        assert lines == sorted(lines)
+    assert {
+        "line": 100,
+        "train_id": "full_train",
+        "seats": [],
+        "booking_reference": "",
+    } in results
+    assert (summary.requests, summary.reserved, summary.refused, summary.seats) == (
+        101,
+        100,
+        1,
+        100,
+    )
+
+
+def test_should_report_failed_requests_as_errors():
+    ticket_office = MagicMock()
+    ticket_office.make_reservation.side_effect = ValueError("seats already booked")
+    output = StringIO()
+
+    summary = BulkReservationRunner(ticket_office, output, workers=2).run(
+        [(1, "express_2000", 4)]
+    )
+
+    assert json.loads(output.getvalue()) == {
+        "line": 1,
+        "train_id": "express_2000",
+        "error": "seats already booked",
+    }
+    assert summary.errors == 1
+
+
+def test_should_keep_going_when_the_office_fails_unexpectedly():
+    ticket_office = MagicMock()
+    ticket_office.make_reservation.side_effect = KeyError("seats")
+    output = StringIO()
+    runner = BulkReservationRunner(ticket_office, output, workers=1, queue_size=2)
+
+    summary = runner.run([(n, "express_2000", 1) for n in range(1, 11)])
+
+    assert summary.errors == 10
+    assert len(output.getvalue().splitlines()) == 10
+
+
+def test_should_batch_queued_requests_of_a_worker():
+    ticket_office = MagicMock()
+    ticket_office.make_reservations.side_effect = lambda requests: [
+        Reservation(train_id, ["1A"], "ref") for train_id, _ in requests
+    ]
+    output = StringIO()
+    runner = BulkReservationRunner(ticket_office, output, workers=1, batch_size=10)
+
+    summary = runner.run([(n, "express_2000", 1) for n in range(1, 6)])
+
+    assert summary.reserved == 5
+    batched = sum(
+        len(call.args[0]) for call in ticket_office.make_reservations.call_args_list
+    )
+    single = ticket_office.make_reservation.call_count
+    assert batched + single == 5
+
+
+@patch("reserve.create_ticket_office")
+def test_should_print_the_reservation_of_one_request(mock_create_ticket_office, capsys):
+    mock_create_ticket_office.return_value.make_reservation.return_value = Reservation(
+        "express_2000", ["1A", "2A"], "75bcd15"
+    )
+
+    assert main(["express_2000", "2"]) == 0
+
+    assert json.loads(capsys.readouterr().out) == {
+        "train_id": "express_2000",
+        "seats": ["1A", "2A"],
+        "booking_reference": "75bcd15",
+    }
+
+
+@patch("reserve.create_ticket_office")
+def test_should_report_malformed_lines_and_go_on(
+    mock_create_ticket_office, tmp_path, capsys
+):
+    mock_create_ticket_office.return_value = reserving_office()[0]
+    bookings = tmp_path / "bookings.csv"
+    bookings.write_text("express_2000,2\nlocal_1000\nexpress_2000,two\nlocal_1000,1\n")
+
+    assert main(["--file", str(bookings), "--workers", "1"]) == 1
+
+    captured = capsys.readouterr()
+    results = {
+        result["line"]: result for result in map(json.loads, captured.out.splitlines())
+    }
+    assert sorted(results) == [1, 2, 3, 4]
+    assert results[2]["error"] == "expected train_id,seat_count"
+    assert results[3]["error"] == "seat count is not a number: 'two'"
+    assert results[4]["seats"] == ["0A"]
+    assert "2 reserved" in captured.err and "2 errors" in captured.err
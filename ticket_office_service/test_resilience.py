@@ -0,0 +1,145 @@
+from threading import Event
+from unittest.mock import MagicMock
+import pytest
+import requests
+from resilience import CircuitOpenError, Resilience
+
+
+def response(status_code=200):
+    return MagicMock(status_code=status_code)
+
+
+def make_policy(**options):
+    options.setdefault("sleep", MagicMock())
+    return Resilience("test_upstream", **options)
+
+
+def test_get_is_retried_after_a_connection_error():
+    session = MagicMock()
+    ok = response()
+    session.get.side_effect = [requests.ConnectionError("refused"), ok]
+    policy = make_policy(retries=2)
+    retries = policy.retried.value
+
+    assert policy.get(session, "http://upstream/data", timeout=(1, 2)) is ok
+    assert session.get.call_count == 2
+    session.get.assert_called_with("http://upstream/data", timeout=(1, 2))
+    assert policy.retried.value == retries + 1
+    assert 0 <= policy.sleep.call_args.args[0] <= policy.backoff
+
+
+def test_retries_are_bounded():
+    session = MagicMock()
+    session.get.side_effect = requests.Timeout("too slow")
+    policy = make_policy(retries=2)
+
+    with pytest.raises(requests.Timeout):
+        policy.get(session, "http://upstream/data")
+    assert session.get.call_count == 3
+
+
+def test_server_errors_are_retried_then_returned():
+    session = MagicMock()
+    session.get.return_value = response(503)
+    policy = make_policy(retries=1)
+
+    assert policy.get(session, "http://upstream/data").status_code == 503
+    assert session.get.call_count == 2
+
+
+def test_get_that_is_not_idempotent_is_sent_once():
+    session = MagicMock()
+    session.get.return_value = response(503)
+    policy = make_policy(retries=2, hedge_delay=0.01)
+
+    assert (
+        policy.get(session, "http://upstream/ref", idempotent=False).status_code == 503
+    )
+    assert session.get.call_count == 1
+
+
+def test_post_is_never_retried():
+    session = MagicMock()
+    session.post.side_effect = requests.Timeout("too slow")
+    policy = make_policy(retries=2)
+
+    with pytest.raises(requests.Timeout):
+        policy.post(session, "http://upstream/reserve", data={})
+    assert session.post.call_count == 1
+
+
+def test_circuit_opens_after_repeated_failures_and_closes_after_a_probe():
+    now = [0.0]
+    session = MagicMock()
+    session.get.side_effect = requests.ConnectionError("refused")
+    policy = make_policy(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            policy.get(session, "http://upstream/data")
+    with pytest.raises(CircuitOpenError):
+        policy.get(session, "http://upstream/data")
+    assert session.get.call_count == 2
+
+    now[0] = 11.0
+    session.get.side_effect = None
+    session.get.return_value = response()
+    policy.get(session, "http://upstream/data")
+    assert not policy.breaker.is_open
+
+
+def test_failed_probe_opens_the_circuit_again():
+    now = [0.0]
+    session = MagicMock()
+    session.post.return_value = response(500)
+    policy = make_policy(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+
+    policy.post(session, "http://upstream/reserve")
+    now[0] = 11.0
+    policy.post(session, "http://upstream/reserve")
+
+    with pytest.raises(CircuitOpenError):
+        policy.post(session, "http://upstream/reserve")
+
+
+def test_probe_raising_an_unexpected_error_lets_the_next_probe_through():
+    now = [0.0]
+    session = MagicMock()
+    session.get.side_effect = requests.ConnectionError("refused")
+    policy = make_policy(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    with pytest.raises(requests.ConnectionError):
+        policy.get(session, "http://upstream/data")
+
+    now[0] = 11.0
+    session.get.side_effect = ValueError("unexpected")
+    with pytest.raises(ValueError):
+        policy.get(session, "http://upstream/data")
+    assert session.get.call_count == 2
+
+    now[0] = 22.0
+    session.get.side_effect = None
+    session.get.return_value = response()
+    policy.get(session, "http://upstream/data")
+    assert not policy.breaker.is_open
+
+
+def test_slow_get_is_hedged_and_first_answer_wins():
+    release_first = Event()
+    fast = response()
+
+    def get(url, **kwargs):
+        if session.get.call_count == 1:
+            release_first.wait(5)
+            return response()
+        return fast
+
+    session = MagicMock()
+    session.get.side_effect = get
+    policy = make_policy(hedge_delay=0.01)
+
+    try:
+        assert policy.get(session, "http://upstream/data") is fast
+    finally:
+        release_first.set()
+    assert session.get.call_count == 2
+    assert policy.hedged.value >= 1
@@ -1,6 +1,11 @@
-from unittest.mock import patch
-from ticket_office import TicketOffice, Reservation
-from train_services_adapters import Seat
+from unittest.mock import MagicMock, patch
+import json
+import pytest
+import requests
+from ticket_office import TicketOffice, Quote, Reservation, Settings, build_coach_index
+from ticket_office import create_app, create_ticket_office
+from train_services_adapters import ReservationRejected, Seat, SeatMap
+from train_services_adapters import TrainDataAdapter, TrainSnapshotCache
 
 
 @patch("ticket_office.BookingReferenceClient")
@@ -220,3 +225,538 @@ def test_should_prefer_coach_C_when_coach_C_is_empty(
     mock_train_data_adapter.return_value.reserve.assert_called_once_with(
         train_id="express_2000", seats=["1C", "2C"], booking_reference="75bcd15"
     )
+
+
+def test_coach_index_counts_total_and_empty_seats_per_coach_in_train_order():
+    train_data = [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="ref1"),
+        Seat(seat_name="1B", seat_number="1", coach="B", booking_reference=""),
+        Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+        Seat(seat_name="2B", seat_number="2", coach="B", booking_reference=""),
+    ]
+
+    coach_index = build_coach_index(train_data)
+
+    assert list(coach_index) == ["A", "B"]
+    assert coach_index["A"].total_seats == 2
+    assert coach_index["A"].empty_seats == ["2A"]
+    assert coach_index["A"].occupation_percentage == 50
+    assert coach_index["B"].empty_seats == ["1B", "2B"]
+    assert coach_index["B"].occupation_percentage == 0
+
+
+def test_coach_index_reads_seat_map_directly():
+    train_data = [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="ref1"),
+        Seat(seat_name="1B", seat_number="1", coach="B", booking_reference=""),
+        Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+        Seat(seat_name="2B", seat_number="2", coach="B", booking_reference=""),
+    ]
+
+    assert build_coach_index(SeatMap.from_seats(train_data)) == build_coach_index(
+        train_data
+    )
+
+
+def test_best_coach_is_the_first_one_when_occupations_are_equal():
+    train_data = [
+        Seat(seat_name="1B", seat_number="1", coach="B", booking_reference=""),
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+    ]
+    ticket_office = TicketOffice(
+        train_service_adapter=None, booking_reference_adapter=None
+    )
+
+    assert ticket_office.get_best_coach_empty_seats(1, train_data) == ["1B"]
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_should_reserve_batch_with_one_fetch_and_one_reserve_per_train(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    trains = {
+        "express_2000": [
+            Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+            for n in range(1, 11)
+        ],
+        "local_1000": [
+            Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="ref1"),
+            Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+        ],
+    }
+    mock_train_data_adapter.return_value.get_train_data.side_effect = trains.get
+    mock_train_data_adapter.return_value.reserve_batch.return_value = True
+    mock_booking_ref_adapter.return_value.get_booking_reference.side_effect = [
+        "ref_a",
+        "ref_b",
+        "ref_c",
+    ]
+    ticket_office = TicketOffice(
+        train_service_adapter=mock_train_data_adapter.return_value,
+        booking_reference_adapter=mock_booking_ref_adapter.return_value,
+    )
+
+    results = ticket_office.make_reservations(
+        [
+            ("express_2000", 2),
+            ("local_1000", 1),
+            ("express_2000", 3),
+            ("express_2000", 0),
+            ("fake_train", 1),
+        ]
+    )
+
+    assert results == [
+        Reservation("express_2000", seats=["1A", "2A"], booking_reference="ref_a"),
+        None,
+        Reservation(
+            "express_2000", seats=["3A", "4A", "5A"], booking_reference="ref_b"
+        ),
+        None,
+        None,
+    ]
+    assert mock_train_data_adapter.return_value.get_train_data.call_count == 3
+    mock_train_data_adapter.return_value.reserve_batch.assert_called_once_with(
+        "express_2000", {"ref_a": ["1A", "2A"], "ref_b": ["3A", "4A", "5A"]}
+    )
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_should_reserve_batch_on_seat_map(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = (
+        SeatMap.from_seats(
+            Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+            for n in range(1, 11)
+        )
+    )
+    mock_train_data_adapter.return_value.reserve_batch.return_value = True
+    mock_booking_ref_adapter.return_value.get_booking_reference.side_effect = [
+        "ref_a",
+        "ref_b",
+    ]
+    ticket_office = TicketOffice(
+        train_service_adapter=mock_train_data_adapter.return_value,
+        booking_reference_adapter=mock_booking_ref_adapter.return_value,
+    )
+
+    results = ticket_office.make_reservations(
+        [("express_2000", 2), ("express_2000", 1)]
+    )
+
+    assert [result.seats for result in results] == [["1A", "2A"], ["3A"]]
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_should_return_none_for_the_whole_train_when_batch_is_rejected(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = [
+        Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+        for n in range(1, 11)
+    ]
+    mock_train_data_adapter.return_value.download_train_data.return_value = (
+        mock_train_data_adapter.return_value.get_train_data.return_value
+    )
+    mock_train_data_adapter.return_value.reserve_batch.return_value = False
+    ticket_office = TicketOffice(
+        train_service_adapter=mock_train_data_adapter.return_value,
+        booking_reference_adapter=mock_booking_ref_adapter.return_value,
+    )
+
+    results = ticket_office.make_reservations(
+        [("express_2000", 1), ("express_2000", 1)]
+    )
+
+    assert results == [None, None]
+    assert mock_train_data_adapter.return_value.reserve_batch.call_count == 2
+
+
+def test_batch_rejected_on_a_stale_cached_train_is_retried_on_a_fresh_read():
+    def seats(*booked):
+        return [
+            Seat(
+                seat_name=f"{n}A",
+                seat_number=str(n),
+                coach="A",
+                booking_reference="75bcd00" if f"{n}A" in booked else "",
+            )
+            for n in range(1, 11)
+        ]
+
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_train_data.return_value = seats()
+    train_service_adapter.download_train_data.return_value = seats("1A")
+    train_service_adapter.reserve_batch.side_effect = [False, True]
+    booking_reference_adapter = MagicMock()
+    booking_reference_adapter.get_booking_reference.side_effect = ["75bcd15", "75bcd16"]
+    ticket_office = TicketOffice(train_service_adapter, booking_reference_adapter)
+
+    results = ticket_office.make_reservations(
+        [("express_2000", 1), ("express_2000", 2)]
+    )
+
+    assert results == [
+        Reservation("express_2000", seats=["2A"], booking_reference="75bcd15"),
+        Reservation("express_2000", seats=["3A", "4A"], booking_reference="75bcd16"),
+    ]
+    train_service_adapter.reserve_batch.assert_called_with(
+        "express_2000", {"75bcd15": ["2A"], "75bcd16": ["3A", "4A"]}
+    )
+    assert booking_reference_adapter.get_booking_reference.call_count == 2
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_reserve_batch_endpoint_returns_a_result_per_request(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = [
+        Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+        for n in range(1, 11)
+    ]
+    mock_train_data_adapter.return_value.reserve_batch.return_value = True
+    mock_booking_ref_adapter.return_value.get_booking_reference.return_value = (
+        "75bcd15"
+    )
+
+    response = create_app(settings=Settings()).test_client().post(
+        "/reserve_batch",
+        json=[
+            {"train_id": "express_2000", "seat_count": 1},
+            {"train_id": "express_2000", "seat_count": 0},
+        ],
+    )
+
+    assert json.loads(response.data) == [
+        {"train_id": "express_2000", "seats": ["1A"], "booking_reference": "75bcd15"},
+        None,
+    ]
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_app_reuses_one_ticket_office_across_requests(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = None
+    app = create_app(settings=Settings())
+
+    for _ in range(3):
+        app.test_client().post(
+            "/reserve_batch", json=[{"train_id": "fake_train", "seat_count": 1}]
+        )
+
+    mock_train_data_adapter.assert_called_once()
+    mock_booking_ref_adapter.assert_called_once()
+
+
+def test_ticket_office_is_built_from_settings():
+    settings = Settings.from_env(
+        {
+            "TICKET_OFFICE_TRAIN_DATA_URL": "http://trains:9000",
+            "TICKET_OFFICE_READ_TIMEOUT": "2.5",
+            "TICKET_OFFICE_POOL_SIZE": "32",
+            "TICKET_OFFICE_TRAIN_CACHE_SIZE": "64",
+            "TICKET_OFFICE_BOOKING_REFERENCE_PREFETCH": "50",
+        }
+    )
+
+    ticket_office = create_ticket_office(settings)
+
+    train_service_adapter = ticket_office.train_service_adapter
+    assert train_service_adapter.url == "http://trains:9000"
+    assert train_service_adapter.timeout == (3.05, 2.5)
+    assert train_service_adapter.cache.max_size == 64
+    assert train_service_adapter.session.get_adapter("http://x")._pool_maxsize == 32
+    booking_reference_adapter = ticket_office.booking_reference_adapter
+    assert booking_reference_adapter.url == "http://127.0.0.1:8082"
+    assert booking_reference_adapter.batch_size == 50
+    assert booking_reference_adapter.session is train_service_adapter.session
+
+
+def test_ticket_office_routes_to_train_data_shards():
+    settings = Settings(
+        train_data_url="http://127.0.0.1:8091,http://127.0.0.1:8092",
+        train_cache_size=64,
+    )
+
+    ticket_office = create_ticket_office(settings)
+
+    shards = ticket_office.train_service_adapter.shards
+    assert [shard.url for shard in shards] == [
+        "http://127.0.0.1:8091",
+        "http://127.0.0.1:8092",
+    ]
+    assert shards[0].session is shards[1].session
+    assert shards[0].cache is shards[1].cache
+
+
+def test_availability_check_turns_down_full_train_without_its_seats():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_availability.return_value = {
+        "free_seats": 3,
+        "total_seats": 10,
+        "coaches": {"A": {"free_seats": 3, "total_seats": 10}},
+    }
+    ticket_office = TicketOffice(
+        train_service_adapter, MagicMock(), check_availability=True
+    )
+
+    assert ticket_office.make_reservation(train_id="express_2000", seat_count=1) is None
+    train_service_adapter.get_train_data.assert_not_called()
+
+
+def test_availability_check_lets_bookable_train_through():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_availability.return_value = {
+        "free_seats": 2,
+        "total_seats": 2,
+        "coaches": {"A": {"free_seats": 2, "total_seats": 2}},
+    }
+    train_service_adapter.get_train_data.return_value = [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference=""),
+        Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+    ]
+    booking_reference_adapter = MagicMock()
+    booking_reference_adapter.get_booking_reference.return_value = "75bcd15"
+    ticket_office = TicketOffice(
+        train_service_adapter, booking_reference_adapter, check_availability=True
+    )
+
+    result = ticket_office.make_reservation(train_id="express_2000", seat_count=1)
+
+    assert result == Reservation("express_2000", ["1A"], "75bcd15")
+
+
+def test_availability_applies_the_allocation_rules():
+    def availability(*coach_free_seats):
+        return {
+            "free_seats": sum(coach_free_seats),
+            "total_seats": 10 * len(coach_free_seats),
+            "coaches": {
+                str(number): {"free_seats": free_seats, "total_seats": 10}
+                for number, free_seats in enumerate(coach_free_seats)
+            },
+        }
+
+    assert TicketOffice.may_allocate_seats(availability(10, 10), 4)
+    assert not TicketOffice.may_allocate_seats(availability(10, 2), 8)
+    assert not TicketOffice.may_allocate_seats(availability(4, 4, 4, 4, 4), 5)
+    assert not TicketOffice.may_allocate_seats(None, 1)
+
+
+def test_train_data_service_can_allocate_the_seats():
+    train_service_adapter = MagicMock()
+    train_service_adapter.allocate.return_value = {"version": 4, "seats": ["1A", "2A"]}
+    booking_reference_adapter = MagicMock()
+    booking_reference_adapter.get_booking_reference.return_value = "75bcd15"
+    ticket_office = TicketOffice(
+        train_service_adapter,
+        booking_reference_adapter,
+        allocate_on_train_data_service=True,
+    )
+
+    result = ticket_office.make_reservation(train_id="express_2000", seat_count=2)
+
+    assert result == Reservation("express_2000", ["1A", "2A"], "75bcd15")
+    train_service_adapter.allocate.assert_called_once_with("express_2000", 2, "75bcd15")
+    train_service_adapter.get_train_data.assert_not_called()
+    train_service_adapter.reserve.assert_not_called()
+
+
+def test_allocation_refused_by_train_data_service_reserves_nothing():
+    train_service_adapter = MagicMock()
+    train_service_adapter.allocate.return_value = {"version": 4, "seats": []}
+    ticket_office = TicketOffice(
+        train_service_adapter, MagicMock(), allocate_on_train_data_service=True
+    )
+
+    assert ticket_office.make_reservation(train_id="express_2000", seat_count=2) is None
+
+
+def test_upstreams_get_their_own_timeouts_and_resilience_policies():
+    settings = Settings.from_env(
+        {
+            "TICKET_OFFICE_BOOKING_REFERENCE_READ_TIMEOUT": "0.5",
+            "TICKET_OFFICE_RETRIES": "3",
+            "TICKET_OFFICE_HEDGE_DELAY": "0.05",
+        }
+    )
+
+    ticket_office = create_ticket_office(settings)
+
+    train_service_adapter = ticket_office.train_service_adapter
+    booking_reference_adapter = ticket_office.booking_reference_adapter
+    assert train_service_adapter.timeout == (3.05, 10.0)
+    assert booking_reference_adapter.timeout == (3.05, 0.5)
+    assert train_service_adapter.resilience.retries == 3
+    assert train_service_adapter.resilience.hedge_delay == 0.05
+    assert train_service_adapter.resilience.breaker.failure_threshold == 5
+    assert (
+        booking_reference_adapter.resilience.breaker
+        is not train_service_adapter.resilience.breaker
+    )
+
+
+def two_coach_seat_map(free_in_a, free_in_b, seats_per_coach=10):
+    return SeatMap.from_seats(
+        Seat(
+            seat_name=f"{number}{coach}",
+            seat_number=str(number),
+            coach=coach,
+            booking_reference="" if number <= free else "75bcd15",
+        )
+        for coach, free in (("A", free_in_a), ("B", free_in_b))
+        for number in range(1, seats_per_coach + 1)
+    )
+
+
+def test_quote_gives_the_best_coach_of_every_bookable_group_size():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_train_data.return_value = two_coach_seat_map(10, 6)
+    ticket_office = TicketOffice(train_service_adapter, MagicMock())
+
+    quote = ticket_office.quote("express_2000")
+
+    # 70% of the 20 seats are booked past 10 passengers, which only coach A takes
+    assert quote == Quote("express_2000", 10, ["A"] * 10)
+    seats = train_service_adapter.get_train_data.return_value
+    for seat_count, coach in enumerate(quote.best_coaches, 1):
+        reserved = TicketOffice.allocate_seats(seats, seat_count)
+        assert {seat[-1] for seat in reserved} == {coach}
+    assert TicketOffice.allocate_seats(seats, 11) is None
+
+
+def test_quote_is_cached_until_the_office_reserves_on_the_train():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_train_data.return_value = two_coach_seat_map(5, 8)
+    ticket_office = TicketOffice(
+        train_service_adapter, MagicMock(), quote_cache=TrainSnapshotCache()
+    )
+
+    first_quote = ticket_office.quote("express_2000")
+    assert ticket_office.quote("express_2000") is first_quote
+    assert train_service_adapter.get_train_data.call_count == 1
+
+    ticket_office.make_reservation("express_2000", 2)
+    train_service_adapter.get_train_data.return_value = two_coach_seat_map(5, 6)
+
+    assert ticket_office.quote("express_2000").best_coaches == ["B"] * 5
+    assert train_service_adapter.get_train_data.call_count == 3
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_quote_endpoint_answers_for_a_seat_count(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = (
+        two_coach_seat_map(4, 10)
+    )
+    client = create_app(settings=Settings()).test_client()
+
+    response = client.get("/quote/express_2000?seat_count=5")
+    too_many = client.get("/quote/express_2000?seat_count=9")
+
+    assert json.loads(response.data) == {
+        "train_id": "express_2000",
+        "largest_group": 8,
+        "best_coaches": ["B"] * 8,
+        "seat_count": 5,
+        "bookable": True,
+        "coach": "B",
+    }
+    assert json.loads(too_many.data)["bookable"] is False
+    assert mock_train_data_adapter.return_value.get_train_data.call_count == 1
+
+
+@patch("ticket_office.BookingReferenceClient")
+@patch("ticket_office.TrainDataAdapter")
+def test_quote_endpoint_rejects_a_seat_count_that_is_not_a_number(
+    mock_train_data_adapter, mock_booking_ref_adapter
+):
+    mock_train_data_adapter.return_value.get_train_data.return_value = (
+        two_coach_seat_map(4, 10)
+    )
+    client = create_app(settings=Settings()).test_client()
+
+    invalid = client.get("/quote/express_2000?seat_count=abc")
+    empty = client.get("/quote/express_2000?seat_count=")
+    missing = client.get("/quote/express_2000")
+
+    assert invalid.status_code == 400
+    assert empty.status_code == 400
+    assert missing.status_code == 200
+    assert "seat_count" not in json.loads(missing.data)
+
+
+def test_reservation_on_a_stale_cached_train_is_retried_on_a_fresh_read():
+    def train_document(*booked):
+        return {
+            "seats": {
+                f"{n}A": {
+                    "coach": "A",
+                    "seat_number": str(n),
+                    "booking_reference": "75bcd00" if f"{n}A" in booked else "",
+                }
+                for n in range(1, 11)
+            }
+        }
+
+    stale, fresh = train_document(), train_document("1A")
+    session = MagicMock()
+    session.get.side_effect = [
+        MagicMock(content=json.dumps(document).encode("utf-8"))
+        for document in (stale, fresh)
+    ]
+    session.post.side_effect = [
+        MagicMock(content=b"already booked with reference: 75bcd00"),
+        MagicMock(content=json.dumps(train_document("1A", "2A")).encode("utf-8")),
+    ]
+    booking_reference_adapter = MagicMock()
+    booking_reference_adapter.get_booking_reference.return_value = "75bcd15"
+    ticket_office = TicketOffice(
+        TrainDataAdapter(session=session, cache=TrainSnapshotCache()),
+        booking_reference_adapter,
+    )
+
+    reservation = ticket_office.make_reservation("express_2000", 1)
+
+    assert reservation == Reservation("express_2000", ["2A"], "75bcd15")
+    assert booking_reference_adapter.get_booking_reference.call_count == 1
+    assert json.loads(session.post.call_args.kwargs["data"]["seats"]) == ["2A"]
+
+
+def test_reservation_rejected_twice_is_refused():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_train_data.return_value = [
+        Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+        for n in range(1, 11)
+    ]
+    train_service_adapter.download_train_data.return_value = (
+        train_service_adapter.get_train_data.return_value
+    )
+    train_service_adapter.reserve.side_effect = ReservationRejected("already booked")
+    ticket_office = TicketOffice(train_service_adapter, MagicMock())
+
+    assert ticket_office.make_reservation("express_2000", 1) is None
+    assert train_service_adapter.reserve.call_count == 2
+
+
+def test_reservation_failing_with_an_error_status_is_not_retried():
+    train_service_adapter = MagicMock()
+    train_service_adapter.get_train_data.return_value = [
+        Seat(seat_name=f"{n}A", seat_number=str(n), coach="A", booking_reference="")
+        for n in range(1, 11)
+    ]
+    train_service_adapter.reserve.side_effect = requests.HTTPError("503")
+    ticket_office = TicketOffice(train_service_adapter, MagicMock())
+
+    with pytest.raises(requests.HTTPError):
+        ticket_office.make_reservation("express_2000", 1)
+    assert train_service_adapter.reserve.call_count == 1
@@ -0,0 +1,465 @@
+from unittest.mock import MagicMock, patch
+import json
+import pytest
+import requests
+from metrics import METRICS
+from resilience import Resilience
+from train_services_adapters import (
+    DEFAULT_TIMEOUT,
+    BookingReferenceClient,
+    PrefetchingBookingReferenceClient,
+    ReservationRejected,
+    Seat,
+    SeatMap,
+    ShardedTrainDataAdapter,
+    TrainDataAdapter,
+    TrainReplica,
+    TrainSnapshotCache,
+    create_session,
+    get_shared_session,
+    shard_for,
+)
+
+
+def json_response(document):
+    return MagicMock(content=json.dumps(document).encode("utf-8"))
+
+
+def test_session_pools_keep_alive_connections():
+    session = create_session(pool_connections=2, pool_maxsize=5)
+
+    adapter = session.get_adapter("http://127.0.0.1:8081")
+    assert adapter._pool_connections == 2
+    assert adapter._pool_maxsize == 5
+
+
+def test_adapters_share_the_process_session_by_default():
+    assert TrainDataAdapter().session is get_shared_session()
+    assert BookingReferenceClient().session is get_shared_session()
+
+
+def test_get_train_data_uses_session_with_timeout():
+    session = MagicMock()
+    session.get.return_value = json_response(
+        {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}}}
+    )
+    adapter = TrainDataAdapter(session=session, timeout=(1, 2))
+
+    seats = adapter.get_train_data("express_2000")
+
+    assert list(seats) == [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="")
+    ]
+    session.get.assert_called_once_with(
+        "http://127.0.0.1:8081/data_for_train/express_2000", timeout=(1, 2)
+    )
+
+
+def test_get_availability_reads_the_seat_counters():
+    session = MagicMock()
+    session.get.return_value = json_response({"free_seats": 1, "total_seats": 2})
+    adapter = TrainDataAdapter(session=session, timeout=(1, 2))
+
+    assert adapter.get_availability("express_2000")["free_seats"] == 1
+    session.get.assert_called_once_with(
+        "http://127.0.0.1:8081/availability/express_2000", timeout=(1, 2)
+    )
+
+
+def test_reserve_posts_form_data_through_session():
+    session = MagicMock()
+    session.post.return_value = json_response({"seats": {}})
+    adapter = TrainDataAdapter(session=session, timeout=(1, 2))
+
+    adapter.reserve("express_2000", ["1A", "2A"], "75bcd15")
+
+    session.post.assert_called_once_with(
+        "http://127.0.0.1:8081/reserve",
+        data={
+            "train_id": "express_2000",
+            "seats": '["1A", "2A"]',
+            "booking_reference": "75bcd15",
+        },
+        timeout=(1, 2),
+    )
+
+
+def test_reserve_batch_reports_whether_the_batch_was_accepted():
+    session = MagicMock()
+    session.post.return_value = json_response({"seats": {}})
+    adapter = TrainDataAdapter(session=session, timeout=(1, 2))
+
+    assert adapter.reserve_batch("express_2000", {"75bcd15": ["1A"]})
+    session.post.assert_called_once_with(
+        "http://127.0.0.1:8081/reserve_batch",
+        data={"train_id": "express_2000", "reservations": '{"75bcd15": ["1A"]}'},
+        timeout=(1, 2),
+    )
+
+    session.post.return_value = MagicMock(content=b"not json")
+    assert not adapter.reserve_batch("express_2000", {"75bcd15": ["1A"]})
+
+
+def train_document(booking_reference=""):
+    return {
+        "seats": {
+            "1A": {
+                "coach": "A",
+                "seat_number": "1",
+                "booking_reference": booking_reference,
+            }
+        }
+    }
+
+
+def test_seat_map_shares_layout_between_trains_of_the_same_rolling_stock():
+    first = SeatMap.from_train_data(train_document()["seats"])
+    second = SeatMap.from_train_data(train_document("75bcd15")["seats"])
+
+    assert first.layout is second.layout
+    assert first.empty_seat_count() == 1
+    assert second.empty_seat_count() == 0
+
+
+def test_seat_map_is_a_view_of_seats():
+    seats = [
+        Seat(seat_name="1A", seat_number="1", coach="A", booking_reference="ref1"),
+        Seat(seat_name="1B", seat_number="1", coach="B", booking_reference=""),
+        Seat(seat_name="2A", seat_number="2", coach="A", booking_reference=""),
+    ]
+
+    seat_map = SeatMap.from_seats(seats)
+
+    assert len(seat_map) == 3
+    assert list(seat_map) == seats
+    assert seat_map[-1] == seats[-1]
+    assert seat_map[1:] == seats[1:]
+    assert list(seat_map.layout.coach_ids) == [0, 1, 0]
+
+
+def test_seat_map_with_booked_seats_is_a_copy():
+    seat_map = SeatMap.from_train_data(train_document()["seats"])
+
+    booked = seat_map.with_booked(["1A"], "75bcd15")
+
+    assert booked[0].booking_reference == "75bcd15"
+    assert seat_map[0].booking_reference == ""
+    assert booked == SeatMap.from_train_data(train_document("75bcd15")["seats"])
+
+
+def test_seat_map_applies_changes_from_the_change_feed():
+    seats = SeatMap.from_train_data(train_document("75bcd15")["seats"], version=1)
+
+    changed = seats.with_changes(
+        [{"version": 2, "reset": True}, {"version": 3, "seats": {"1A": "75bcd16"}}]
+    )
+
+    assert changed.version == 3
+    assert [seat.booking_reference for seat in changed] == ["75bcd16"]
+    assert (
+        seats.with_changes([{"version": 4, "seats": {"1A": ""}}]).empty_seat_count()
+        == 1
+    )
+
+
+def test_cache_evicts_least_recently_used_train():
+    cache = TrainSnapshotCache(max_size=2)
+    cache.put("train_1", [])
+    cache.put("train_2", [])
+    cache.get("train_1")
+    cache.put("train_3", [])
+
+    assert cache.get("train_2") is None
+    assert cache.get("train_1") == []
+    assert cache.get("train_3") == []
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cache_entries_expire_after_ttl():
+    now = [0.0]
+    cache = TrainSnapshotCache(ttl=5, clock=lambda: now[0])
+    cache.put("train_1", [])
+
+    now[0] = 4.9
+    assert cache.get("train_1") == []
+    now[0] = 5.0
+    assert cache.get("train_1") is None
+    assert len(cache) == 0
+
+
+def test_cache_hits_and_misses_are_counted_in_metrics():
+    cache = TrainSnapshotCache(name="test_cache")
+    hits, misses = cache.hit_counter.value, cache.miss_counter.value
+    cache.put("train_1", [])
+
+    cache.get("train_1")
+    cache.get("train_2")
+    cache.peek("train_1")
+
+    assert cache.hit_counter.value == hits + 1
+    assert cache.miss_counter.value == misses + 1
+    assert "ticket_office_test_cache_hits_total" in METRICS.render()
+
+
+def test_cached_train_data_is_only_downloaded_once():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+
+    first = adapter.get_train_data("express_2000")
+    second = adapter.get_train_data("express_2000")
+
+    assert first == second
+    assert session.get.call_count == 1
+    assert (adapter.cache.hits, adapter.cache.misses) == (1, 1)
+
+
+def test_cache_is_updated_from_reserve_response():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = json_response(train_document("75bcd15"))
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    adapter.reserve("express_2000", ["1A"], "75bcd15")
+
+    (seat,) = adapter.get_train_data("express_2000")
+    assert seat.booking_reference == "75bcd15"
+    assert session.get.call_count == 1
+
+
+def test_cache_entry_is_dropped_when_reserve_is_rejected():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = MagicMock(content=b"already booked")
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    assert not adapter.reserve_batch("express_2000", {"75bcd15": ["1A"]})
+
+    adapter.get_train_data("express_2000")
+    assert session.get.call_count == 2
+
+
+def test_reserve_answered_with_an_error_status_is_not_a_rejection():
+    unavailable = requests.Response()
+    unavailable.status_code = 503
+    unavailable._content = b"<html>Service Unavailable</html>"
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = unavailable
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    with pytest.raises(requests.HTTPError):
+        adapter.reserve("express_2000", ["1A"], "75bcd15")
+    with pytest.raises(requests.HTTPError):
+        adapter.reserve_batch("express_2000", {"75bcd15": ["1A"]})
+    assert len(adapter.cache) == 0
+
+
+def test_rejected_reserve_raises_and_drops_the_cache_entry():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = MagicMock(content=b"already booked with reference: x")
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    with pytest.raises(ReservationRejected, match="already booked"):
+        adapter.reserve("express_2000", ["1A"], "75bcd15")
+
+    adapter.get_train_data("express_2000")
+    assert session.get.call_count == 2
+
+
+def test_allocate_posts_the_seat_count_and_drops_the_cached_train():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = json_response({"version": 1, "seats": ["1A"]})
+    adapter = TrainDataAdapter(session=session, cache=TrainSnapshotCache())
+    adapter.get_train_data("express_2000")
+
+    allocation = adapter.allocate("express_2000", 1, "75bcd15")
+
+    assert allocation["seats"] == ["1A"]
+    session.post.assert_called_once_with(
+        "http://127.0.0.1:8081/allocate",
+        data={
+            "train_id": "express_2000",
+            "seat_count": "1",
+            "booking_reference": "75bcd15",
+        },
+        timeout=DEFAULT_TIMEOUT,
+    )
+    assert adapter.cache.get("express_2000") is None
+
+
+def test_reserve_sends_expected_version_when_given():
+    session = MagicMock()
+    session.get.return_value = json_response(dict(train_document(), version=3))
+    session.post.return_value = json_response(train_document())
+    adapter = TrainDataAdapter(session=session)
+
+    seats = adapter.get_train_data("express_2000")
+    adapter.reserve("express_2000", ["1A"], "75bcd15", expected_version=seats.version)
+
+    assert session.post.call_args.kwargs["data"]["expected_version"] == "3"
+
+
+def test_sharded_adapter_sends_each_train_to_its_shard():
+    session = MagicMock()
+    session.get.return_value = json_response(train_document())
+    session.post.return_value = json_response(train_document())
+    urls = ["http://127.0.0.1:8091", "http://127.0.0.1:8092", "http://127.0.0.1:8093"]
+    adapter = ShardedTrainDataAdapter(
+        [TrainDataAdapter(session=session, url=url) for url in urls]
+    )
+
+    for train_id in ("express_2000", "local_1000", "night_train"):
+        shard_url = urls[shard_for(train_id, 3)]
+        adapter.get_train_data(train_id)
+        session.get.assert_called_with(
+            f"{shard_url}/data_for_train/{train_id}", timeout=DEFAULT_TIMEOUT
+        )
+        adapter.reserve(train_id, ["1A"], "75bcd15")
+        assert session.post.call_args.args == (f"{shard_url}/reserve",)
+        adapter.reset(train_id)
+        session.get.assert_called_with(
+            f"{shard_url}/reset/{train_id}", timeout=DEFAULT_TIMEOUT
+        )
+
+
+def test_get_booking_reference_uses_session_with_timeout():
+    session = MagicMock()
+    session.get.return_value.text = "75bcd15"
+    client = BookingReferenceClient(session=session, timeout=(1, 2))
+
+    assert client.get_booking_reference() == "75bcd15"
+    session.get.assert_called_once_with(
+        "http://127.0.0.1:8082/booking_reference", timeout=(1, 2)
+    )
+
+
+def test_get_booking_references_fetches_a_batch():
+    session = MagicMock()
+    session.get.return_value = json_response(["75bcd15", "75bcd16"])
+    client = BookingReferenceClient(session=session, timeout=(1, 2))
+
+    assert client.get_booking_references(2) == ["75bcd15", "75bcd16"]
+    session.get.assert_called_once_with(
+        "http://127.0.0.1:8082/booking_references",
+        params={"count": 2},
+        timeout=(1, 2),
+    )
+
+
+def test_booking_reference_errors_are_raised_without_using_up_references():
+    unavailable = requests.Response()
+    unavailable.status_code = 503
+    unavailable._content = b"<html>Service Unavailable</html>"
+    session = MagicMock()
+    session.get.return_value = unavailable
+    client = BookingReferenceClient(
+        session=session, resilience=Resilience("booking_test", retries=2)
+    )
+
+    with pytest.raises(requests.HTTPError):
+        client.get_booking_reference()
+    with pytest.raises(requests.HTTPError):
+        client.get_booking_references(2)
+    assert session.get.call_count == 2
+
+
+class ImmediateThread:
+    """Stands in for threading.Thread and runs the target when started."""
+
+    def __init__(self, target, daemon=None):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+@patch("train_services_adapters.Thread", ImmediateThread)
+def test_prefetching_client_refills_its_buffer_when_running_low():
+    session = MagicMock()
+    session.get.side_effect = [
+        json_response(["75bcd15", "75bcd16", "75bcd17"]),
+        json_response(["75bcd18", "75bcd19", "75bcd1a"]),
+    ]
+    client = PrefetchingBookingReferenceClient(
+        session=session, batch_size=3, low_watermark=1
+    )
+
+    assert client.get_booking_reference() == "75bcd15"
+    assert session.get.call_count == 1
+    assert client.get_booking_reference() == "75bcd16"
+    assert session.get.call_count == 2
+    assert client.get_booking_reference() == "75bcd17"
+    assert client.get_booking_reference() == "75bcd18"
+    assert session.get.call_count == 2
+
+
+@patch("train_services_adapters.Thread", ImmediateThread)
+def test_prefetching_client_fetches_synchronously_when_refill_failed():
+    session = MagicMock()
+    session.get.side_effect = [
+        json_response(["75bcd15"]),
+        MagicMock(content=b"not json"),
+        json_response(["75bcd16"]),
+        json_response(["75bcd17"]),
+    ]
+    client = PrefetchingBookingReferenceClient(
+        session=session, batch_size=1, low_watermark=0
+    )
+
+    assert client.get_booking_reference() == "75bcd15"
+    assert client.get_booking_reference() == "75bcd16"
+
+
+def test_prefetching_client_can_refill_again_after_an_unexpected_error():
+    session = MagicMock()
+    session.get.side_effect = RuntimeError("boom")
+    client = PrefetchingBookingReferenceClient(session=session)
+    client._refilling = True
+
+    with pytest.raises(RuntimeError):
+        client._refill()
+
+    assert not client._refilling
+
+
+def test_train_replica_follows_the_change_feed():
+    adapter = MagicMock()
+    adapter.download_train_data.return_value = SeatMap.from_train_data(
+        train_document()["seats"], version=0
+    )
+    adapter.get_changes.return_value = {
+        "version": 1,
+        "changes": [{"version": 1, "seats": {"1A": "75bcd15"}}],
+    }
+    replica = TrainReplica(adapter, "express_2000")
+
+    replica.poll()
+    (seat,) = replica.poll(wait=5)
+
+    assert seat.booking_reference == "75bcd15"
+    assert replica.seats.version == 1
+    adapter.get_changes.assert_called_once_with("express_2000", 0, 5)
+    adapter.download_train_data.assert_called_once_with("express_2000")
+
+
+def test_train_replica_reads_the_train_again_when_changes_are_lost():
+    adapter = MagicMock()
+    adapter.download_train_data.side_effect = [
+        SeatMap.from_train_data(train_document()["seats"], version=0),
+        SeatMap.from_train_data(train_document("75bcd15")["seats"], version=1500),
+    ]
+    adapter.get_changes.return_value = {"version": 1500, "changes": None}
+    replica = TrainReplica(adapter, "express_2000")
+
+    replica.poll()
+    replica.poll()
+
+    assert replica.seats.version == 1500
+    assert adapter.download_train_data.call_count == 2
@@ -1,11 +1,48 @@
-import json
-from typing import List, Optional, Union
-from dataclasses import dataclass, asdict
-from flask import Flask, request
-from train_services_adapters import Seat
+import os
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from dataclasses import asdict, dataclass, field, fields, replace
+from flask import Blueprint, Flask, Response, abort, current_app, request
+import json_codec
+from metrics import CONTENT_TYPE, METRICS
+import occupancy
+from occupancy import TrainOccupancy
+from resilience import Resilience
+from train_services_adapters import ReservationRejected, Seat, SeatMap
 from train_services_adapters import TrainDataAdapter, BookingReferenceClient
+from train_services_adapters import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT,
+    PrefetchingBookingReferenceClient,
+    ShardedTrainDataAdapter,
+    TrainSnapshotCache,
+    create_session,
+)
 
-app = Flask(__name__)
+reservations_blueprint = Blueprint("reservations", __name__)
+
+RESERVATION_SECONDS = METRICS.histogram(
+    "ticket_office_reservation_seconds", "Time spent in make_reservation"
+)
+CHECK_AVAILABILITY_SECONDS = METRICS.histogram(
+    "ticket_office_check_availability_seconds",
+    "Time spent checking the train availability",
+)
+GET_TRAIN_DATA_SECONDS = METRICS.histogram(
+    "ticket_office_get_train_data_seconds", "Time spent getting the train data"
+)
+ALLOCATE_SEATS_SECONDS = METRICS.histogram(
+    "ticket_office_allocate_seats_seconds", "Time spent choosing the coach and seats"
+)
+GET_BOOKING_REFERENCE_SECONDS = METRICS.histogram(
+    "ticket_office_get_booking_reference_seconds",
+    "Time spent getting a booking reference",
+)
+RESERVE_SECONDS = METRICS.histogram(
+    "ticket_office_reserve_seconds", "Time spent reserving the seats"
+)
+QUOTE_SECONDS = METRICS.histogram(
+    "ticket_office_quote_seconds", "Time spent computing quotes, cache misses only"
+)
 
 
 @dataclass
@@ -15,6 +52,61 @@ class Reservation:
     booking_reference: str
 
 
+@dataclass
+class Quote:
+    """What a train can take: `best_coaches[n - 1]` is the coach a group of
+    `n` passengers would be seated in, for every group size up to
+    `largest_group`."""
+
+    train_id: str
+    largest_group: int
+    best_coaches: List[str]
+
+
+@dataclass
+class CoachAvailability:
+    total_seats: int = 0
+    empty_seats: List[str] = field(default_factory=list)
+
+    @property
+    def occupation_percentage(self) -> float:
+        return 100 * (1 - len(self.empty_seats) / self.total_seats)
+
+
+def build_coach_index(
+    train_seats: Sequence[Seat],
+) -> Dict[str, CoachAvailability]:
+    """Group the train seats by coach in a single pass.
+
+    Coaches keep the order in which they first appear in the train data, and the
+    empty seats of each coach keep the train data order.
+    """
+    if isinstance(train_seats, SeatMap):
+        return _build_seat_map_coach_index(train_seats)
+    coach_index: Dict[str, CoachAvailability] = {}
+    for seat in train_seats:
+        coach = coach_index.get(seat.coach)
+        if coach is None:
+            coach = coach_index[seat.coach] = CoachAvailability()
+        coach.total_seats += 1
+        if not seat.booking_reference:
+            coach.empty_seats.append(seat.seat_name)
+    return coach_index
+
+
+def _build_seat_map_coach_index(seat_map: SeatMap) -> Dict[str, CoachAvailability]:
+    layout = seat_map.layout
+    coaches = [
+        CoachAvailability(total_seats=coach_size) for coach_size in layout.coach_sizes
+    ]
+    for seat_name, coach_id, booked in zip(
+        layout.seat_names, layout.coach_ids, seat_map.booked
+    ):
+        if not booked:
+            coaches[coach_id].empty_seats.append(seat_name)
+    return dict(zip(layout.coaches, coaches))
+
+
 class TicketOffice:
     MAXIMUM_OCCUPATION_PERCENTAGE = 70
 
@@ -22,70 +114,378 @@ class TicketOffice:
         self,
         train_service_adapter: TrainDataAdapter,
         booking_reference_adapter: BookingReferenceClient,
+        check_availability: bool = False,
+        allocate_on_train_data_service: bool = False,
+        vectorised_allocation: int = 0,
+        quote_cache: Optional[TrainSnapshotCache[Quote]] = None,
     ) -> None:
+        """With `check_availability`, the seat counters of the train are
+        checked before its seats are downloaded, so that trains too full for
+        the reservation are turned down early.
+
+        With `allocate_on_train_data_service`, the train data service picks and
+        books the seats itself, under the train's lock: the train is never
+        downloaded and no other booking can take the seats in between.
+
+        With `vectorised_allocation`, the seats of trains with at least that
+        many seats are picked with NumPy when it is installed, see
+        occupancy.py.
+
+        With a `quote_cache`, quotes are kept until a reservation made here
+        changes their train, or until they expire."""
         self.train_service_adapter = train_service_adapter
         self.booking_reference_adapter = booking_reference_adapter
+        self.check_availability = check_availability
+        self.allocate_on_train_data_service = allocate_on_train_data_service
+        self.vectorised_allocation = vectorised_allocation
+        self.quote_cache = quote_cache
+        # reservations made per train, to tell whether one was made while a
+        # quote was being computed
+        self._reservations_made: Dict[str, int] = {}
 
     def make_reservation(self, train_id: str, seat_count: int) -> Optional[Reservation]:
+        with RESERVATION_SECONDS.time():
+            return self._make_reservation(train_id, seat_count)
+
+    def _make_reservation(
+        self, train_id: str, seat_count: int
+    ) -> Optional[Reservation]:
         if seat_count == 0:
             return None
 
-        seats = self.train_service_adapter.get_train_data(train_id)
+        if self.check_availability:
+            with CHECK_AVAILABILITY_SECONDS.time():
+                availability = self.train_service_adapter.get_availability(train_id)
+            if not self.may_allocate_seats(availability, seat_count):
+                return None
+
+        if self.allocate_on_train_data_service:
+            return self._allocate_on_train_data_service(train_id, seat_count)
+
+        with GET_TRAIN_DATA_SECONDS.time():
+            seats = self.train_service_adapter.get_train_data(train_id)
         if not seats:
             return None
 
-        empty_seats = [seat for seat in seats if not seat.booking_reference]
+        with ALLOCATE_SEATS_SECONDS.time():
+            seats_to_reserve = self.choose_seats(seats, seat_count)
+        if not seats_to_reserve:
+            return None
+
+        with GET_BOOKING_REFERENCE_SECONDS.time():
+            booking_reference = self.booking_reference_adapter.get_booking_reference()
+        try:
+            self._reserve(train_id, seats_to_reserve, booking_reference)
+        except ReservationRejected:
+            # the seats were read from a stale copy of the train: read it
+            # again and try once more, with the same booking reference
+            with GET_TRAIN_DATA_SECONDS.time():
+                seats = self.train_service_adapter.download_train_data(train_id)
+            if not seats:
+                return None
+            with ALLOCATE_SEATS_SECONDS.time():
+                seats_to_reserve = self.choose_seats(seats, seat_count)
+            if not seats_to_reserve:
+                return None
+            try:
+                self._reserve(train_id, seats_to_reserve, booking_reference)
+            except ReservationRejected:
+                return None
+        return Reservation(
+            train_id, seats=seats_to_reserve, booking_reference=booking_reference
+        )
+
+    def _reserve(
+        self, train_id: str, seats_to_reserve: List[str], booking_reference: str
+    ) -> None:
+        with RESERVE_SECONDS.time():
+            self.train_service_adapter.reserve(
+                train_id=train_id,
+                seats=seats_to_reserve,
+                booking_reference=booking_reference,
+            )
+        self._train_changed(train_id)
+
+    def _allocate_on_train_data_service(
+        self, train_id: str, seat_count: int
+    ) -> Optional[Reservation]:
+        with GET_BOOKING_REFERENCE_SECONDS.time():
+            booking_reference = self.booking_reference_adapter.get_booking_reference()
+        with RESERVE_SECONDS.time():
+            allocation = self.train_service_adapter.allocate(
+                train_id, seat_count, booking_reference
+            )
+        if not allocation or not allocation["seats"]:
+            return None
+        self._train_changed(train_id)
+        return Reservation(
+            train_id, seats=allocation["seats"], booking_reference=booking_reference
+        )
+
+    def make_reservations(
+        self, reservation_requests: List[Tuple[str, int]]
+    ) -> List[Optional[Reservation]]:
+        """Make many reservations at once, given as (train_id, seat_count) pairs.
+
+        Each train is fetched once and all of its requests are allocated in memory,
+        in request order, before a single combined reserve call is made for it.
+        The results line up with the requests, None marking the ones that failed.
+
+        The combined call is all or nothing: when a single seat of the train
+        was booked since it was read, it is refused for every request on that
+        train. The train is then read again and its requests allocated once
+        more, with the booking references already taken; if that is refused
+        too, they all fail.
+        """
+        results: List[Optional[Reservation]] = [None] * len(reservation_requests)
+        requests_by_train: Dict[str, List[int]] = {}
+        for position, (train_id, _) in enumerate(reservation_requests):
+            requests_by_train.setdefault(train_id, []).append(position)
+
+        for train_id, positions in requests_by_train.items():
+            booking_references: Dict[int, str] = {}
+            seats = self.train_service_adapter.get_train_data(train_id)
+            reservations = self._allocate_batch(
+                train_id, seats, positions, reservation_requests, booking_references
+            )
+            if reservations and not self._reserve_batch(train_id, reservations):
+                seats = self.train_service_adapter.download_train_data(train_id)
+                reservations = self._allocate_batch(
+                    train_id, seats, positions, reservation_requests, booking_references
+                )
+                if reservations and not self._reserve_batch(train_id, reservations):
+                    reservations = {}
+            for position, reservation in reservations.items():
+                results[position] = reservation
+
+        return results
+
+    def _allocate_batch(
+        self,
+        train_id: str,
+        seats: Optional[Sequence[Seat]],
+        positions: List[int],
+        reservation_requests: List[Tuple[str, int]],
+        booking_references: Dict[int, str],
+    ) -> Dict[int, Reservation]:
+        """Allocate the requests at `positions` on the train, in order. The
+        booking reference taken for a request is kept in `booking_references`
+        and used again if it is allocated again."""
+        reservations: Dict[int, Reservation] = {}
+        if not seats:
+            return reservations
+        for position in positions:
+            seat_count = reservation_requests[position][1]
+            if seat_count == 0:
+                continue
+            seats_to_reserve = self.choose_seats(seats, seat_count)
+            if not seats_to_reserve:
+                continue
+            booking_reference = booking_references.get(position)
+            if booking_reference is None:
+                booking_reference = booking_references[position] = (
+                    self.booking_reference_adapter.get_booking_reference()
+                )
+            seats = self.book_seats(seats, seats_to_reserve, booking_reference)
+            reservations[position] = Reservation(
+                train_id,
+                seats=seats_to_reserve,
+                booking_reference=booking_reference,
+            )
+        return reservations
+
+    def _reserve_batch(
+        self, train_id: str, reservations: Dict[int, Reservation]
+    ) -> bool:
+        reserved = self.train_service_adapter.reserve_batch(
+            train_id,
+            {
+                reservation.booking_reference: reservation.seats
+                for reservation in reservations.values()
+            },
+        )
+        if reserved:
+            self._train_changed(train_id)
+        return reserved
+
+    def quote(self, train_id: str) -> Optional[Quote]:
+        """The largest group the train can take and the best coach for each
+        group size, or None for an unknown train. Cached quotes are answered
+        without calling the train data service."""
+        if self.quote_cache is not None:
+            quote = self.quote_cache.get(train_id)
+            if quote is not None:
+                return quote
+        reservations_made = self._reservations_made.get(train_id, 0)
+        with GET_TRAIN_DATA_SECONDS.time():
+            seats = self.train_service_adapter.get_train_data(train_id)
+        if not seats:
+            return None
+        with QUOTE_SECONDS.time():
+            best_coaches = self.best_coaches(seats)
+        quote = Quote(train_id, len(best_coaches), best_coaches)
+        # a quote computed from seats read before a reservation is not kept
         if (
-            self.compute_seats_occupation_persentage(seats, empty_seats, seat_count)
-            > self.MAXIMUM_OCCUPATION_PERCENTAGE
+            self.quote_cache is not None
+            and self._reservations_made.get(train_id, 0) == reservations_made
         ):
+            self.quote_cache.put(train_id, quote)
+        return quote
+
+    def _train_changed(self, train_id: str) -> None:
+        # concurrent reservations may count as one: the count still changes
+        self._reservations_made[train_id] = self._reservations_made.get(train_id, 0) + 1
+        if self.quote_cache is not None:
+            self.quote_cache.invalidate(train_id)
+
+    @staticmethod
+    def book_seats(
+        train_seats: Sequence[Seat], seat_names: List[str], booking_reference: str
+    ) -> Sequence[Seat]:
+        """Return a copy of the train seats with `seat_names` booked."""
+        if isinstance(train_seats, SeatMap):
+            return train_seats.with_booked(seat_names, booking_reference)
+        booked = set(seat_names)
+        return [
+            (
+                replace(seat, booking_reference=booking_reference)
+                if seat.seat_name in booked
+                else seat
+            )
+            for seat in train_seats
+        ]
+
+    def is_vectorised(self, train_seats: Sequence[Seat]) -> bool:
+        return bool(
+            self.vectorised_allocation
+            and occupancy.numpy is not None
+            and isinstance(train_seats, SeatMap)
+            and len(train_seats) >= self.vectorised_allocation
+        )
+
+    def choose_seats(
+        self, train_seats: Sequence[Seat], seat_count: int
+    ) -> Optional[List[str]]:
+        """`allocate_seats`, vectorised for large trains when enabled."""
+        if self.is_vectorised(train_seats):
+            return TrainOccupancy(
+                train_seats, self.MAXIMUM_OCCUPATION_PERCENTAGE
+            ).allocate_seats(seat_count)
+        return self.allocate_seats(train_seats, seat_count)
+
+    def best_coaches(self, train_seats: Sequence[Seat]) -> List[str]:
+        """The coach `allocate_seats` seats groups of 1, 2, ... passengers in,
+        up to the largest group the train can take."""
+        coach_index = build_coach_index(train_seats)
+        largest_coach = max(
+            (len(coach.empty_seats) for coach in coach_index.values()), default=0
+        )
+        if self.is_vectorised(train_seats):
+            coach_names = train_seats.layout.coaches
+            best_coaches = []
+            for coach in TrainOccupancy(
+                train_seats, self.MAXIMUM_OCCUPATION_PERCENTAGE
+            ).best_coaches(range(1, largest_coach + 1)):
+                if coach < 0:
+                    break
+                best_coaches.append(coach_names[coach])
+            return best_coaches
+
+        empty_seats_count = sum(
+            len(coach.empty_seats) for coach in coach_index.values()
+        )
+        best_coaches = []
+        # both rules only get harder to meet as the group grows
+        for seat_count in range(1, largest_coach + 1):
+            train_occupation = 100 * (
+                1 - (empty_seats_count - seat_count) / len(train_seats)
+            )
+            if train_occupation > self.MAXIMUM_OCCUPATION_PERCENTAGE:
+                break
+            best_coach = self.select_best_coach(seat_count, coach_index)
+            if best_coach is None:
+                break
+            best_coaches.append(best_coach)
+        return best_coaches
+
+    @classmethod
+    def allocate_seats(
+        cls, train_seats: Sequence[Seat], seat_count: int
+    ) -> Optional[List[str]]:
+        """Pick the names of the seats to reserve, or None when the business
+        rules do not allow booking `seat_count` seats on this train."""
+        coach_index = build_coach_index(train_seats)
+        empty_seats_count = sum(
+            len(coach.empty_seats) for coach in coach_index.values()
+        )
+        train_occupation = 100 * (
+            1 - (empty_seats_count - seat_count) / len(train_seats)
+        )
+        if train_occupation > cls.MAXIMUM_OCCUPATION_PERCENTAGE:
             return None
 
-        best_coach_empty_seats = self.get_best_coach_empty_seats(seat_count, seats)
+        best_coach_empty_seats = cls.select_best_coach_empty_seats(
+            seat_count, coach_index
+        )
 
         if not best_coach_empty_seats:
             return None
         # Since the coach might have more empty seats than we need, we select only the first `seat_count`
-        seats_to_reserve = best_coach_empty_seats[:seat_count]
-        booking_reference = self.booking_reference_adapter.get_booking_reference()
-        self.train_service_adapter.reserve(
-            train_id=train_id,
-            seats=seats_to_reserve,
-            booking_reference=booking_reference,
+        return best_coach_empty_seats[:seat_count]
+
+    @classmethod
+    def may_allocate_seats(cls, availability: Optional[dict], seat_count: int) -> bool:
+        """Apply the business rules of `allocate_seats` to the seat counters of
+        the train: when this is False, so is any seat allocation."""
+        if not availability or not availability["total_seats"]:
+            return False
+        train_occupation = 100 * (
+            1 - (availability["free_seats"] - seat_count) / availability["total_seats"]
         )
-        return Reservation(
-            train_id, seats=seats_to_reserve, booking_reference=booking_reference
+        if train_occupation > cls.MAXIMUM_OCCUPATION_PERCENTAGE:
+            return False
+        return any(
+            seat_count <= coach["free_seats"]
+            for coach in availability["coaches"].values()
         )
 
     def get_best_coach_empty_seats(
-        self, seat_count: int, train_seats: List[Seat]
+        self, seat_count: int, train_seats: Sequence[Seat]
     ) -> Optional[List[str]]:
+        return self.select_best_coach_empty_seats(
+            seat_count, build_coach_index(train_seats)
+        )
+
+    @classmethod
+    def select_best_coach_empty_seats(
+        cls, seat_count: int, coach_index: Dict[str, CoachAvailability]
+    ) -> Optional[List[str]]:
+        """Return the empty seats of the least occupied coach that can take
+        `seat_count` passengers, or None when no single coach can."""
+        best_coach = cls.select_best_coach(seat_count, coach_index)
+        if best_coach is None:
+            return None
+        return coach_index[best_coach].empty_seats
+
+    @staticmethod
+    def select_best_coach(
+        seat_count: int, coach_index: Dict[str, CoachAvailability]
+    ) -> Optional[str]:
+        """Return the least occupied coach that can take `seat_count`
+        passengers, or None when no single coach can."""
         best_seats_occupation = (
             100.0  # intitialise occupation to maximum == 100% occupation
         )
-        best_coach_empty_seats = None
-        coaches = list({seat.coach for seat in train_seats})
-
-        for coach in coaches:
-            coach_seats = [
-                seat.seat_name for seat in train_seats if seat.coach == coach
-            ]
-            empty_coach_seats = [
-                seat.seat_name
-                for seat in train_seats
-                if not seat.booking_reference and seat.coach == coach
-            ]
-
-            if seat_count <= len(empty_coach_seats):
-                new_seats_occupation = self.compute_seats_occupation_persentage(
-                    coach_seats, empty_coach_seats
-                )
+        best_coach = None
 
+        for coach_name, coach in coach_index.items():
+            if seat_count <= len(coach.empty_seats):
+                new_seats_occupation = coach.occupation_percentage
                 if best_seats_occupation > new_seats_occupation:
                     best_seats_occupation = new_seats_occupation
-                    best_coach_empty_seats = empty_coach_seats
+                    best_coach = coach_name
 
-        return best_coach_empty_seats
+        return best_coach
 
     @staticmethod
     def compute_seats_occupation_persentage(
@@ -96,15 +496,198 @@ class TicketOffice:
         return 100 * (1 - (len(empty_seats) - nb_seats_to_book) / len(all_seats))
 
 
-@app.route("/reserve", methods=["POST"])
+@dataclass
+class Settings:
+    """How the ticket office reaches the train data and booking reference
+    services. Caching, reference prefetching, availability checks, allocation
+    by the train data service, retries, the circuit breaker and hedged
+    requests are off when set to 0, see resilience.py for the last three. The
+    booking reference service uses `read_timeout` unless given its own.
+    `vectorised_allocation`, also off at 0, is the seat count from which
+    trains are allocated with NumPy. Quotes are cached per train, dropped
+    when the ticket office makes a reservation on the train or after
+    `quote_cache_ttl` seconds, for reservations made by others.
+
+    A sharded train data service is given as the comma separated urls of its
+    shards, in shard order."""
+
+    train_data_url: str = TrainDataAdapter.URL
+    booking_reference_url: str = BookingReferenceClient.URL
+    connect_timeout: float = DEFAULT_TIMEOUT[0]
+    read_timeout: float = DEFAULT_TIMEOUT[1]
+    booking_reference_read_timeout: float = 0.0
+    pool_size: int = DEFAULT_POOL_SIZE
+    train_cache_size: int = 0
+    train_cache_ttl: float = 5.0
+    booking_reference_prefetch: int = 0
+    check_availability: int = 0
+    allocate_on_train_data_service: int = 0
+    retries: int = 2
+    retry_backoff: float = 0.05
+    circuit_failure_threshold: int = 5
+    circuit_reset_timeout: float = 10.0
+    hedge_delay: float = 0.0
+    vectorised_allocation: int = 0
+    quote_cache_size: int = 1000
+    quote_cache_ttl: float = 5.0
+
+    def resilience(self, upstream: str) -> Resilience:
+        return Resilience(
+            upstream,
+            retries=self.retries,
+            backoff=self.retry_backoff,
+            failure_threshold=self.circuit_failure_threshold,
+            reset_timeout=self.circuit_reset_timeout,
+            hedge_delay=self.hedge_delay,
+            hedge_workers=self.pool_size,
+        )
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> "Settings":
+        """Read settings from TICKET_OFFICE_<FIELD NAME> environment variables,
+        e.g. TICKET_OFFICE_TRAIN_DATA_URL."""
+        values = {}
+        for setting in fields(cls):
+            value = environ.get(f"TICKET_OFFICE_{setting.name.upper()}")
+            if value is not None:
+                values[setting.name] = type(setting.default)(value)
+        return cls(**values)
+
+
+def create_ticket_office(settings: Settings) -> TicketOffice:
+    train_data_urls = settings.train_data_url.split(",")
+    session = create_session(
+        pool_connections=len(train_data_urls) + 1,
+        pool_maxsize=settings.pool_size,
+        pool_block=True,
+    )
+    timeout = (settings.connect_timeout, settings.read_timeout)
+    booking_reference_timeout = (
+        settings.connect_timeout,
+        settings.booking_reference_read_timeout or settings.read_timeout,
+    )
+    cache = None
+    if settings.train_cache_size:
+        cache = TrainSnapshotCache(
+            max_size=settings.train_cache_size,
+            ttl=settings.train_cache_ttl,
+            name="train_cache",
+        )
+    quote_cache = None
+    if settings.quote_cache_size:
+        quote_cache = TrainSnapshotCache(
+            max_size=settings.quote_cache_size,
+            ttl=settings.quote_cache_ttl,
+            name="quote_cache",
+        )
+    if settings.booking_reference_prefetch:
+        booking_reference_adapter = PrefetchingBookingReferenceClient(
+            session,
+            booking_reference_timeout,
+            settings.booking_reference_url,
+            batch_size=settings.booking_reference_prefetch,
+            low_watermark=settings.booking_reference_prefetch // 5,
+            resilience=settings.resilience("booking_reference"),
+        )
+    else:
+        booking_reference_adapter = BookingReferenceClient(
+            session,
+            booking_reference_timeout,
+            settings.booking_reference_url,
+            resilience=settings.resilience("booking_reference"),
+        )
+    # one circuit breaker per shard: a shard that is down does not stop the others
+    train_data_adapters = [
+        TrainDataAdapter(
+            session, timeout, cache, url, resilience=settings.resilience("train_data")
+        )
+        for url in train_data_urls
+    ]
+    if len(train_data_adapters) == 1:
+        train_data_adapter = train_data_adapters[0]
+    else:
+        train_data_adapter = ShardedTrainDataAdapter(train_data_adapters)
+    return TicketOffice(
+        train_data_adapter,
+        booking_reference_adapter,
+        check_availability=bool(settings.check_availability),
+        allocate_on_train_data_service=bool(settings.allocate_on_train_data_service),
+        vectorised_allocation=settings.vectorised_allocation,
+        quote_cache=quote_cache,
+    )
+
+
+def create_app(
+    settings: Optional[Settings] = None, ticket_office: Optional[TicketOffice] = None
+) -> Flask:
+    """Build the ticket office application.
+
+    The ticket office and its adapters are created here, once per application
+    (hence once per worker process), and shared by all the request threads.
+    """
+    app = Flask(__name__)
+    if ticket_office is None:
+        ticket_office = create_ticket_office(settings or Settings.from_env())
+    app.extensions["ticket_office"] = ticket_office
+    app.register_blueprint(reservations_blueprint)
+    return app
+
+
+def _ticket_office() -> TicketOffice:
+    return current_app.extensions["ticket_office"]
+
+
+@reservations_blueprint.route("/reserve", methods=["POST"])
 def reserve() -> Optional[str]:
     train_id = request.form["train_id"]
     seat_count = request.form["seat_count"]
-    ticket_office = TicketOffice(TrainDataAdapter(), BookingReferenceClient())
-    reservation = ticket_office.make_reservation(train_id, int(seat_count))
+    reservation = _ticket_office().make_reservation(train_id, int(seat_count))
     if not reservation:
         return None
-    return json.dumps(asdict(reservation))
+    return json_codec.dumps(reservation)
+
+
+@reservations_blueprint.route("/reserve_batch", methods=["POST"])
+def reserve_batch() -> str:
+    """Take a json list of {"train_id": ..., "seat_count": ...} objects and
+    return a list holding a reservation, or null, for each of them."""
+    reservation_requests = [
+        (reservation_request["train_id"], int(reservation_request["seat_count"]))
+        for reservation_request in request.get_json()
+    ]
+    reservations = _ticket_office().make_reservations(reservation_requests)
+    return json_codec.dumps(reservations)
+
+
+@reservations_blueprint.route("/quote/<train_id>")
+def quote(train_id: str) -> str:
+    """Return the quote of the train as json, or null for an unknown train.
+    With a seat_count query parameter, also say whether that many seats can
+    be booked, and in which coach: a seat_count that is not a whole number
+    is answered with a 400."""
+    seat_count = request.args.get("seat_count", type=int)
+    if seat_count is None and "seat_count" in request.args:
+        abort(400, "seat_count must be a whole number")
+    quote = _ticket_office().quote(train_id)
+    if quote is None or seat_count is None:
+        return json_codec.dumps(quote)
+    bookable = 0 < seat_count <= quote.largest_group
+    return json_codec.dumps(
+        dict(
+            asdict(quote),
+            seat_count=seat_count,
+            bookable=bookable,
+            coach=quote.best_coaches[seat_count - 1] if bookable else None,
+        )
+    )
+
+
+@reservations_blueprint.route("/metrics")
+def metrics() -> Response:
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,81 @@
+from array import array
+from collections import OrderedDict, deque
 from dataclasses import dataclass
-from typing import Optional, List
+from threading import Event, Lock, Thread
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Optional,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from weakref import WeakValueDictionary
+import sys
+import time
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import json_codec
+from metrics import METRICS
+from resilience import NO_RESILIENCE, Resilience
+
+# (connect, read) timeouts in seconds, as accepted by `requests`
+Timeout = Tuple[float, float]
+DEFAULT_TIMEOUT: Timeout = (3.05, 10.0)
+DEFAULT_POOL_SIZE = 10
+
+TRAIN_DATA_GET_SECONDS = METRICS.histogram(
+    "train_data_get_seconds", "Round trip of train data requests, parsing included"
+)
+TRAIN_DATA_AVAILABILITY_SECONDS = METRICS.histogram(
+    "train_data_availability_seconds", "Round trip of train availability requests"
+)
+TRAIN_DATA_RESERVE_SECONDS = METRICS.histogram(
+    "train_data_reserve_seconds", "Round trip of reserve requests to the train data"
+)
+BOOKING_REFERENCE_GET_SECONDS = METRICS.histogram(
+    "booking_reference_get_seconds", "Round trip of booking reference requests"
+)
+
+_shared_session: Optional[requests.Session] = None
+_shared_session_lock = Lock()
+
+
+def create_session(
+    pool_connections: int = DEFAULT_POOL_SIZE,
+    pool_maxsize: int = DEFAULT_POOL_SIZE,
+    pool_block: bool = False,
+) -> requests.Session:
+    """Build a session that keeps connections alive and pools them per host.
+
+    `pool_connections` is the number of hosts to keep pools for, `pool_maxsize`
+    the number of connections kept alive in each pool. With `pool_block` set,
+    callers wait for a free connection instead of opening extra ones.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_shared_session() -> requests.Session:
+    """Return the process wide session used by adapters built without one."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+        return _shared_session
 
 
 @dataclass
@@ -12,40 +86,654 @@ class Seat:
     booking_reference: str
 
 
+class SeatLayout:
+    """The seats of a rolling stock: names, numbers and coaches, in train order.
+
+    Layouts are interned, so every train built from the same rolling stock shares
+    one set of tables. Coaches are numbered in order of first appearance and each
+    seat refers to its coach by that number.
+    """
+
+    __slots__ = (
+        "seat_names",
+        "seat_numbers",
+        "coaches",
+        "coach_ids",
+        "coach_sizes",
+        "seat_positions",
+        "__weakref__",
+    )
+    _interned: "WeakValueDictionary[tuple, SeatLayout]" = WeakValueDictionary()
+    _interned_lock = Lock()
+
+    def __init__(
+        self,
+        seat_names: Tuple[str, ...],
+        seat_numbers: Tuple[str, ...],
+        seat_coaches: Tuple[str, ...],
+    ) -> None:
+        self.seat_names = seat_names
+        self.seat_numbers = seat_numbers
+        coach_positions: Dict[str, int] = {}
+        for coach in seat_coaches:
+            if coach not in coach_positions:
+                coach_positions[coach] = len(coach_positions)
+        self.coaches = tuple(sys.intern(coach) for coach in coach_positions)
+        self.coach_ids = array("H", [coach_positions[coach] for coach in seat_coaches])
+        self.coach_sizes = array("I", [0] * len(self.coaches))
+        for coach_id in self.coach_ids:
+            self.coach_sizes[coach_id] += 1
+        self.seat_positions = {name: index for index, name in enumerate(seat_names)}
+
+    @classmethod
+    def intern(
+        cls,
+        seat_names: Tuple[str, ...],
+        seat_numbers: Tuple[str, ...],
+        seat_coaches: Tuple[str, ...],
+    ) -> "SeatLayout":
+        key = (seat_names, seat_numbers, seat_coaches)
+        with cls._interned_lock:
+            layout = cls._interned.get(key)
+            if layout is None:
+                layout = cls._interned[key] = cls(*key)
+            return layout
+
+    def __len__(self) -> int:
+        return len(self.seat_names)
+
+
+class SeatMap(Sequence[Seat]):
+    """Compact, read-only seat map of one train.
+
+    Booking state is one byte per seat, booking references are only kept for
+    booked seats, and everything else lives in the shared `SeatLayout`. Indexing
+    or iterating builds `Seat` objects on demand for code expecting a seat list.
+    `version` is the train version reported by the train data service, if any.
+    """
+
+    __slots__ = ("layout", "booked", "booking_references", "version")
+
+    def __init__(
+        self,
+        layout: SeatLayout,
+        booked: bytearray,
+        booking_references: Dict[int, str],
+        version: Optional[int] = None,
+    ) -> None:
+        self.layout = layout
+        self.booked = booked
+        self.booking_references = booking_references
+        self.version = version
+
+    @classmethod
+    def from_train_data(
+        cls, seats_data: Dict[str, dict], version: Optional[int] = None
+    ) -> "SeatMap":
+        seat_numbers = []
+        seat_coaches = []
+        booked = bytearray(len(seats_data))
+        booking_references = {}
+        for index, seat_data in enumerate(seats_data.values()):
+            seat_numbers.append(seat_data.get("seat_number"))
+            seat_coaches.append(seat_data.get("coach"))
+            booking_reference = seat_data.get("booking_reference")
+            if booking_reference:
+                booked[index] = 1
+                booking_references[index] = booking_reference
+        layout = SeatLayout.intern(
+            tuple(seats_data), tuple(seat_numbers), tuple(seat_coaches)
+        )
+        return cls(layout, booked, booking_references, version)
+
+    @classmethod
+    def from_seats(cls, seats: Iterable[Seat]) -> "SeatMap":
+        return cls.from_train_data(
+            {
+                seat.seat_name: {
+                    "seat_number": seat.seat_number,
+                    "coach": seat.coach,
+                    "booking_reference": seat.booking_reference,
+                }
+                for seat in seats
+            }
+        )
+
+    def with_booked(
+        self, seat_names: Iterable[str], booking_reference: str
+    ) -> "SeatMap":
+        """Return a copy of this seat map with `seat_names` booked."""
+        booked = bytearray(self.booked)
+        booking_references = dict(self.booking_references)
+        for seat_name in seat_names:
+            index = self.layout.seat_positions[seat_name]
+            booked[index] = 1
+            booking_references[index] = booking_reference
+        return SeatMap(self.layout, booked, booking_references)
+
+    def with_changes(self, changes: Iterable[dict]) -> "SeatMap":
+        """Return a copy of this seat map with changes from the train data
+        service's change feed applied, oldest first, and their version."""
+        booked = bytearray(self.booked)
+        booking_references = dict(self.booking_references)
+        version = self.version
+        seat_positions = self.layout.seat_positions
+        for change in changes:
+            if change.get("reset"):
+                booked = bytearray(len(booked))
+                booking_references = {}
+            for seat_name, booking_reference in change.get("seats", {}).items():
+                index = seat_positions[seat_name]
+                booked[index] = 1 if booking_reference else 0
+                if booking_reference:
+                    booking_references[index] = booking_reference
+                else:
+                    booking_references.pop(index, None)
+            version = change["version"]
+        return SeatMap(self.layout, booked, booking_references, version)
+
+    def empty_seat_count(self) -> int:
+        return len(self.booked) - self.booked.count(1)
+
+    def __len__(self) -> int:
+        return len(self.booked)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        layout = self.layout
+        return Seat(
+            layout.seat_names[index],
+            layout.seat_numbers[index],
+            layout.coaches[layout.coach_ids[index]],
+            self.booking_references.get(index, ""),
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, SeatMap):
+            return NotImplemented
+        return (
+            self.layout is other.layout
+            and self.booked == other.booked
+            and self.booking_references == other.booking_references
+        )
+
+    def __repr__(self) -> str:
+        return f"SeatMap({list(self)!r})"
+
+
+def seats_from_train_data(train_data: Optional[dict]) -> Optional[SeatMap]:
+    """Convert a train document from the train data service into a seat map."""
+    if not train_data or "seats" not in train_data:
+        return None
+    return SeatMap.from_train_data(train_data["seats"], train_data.get("version"))
+
+
+class ReservationRejected(ValueError):
+    """The train data service refused a reservation, e.g. because one of its
+    seats was booked since the train was read."""
+
+
+# what a cache keeps per train: its seat map, or e.g. a quote computed from it
+Snapshot = TypeVar("Snapshot")
+
+
+class TrainSnapshotCache(Generic[Snapshot]):
+    """Parsed train seat maps, or other snapshots of a train's state, kept for
+    `ttl` seconds and bounded to `max_size` trains, the least recently used
+    train being evicted first. Hits and misses are also counted in metrics, as
+    `ticket_office_<name>_hits_total` and `ticket_office_<name>_misses_total`."""
+
+    def __init__(
+        self,
+        max_size: int = 128,
+        ttl: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+        name: str = "train_cache",
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = METRICS.counter(
+            f"ticket_office_{name}_hits_total", f"Lookups answered by the {name}"
+        )
+        self.miss_counter = METRICS.counter(
+            f"ticket_office_{name}_misses_total", f"Lookups the {name} missed"
+        )
+        self._entries: "OrderedDict[str, Tuple[float, Snapshot]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, train_id: str) -> Optional[Snapshot]:
+        snapshot = self.peek(train_id)
+        if snapshot is None:
+            self.misses += 1
+            self.miss_counter.inc()
+        else:
+            self.hits += 1
+            self.hit_counter.inc()
+        return snapshot
+
+    def peek(self, train_id: str) -> Optional[Snapshot]:
+        """Like `get`, but not counted as a hit or a miss: for keeping cached
+        snapshots up to date rather than reading trains."""
+        with self._lock:
+            entry = self._entries.get(train_id)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[train_id]
+                return None
+            self._entries.move_to_end(train_id)
+            return entry[1]
+
+    def put(self, train_id: str, snapshot: Snapshot) -> None:
+        with self._lock:
+            self._entries[train_id] = (self.clock() + self.ttl, snapshot)
+            self._entries.move_to_end(train_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, train_id: str) -> None:
+        with self._lock:
+            self._entries.pop(train_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
 class TrainDataAdapter:
     URL = "http://127.0.0.1:8081"
 
-    def get_train_data(self, train_id: str) -> Optional[List[Seat]]:
-        response = requests.get(self.URL + f"/data_for_train/{train_id}")
-        train_data = response.json()
-        if "seats" not in train_data:
-            return None
-        seats = []
-        for seat_name, seat_data in train_data["seats"].items():
-            seats.append(
-                Seat(
-                    seat_name,
-                    seat_data.get("seat_number"),
-                    seat_data.get("coach"),
-                    seat_data.get("booking_reference"),
-                )
-            )
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        cache: Optional[TrainSnapshotCache] = None,
+        url: Optional[str] = None,
+        resilience: Resilience = NO_RESILIENCE,
+    ) -> None:
+        self.url = url or self.URL
+        self.session = session or get_shared_session()
+        self.timeout = timeout
+        self.cache = cache
+        self.resilience = resilience
 
+    def get_train_data(self, train_id: str) -> Optional[SeatMap]:
+        if self.cache is not None:
+            seats = self.cache.get(train_id)
+            if seats is not None:
+                return seats
+        seats = self.download_train_data(train_id)
+        if self.cache is not None and seats is not None:
+            self.cache.put(train_id, seats)
         return seats
 
-    def reserve(self, train_id: str, seats: List[str], booking_reference: str) -> str:
+    def download_train_data(self, train_id: str) -> Optional[SeatMap]:
+        """Read the train from the train data service, bypassing the cache."""
+        with TRAIN_DATA_GET_SECONDS.time():
+            response = self.resilience.get(
+                self.session,
+                self.url + f"/data_for_train/{train_id}",
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return seats_from_train_data(json_codec.loads(response.content))
+
+    def get_changes(
+        self, train_id: str, since_version: int, wait: float = 0.0
+    ) -> Optional[dict]:
+        """The seat changes made to the train after `since_version`, as in
+        {"version": 5, "changes": [{"version": 4, "seats": {"1A": "75bcd15"}}]},
+        waiting up to `wait` seconds for one. "changes" is None when the
+        service no longer remembers them all."""
+        response = self.resilience.get(
+            self.session,
+            self.url + f"/changes/{train_id}",
+            hedge=False,
+            params={"since_version": since_version, "timeout": wait},
+            timeout=(self.timeout[0], self.timeout[1] + wait),
+        )
+        return json_codec.loads(response.content)
+
+    def get_availability(self, train_id: str) -> Optional[dict]:
+        """The free and total seat counts of the train and of each coach, as in
+        {"free_seats": 1, "total_seats": 2, "coaches": {"A": {...}}}, or None
+        for an unknown train."""
+        with TRAIN_DATA_AVAILABILITY_SECONDS.time():
+            response = self.resilience.get(
+                self.session,
+                self.url + f"/availability/{train_id}",
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return json_codec.loads(response.content)
+
+    def _refresh_cache(self, train_id: str, response: requests.Response) -> dict:
+        """Return the train document sent back by a reserve call, keeping the
+        cache in step with it. A rejected reservation is a plain text answer
+        (e.g. "already booked"), which means our snapshot was stale: it raises
+        ReservationRejected. An error status raises requests.HTTPError, as the
+        seats may or may not have been reserved."""
+        if self.cache is not None and not response.ok:
+            self.cache.invalidate(train_id)
+        response.raise_for_status()
+        try:
+            train_data = json_codec.loads(response.content)
+        except ValueError as error:
+            if self.cache is not None:
+                self.cache.invalidate(train_id)
+            raise ReservationRejected(
+                response.content.decode("utf-8", "replace")
+            ) from error
+        if self.cache is not None:
+            seats = seats_from_train_data(train_data)
+            if seats is None:
+                self.cache.invalidate(train_id)
+            else:
+                self.cache.put(train_id, seats)
+        return train_data
+
+    def reserve(
+        self,
+        train_id: str,
+        seats: List[str],
+        booking_reference: str,
+        expected_version: Optional[int] = None,
+    ) -> str:
         form_data = {
             "train_id": train_id,
             "seats": json.dumps(seats),
             "booking_reference": booking_reference,
         }
-        response = requests.post(self.URL + "/reserve", data=form_data)
-        return f"situation after reservation: {response.json()}"
+        if expected_version is not None:
+            form_data["expected_version"] = str(expected_version)
+        with TRAIN_DATA_RESERVE_SECONDS.time():
+            response = self.resilience.post(
+                self.session,
+                self.url + "/reserve",
+                data=form_data,
+                timeout=self.timeout,
+            )
+        return f"situation after reservation: {self._refresh_cache(train_id, response)}"
+
+    def reserve_batch(
+        self,
+        train_id: str,
+        reservations: Dict[str, List[str]],
+        expected_version: Optional[int] = None,
+    ) -> bool:
+        """Reserve the seats of several bookings, keyed by booking reference, in
+        one call. Either all of them are reserved or, when False is returned,
+        none of them are.
+
+        With `expected_version`, the train data service refuses the reservation
+        if the train changed since that version was read.
+        """
+        form_data = {
+            "train_id": train_id,
+            "reservations": json.dumps(reservations),
+        }
+        if expected_version is not None:
+            form_data["expected_version"] = str(expected_version)
+        with TRAIN_DATA_RESERVE_SECONDS.time():
+            response = self.resilience.post(
+                self.session,
+                self.url + "/reserve_batch",
+                data=form_data,
+                timeout=self.timeout,
+            )
+        try:
+            return "seats" in self._refresh_cache(train_id, response)
+        except ReservationRejected:
+            return False
+
+    def allocate(
+        self, train_id: str, seat_count: int, booking_reference: str
+    ) -> Optional[dict]:
+        """Let the train data service pick and book the seats, with the same
+        rules as TicketOffice.allocate_seats, in one round trip. Returns
+        {"version": 4, "seats": ["1A", "2A"]}, with no seats when the train
+        cannot take `seat_count` passengers, or None for an unknown train."""
+        form_data = {
+            "train_id": train_id,
+            "seat_count": str(seat_count),
+            "booking_reference": booking_reference,
+        }
+        with TRAIN_DATA_RESERVE_SECONDS.time():
+            response = self.resilience.post(
+                self.session,
+                self.url + "/allocate",
+                data=form_data,
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            allocation = json_codec.loads(response.content)
+        if self.cache is not None and allocation and allocation["seats"]:
+            self.cache.invalidate(train_id)
+        return allocation
+
+    def reset(self, train_id: str) -> None:
+        """Remove all the reservations on a train."""
+        self.resilience.get(
+            self.session,
+            self.url + f"/reset/{train_id}",
+            hedge=False,
+            timeout=self.timeout,
+        )
+        if self.cache is not None:
+            self.cache.invalidate(train_id)
+
+
+def shard_for(train_id: str, shard_count: int) -> int:
+    """The shard of the train data service that owns a train, computed the
+    same way as in the service's sharding.py."""
+    return zlib.crc32(train_id.encode("utf-8")) % shard_count
+
+
+class ShardedTrainDataAdapter:
+    """Sends each train's requests to the train data shard that owns it.
+
+    `shards` holds one adapter per shard, in shard order, i.e. for the ports
+    8091, 8092... of `start_service.py --shards=N`.
+    """
+
+    def __init__(self, shards: Sequence[TrainDataAdapter]) -> None:
+        self.shards = list(shards)
+
+    def shard(self, train_id: str) -> TrainDataAdapter:
+        return self.shards[shard_for(train_id, len(self.shards))]
+
+    def get_train_data(self, train_id: str) -> Optional[SeatMap]:
+        return self.shard(train_id).get_train_data(train_id)
+
+    def download_train_data(self, train_id: str) -> Optional[SeatMap]:
+        return self.shard(train_id).download_train_data(train_id)
+
+    def get_changes(
+        self, train_id: str, since_version: int, wait: float = 0.0
+    ) -> Optional[dict]:
+        return self.shard(train_id).get_changes(train_id, since_version, wait)
+
+    def get_availability(self, train_id: str) -> Optional[dict]:
+        return self.shard(train_id).get_availability(train_id)
+
+    def reserve(
+        self,
+        train_id: str,
+        seats: List[str],
+        booking_reference: str,
+        expected_version: Optional[int] = None,
+    ) -> str:
+        return self.shard(train_id).reserve(
+            train_id, seats, booking_reference, expected_version
+        )
+
+    def reserve_batch(
+        self,
+        train_id: str,
+        reservations: Dict[str, List[str]],
+        expected_version: Optional[int] = None,
+    ) -> bool:
+        return self.shard(train_id).reserve_batch(
+            train_id, reservations, expected_version
+        )
+
+    def allocate(
+        self, train_id: str, seat_count: int, booking_reference: str
+    ) -> Optional[dict]:
+        return self.shard(train_id).allocate(train_id, seat_count, booking_reference)
+
+    def reset(self, train_id: str) -> None:
+        self.shard(train_id).reset(train_id)
+
+
+class TrainReplica:
+    """A local copy of one train, kept current from the change feed of the
+    train data service instead of downloading the whole train again.
+
+    `seats` is replaced, never modified, when changes arrive, so readers
+    always get a consistent seat map. Call `poll` to catch up, or `start` a
+    thread that long-polls until `stop`, which may take up to `poll_timeout`.
+    """
+
+    def __init__(
+        self,
+        adapter: Union[TrainDataAdapter, ShardedTrainDataAdapter],
+        train_id: str,
+        poll_timeout: float = 20.0,
+    ) -> None:
+        self.adapter = adapter
+        self.train_id = train_id
+        self.poll_timeout = poll_timeout
+        self.seats: Optional[SeatMap] = None
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def poll(self, wait: float = 0.0) -> Optional[SeatMap]:
+        """Apply the changes made since the replica's version, waiting up to
+        `wait` seconds for one, and return the up to date seats."""
+        seats = self.seats
+        if seats is None:
+            self.seats = self.adapter.download_train_data(self.train_id)
+            return self.seats
+        feed = self.adapter.get_changes(self.train_id, seats.version, wait)
+        if feed is None:
+            self.seats = None
+        elif feed["changes"] is None:
+            self.seats = self.adapter.download_train_data(self.train_id)
+        elif feed["changes"]:
+            self.seats = seats.with_changes(feed["changes"])
+        return self.seats
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = Thread(target=self._follow, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _follow(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.poll(self.poll_timeout)
+            except (requests.RequestException, ValueError):
+                # the service is unreachable or restarting, try again later
+                self._stopped.wait(1.0)
 
 
 class BookingReferenceClient:
     URL = "http://127.0.0.1:8082"
 
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        url: Optional[str] = None,
+        resilience: Resilience = NO_RESILIENCE,
+    ) -> None:
+        self.url = url or self.URL
+        self.session = session or get_shared_session()
+        self.timeout = timeout
+        self.resilience = resilience
+
     def get_booking_reference(self) -> str:
-        response = requests.get(self.URL + "/booking_reference")
+        # each request sent uses up a reference: no retries or hedging
+        with BOOKING_REFERENCE_GET_SECONDS.time():
+            response = self.resilience.get(
+                self.session,
+                self.url + "/booking_reference",
+                idempotent=False,
+                timeout=self.timeout,
+            )
+        response.raise_for_status()
         return response.text
+
+    def get_booking_references(self, count: int) -> List[str]:
+        with BOOKING_REFERENCE_GET_SECONDS.time():
+            response = self.resilience.get(
+                self.session,
+                self.url + "/booking_references",
+                params={"count": count},
+                idempotent=False,
+                timeout=self.timeout,
+            )
+        response.raise_for_status()
+        return json_codec.loads(response.content)
+
+
+class PrefetchingBookingReferenceClient(BookingReferenceClient):
+    """Hand out booking references from a local buffer.
+
+    The buffer is filled `batch_size` references at a time. Once it runs down to
+    `low_watermark` references, a background thread fetches the next batch, so
+    callers only wait on the booking reference service when the buffer is empty.
+    """
+
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        url: Optional[str] = None,
+        batch_size: int = 100,
+        low_watermark: int = 20,
+        resilience: Resilience = NO_RESILIENCE,
+    ) -> None:
+        super().__init__(session, timeout, url, resilience)
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self._references: deque = deque()
+        self._lock = Lock()
+        self._refilling = False
+
+    def get_booking_reference(self) -> str:
+        with self._lock:
+            if not self._references:
+                self._references.extend(self.get_booking_references(self.batch_size))
+            reference = self._references.popleft()
+            start_refill = (
+                len(self._references) <= self.low_watermark and not self._refilling
+            )
+            if start_refill:
+                self._refilling = True
+        if start_refill:
+            Thread(target=self._refill, daemon=True).start()
+        return reference
+
+    def _refill(self) -> None:
+        references: List[str] = []
+        try:
+            references = self.get_booking_references(self.batch_size)
+        except (requests.RequestException, ValueError):
+            # the next caller finding the buffer empty will fetch synchronously
+            pass
+        finally:
+            # whatever went wrong, a later caller must be able to start a refill
+            with self._lock:
+                self._references.extend(references)
+                self._refilling = False
@@ -0,0 +1,76 @@
+"""
+Use this script to generate a large fleet of trains for the Train Data Service:
+
+    python generate_trains.py 50000 fleet.jsonl
+
+The fleet is written in json-lines format, one train per line, which the service
+loads lazily:
+
+    python start_service.py fleet.jsonl
+
+Each train is built from one of a few rolling stock types, from short regional
+units to long high speed trains, with a realistic spread of coach counts and
+seats per coach. A small share of the seats is already booked.
+"""
+import json
+import random
+import string
+
+# name, (min, max) coaches, (min, max) seats per coach
+ROLLING_STOCK = [
+    ("regional", (2, 4), (60, 80)),
+    ("intercity", (6, 12), (56, 72)),
+    ("express", (8, 16), (48, 64)),
+    ("highspeed", (16, 20), (40, 80)),
+]
+
+def coach_names(count):
+    """A, B, ... Z, AA, AB, ... like coach letters on a long train"""
+    names = []
+    for index in range(1, count + 1):
+        name = ""
+        while index:
+            index, remainder = divmod(index - 1, 26)
+            name = string.ascii_uppercase[remainder] + name
+        names.append(name)
+    return names
+
+def generate_train(rng, booked_share=0.1):
+    kind, coach_range, seat_range = rng.choice(ROLLING_STOCK)
+    seats_per_coach = rng.randint(*seat_range)
+    seats = {}
+    for coach in coach_names(rng.randint(*coach_range)):
+        for number in range(1, seats_per_coach + 1):
+            booked = rng.random() < booked_share
+            seats["{0}{1}".format(number, coach)] = {
+                "coach": coach,
+                "seat_number": str(number),
+                "booking_reference": "{0:x}".format(rng.getrandbits(28)) if booked else "",
+            }
+    return kind, seats
+
+def generate_fleet(train_count, output, seed=0, booked_share=0.1):
+    rng = random.Random(seed)
+    for index in range(train_count):
+        kind, seats = generate_train(rng, booked_share)
+        # the train id comes first, so the service can index the file without parsing the seats
+        output.write(json.dumps({"train_id": "{0}_{1}".format(kind, index), "seats": seats}))
+        output.write("\n")
+
+def main(args):
+    train_count = int(args[0])
+    output_file = args[1] if len(args) > 1 else "fleet.jsonl"
+    seed = int(args[2]) if len(args) > 2 else 0
+    with open(output_file, "w") as output:
+        generate_fleet(train_count, output, seed)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2 or "-help" in sys.argv or "--help" in sys.argv or "-h" in sys.argv:
+        print("""
+    Use this program to generate a fleet of trains:
+
+        python {0} <number of trains> [output file, defaults to fleet.jsonl] [random seed]
+        """.format(sys.argv[0]))
+    else:
+        main(sys.argv[1:])
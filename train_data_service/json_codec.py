@@ -0,0 +1,50 @@
+"""
+JSON encoding and decoding, with orjson when it is installed and the standard
+library's json module otherwise:
+
+    pip install orjson
+
+`loads` takes str or bytes, so a response body can be decoded without making it
+a str first. `dumps` returns a str and also accepts dataclasses. orjson writes
+compact json, without spaces after separators.
+
+JSON_CODEC=json makes the process use the standard library even when orjson is
+installed, for instance to compare the two.
+
+The ticket office and the train data service each ship a copy of this file, so
+that each runs on its own: keep them identical, ticket_office_service/
+test_metrics.py checks they are.
+"""
+
+import dataclasses
+import json
+import os
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None and os.environ.get("JSON_CODEC", "orjson") != "json":
+    BACKEND = "orjson"
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(value: Any) -> str:
+        return orjson.dumps(value).decode("utf-8")
+
+else:
+    BACKEND = "json"
+
+    def _default(value: Any) -> Any:
+        if dataclasses.is_dataclass(value) and not isinstance(value, type):
+            return dataclasses.asdict(value)
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(value: Any) -> str:
+        return json.dumps(value, default=_default)
@@ -0,0 +1,241 @@
+"""
+Storage backends that keep TrainDataService reservations across restarts.
+
+MemoryStore keeps nothing, which is how the service always behaved. ReservationLog
+appends every change to a log file and makes it durable before the reservation is
+confirmed:
+
+    service = TrainDataService.from_file("trains.json", store=ReservationLog("reservations"))
+
+Writes are group committed: a single writer thread takes all the changes queued
+since its last write, appends them and calls fsync once for the whole group, so
+the cost of fsync is shared by every reservation made in the meantime.
+Once a write fails, the log stops: the records waiting on it and every later one
+raise the error, and the service puts back the seats they changed.
+
+The log is compacted in the background once it holds `snapshot_every` records:
+it is moved aside, folded into snapshot.json and deleted. A log a failed
+compaction left aside is folded in before the next one is moved there. At startup, the
+snapshot, a log left half-compacted by a crash, and the current log are replayed
+in that order. Replaying a record twice is harmless, because each one records the
+final booking of its seats.
+"""
+import os
+import threading
+import time
+
+import json_codec
+
+
+class MemoryStore(object):
+    """Keeps reservations in memory only: they are lost on restart"""
+
+    def replay(self, service):
+        pass
+
+    def record(self, record):
+        return 0
+
+    def wait_until_durable(self, sequence):
+        pass
+
+    def close(self):
+        pass
+
+
+def apply_record(state, record):
+    """Fold one log record into a {train_id: {"version", "reset", "seats"}} state"""
+    train_id = record["train_id"]
+    if record.get("reset"):
+        state[train_id] = {"version": record["version"], "reset": True, "seats": {}}
+        return
+    train_state = state.setdefault(train_id, {"version": 0, "reset": False, "seats": {}})
+    train_state["version"] = record["version"]
+    train_state["seats"].update(record["seats"])
+
+
+def read_records(path, truncate_torn_tail=False):
+    """Records of a log file, up to a last line torn by a crash mid-write.
+
+    With truncate_torn_tail, the torn line is cut off the file so that new records
+    can be appended after the last complete one.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+" if truncate_torn_tail else "rb") as log:
+        complete_length = 0
+        for line in log:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete record")
+                record = json_codec.loads(line)
+            except ValueError:
+                if truncate_torn_tail:
+                    log.truncate(complete_length)
+                return
+            complete_length += len(line)
+            yield record
+
+
+def fsync_directory(directory):
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class ReservationLog(object):
+    LOG_FILE = "reservations.log"
+    COMPACTING_FILE = "reservations.log.compacting"
+    SNAPSHOT_FILE = "snapshot.json"
+
+    def __init__(self, directory, commit_delay=0.001, snapshot_every=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.log_path = os.path.join(directory, self.LOG_FILE)
+        self.compacting_path = os.path.join(directory, self.COMPACTING_FILE)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+        self.commit_delay = commit_delay
+        self.snapshot_every = snapshot_every
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.queued_sequence = 0
+        self.durable_sequence = 0
+        self.error = None
+        self.closed = False
+        self.log = None
+        self.records_in_log = 0
+        self.writer = None
+        self.compactor = None
+
+    def replay(self, service):
+        """Restore the service's reservations, then start accepting new records"""
+        state = self.read_snapshot()
+        for record in read_records(self.compacting_path):
+            apply_record(state, record)
+        for record in read_records(self.log_path, truncate_torn_tail=True):
+            apply_record(state, record)
+            self.records_in_log += 1
+        for train_id, train_state in state.items():
+            service.restore_train(train_id, train_state)
+
+        self.log = open(self.log_path, "a")
+        fsync_directory(self.directory)
+        if os.path.exists(self.compacting_path):
+            self.start_compaction()
+        self.writer = threading.Thread(target=self.write_loop, name="reservation-log-writer", daemon=True)
+        self.writer.start()
+
+    def read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return {}
+        with open(self.snapshot_path, "rb") as snapshot:
+            return json_codec.loads(snapshot.read())
+
+    def record(self, record):
+        """Queue a record and return the sequence number to wait on.
+
+        Raises the error that stopped the writer, if any: nothing can be made durable any more.
+        """
+        line = json_codec.dumps(record) + "\n"
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise RuntimeError("reservation log is closed")
+            self.pending.append(line)
+            self.queued_sequence += 1
+            self.condition.notify_all()
+            return self.queued_sequence
+
+    def wait_until_durable(self, sequence):
+        with self.condition:
+            while self.durable_sequence < sequence and self.error is None:
+                self.condition.wait()
+            if self.durable_sequence < sequence:
+                raise self.error
+
+    def fail(self, error):
+        """Stop writing: every record not yet durable, and every later one, raises error"""
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+            # give reservations arriving at the same time a chance to join this group
+            time.sleep(self.commit_delay)
+            with self.condition:
+                group = self.pending
+                self.pending = []
+                group_sequence = self.queued_sequence
+            try:
+                self.log.write("".join(group))
+                self.log.flush()
+                os.fsync(self.log.fileno())
+            except Exception as error:
+                self.fail(error)
+                return
+            with self.condition:
+                self.durable_sequence = group_sequence
+                self.condition.notify_all()
+            self.records_in_log += len(group)
+            if self.records_in_log >= self.snapshot_every:
+                try:
+                    self.rotate()
+                except Exception as error:
+                    self.fail(error)
+                    return
+
+    def rotate(self):
+        """Move the full log aside for compaction and continue in an empty one"""
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        if os.path.exists(self.compacting_path):
+            # a failed compaction left its log behind: fold it into the snapshot before it is replaced,
+            # or keep appending to the current log if that fails again
+            try:
+                self.compact()
+            except (OSError, ValueError):
+                return
+        self.log.close()
+        os.rename(self.log_path, self.compacting_path)
+        self.log = open(self.log_path, "a")
+        fsync_directory(self.directory)
+        self.records_in_log = 0
+        self.start_compaction()
+
+    def start_compaction(self):
+        self.compactor = threading.Thread(target=self.compact, name="reservation-log-compactor", daemon=True)
+        self.compactor.start()
+
+    def compact(self):
+        state = self.read_snapshot()
+        for record in read_records(self.compacting_path):
+            apply_record(state, record)
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w") as snapshot:
+            snapshot.write(json_codec.dumps(state))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        os.remove(self.compacting_path)
+        fsync_directory(self.directory)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,58 @@
+"""
+Run the Train Data Service as several processes, each one owning a share of the trains, so that
+reservations on different trains are served by different cores.
+
+A train belongs to shard number crc32(train_id) % shard_count. Shard i listens on FIRST_SHARD_PORT + i
+and only loads its own trains, so clients have to send each request to the shard of its train, see
+ShardedTrainDataAdapter in the ticket office, which uses the same rule:
+
+    python start_service.py --shards=4 trains.json
+
+Each shard logs its reservations in its own sub directory of the reservations directory. Keep the same
+number of shards for a given directory: a shard ignores the reservations logged for trains it does not own.
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import zlib
+
+FIRST_SHARD_PORT = 8091
+
+def shard_for(train_id, shard_count):
+    """The shard that owns a train. The ticket office routes its requests with the same function."""
+    return zlib.crc32(train_id.encode("utf-8")) % shard_count
+
+def serve_shard(trains_data_file, shard_index, shard_count, port, store_directory=None, using_flask=False):
+    from train_data_service import TrainDataService
+    from reservation_store import ReservationLog
+    store = None
+    if store_directory:
+        store = ReservationLog(os.path.join(store_directory, "shard_{0}".format(shard_index)))
+    train_data_service = TrainDataService.from_file(trains_data_file, store, shard=(shard_index, shard_count))
+
+    if using_flask:
+        from train_data_service_flask import start
+    else:
+        from train_data_service_cherrypy import start
+    start(train_data_service, port)
+
+def start_shards(trains_data_file, shard_count, first_port=FIRST_SHARD_PORT, store_directory=None, using_flask=False):
+    """Start one process per shard, on consecutive ports, and wait for them"""
+    processes = [
+        multiprocessing.Process(
+            target=serve_shard,
+            args=(trains_data_file, shard_index, shard_count, first_port + shard_index, store_directory, using_flask),
+            name="train-data-shard-{0}".format(shard_index))
+        for shard_index in range(shard_count)]
+    for process in processes:
+        process.start()
+    # stopping the service stops its shards too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
@@ -4,18 +4,27 @@ Use this script to start the Train Data Service on port 8081
 using_flask = False
 
 def main(args):
+    from train_data_service import TrainDataService
+    from reservation_store import ReservationLog
+    shard_options = [arg for arg in args if arg.startswith("--shards=")]
+    args = [arg for arg in args if arg not in shard_options]
     if args:
         trains_data_file = args[0]
     else:
         trains_data_file = "trains.json"
-    with open(trains_data_file) as f:
-        trains_data = f.read()
+    if shard_options:
+        from sharding import start_shards
+        store_directory = args[1] if len(args) > 1 else None
+        start_shards(trains_data_file, int(shard_options[-1].split("=", 1)[1]), store_directory=store_directory, using_flask=using_flask)
+        return
+    store = ReservationLog(args[1]) if len(args) > 1 else None
+    train_data_service = TrainDataService.from_file(trains_data_file, store)
     
     if using_flask:
         from train_data_service_flask import start
     else:
         from train_data_service_cherrypy import start
-    start(trains_data)
+    start(train_data_service)
         
 
 if __name__ == '__main__':
@@ -33,6 +42,21 @@ if __name__ == '__main__':
     It defaults to looking for "trains.json" in the current working directory.
 
         python {0} trains.json
+
+    Large fleets written by generate_trains.py (".jsonl" files) are loaded lazily, 
+    each train being parsed the first time it is requested.
+
+        python {0} fleet.jsonl
+
+    Reservations are kept in memory only, unless you also pass a directory in which 
+    to log them. They are then replayed from that directory when the service restarts.
+
+        python {0} trains.json reservations
+
+    To use more than one core, start several shards, each one serving its own share 
+    of the trains on consecutive ports from 8091 (see sharding.py):
+
+        python {0} --shards=4 trains.json reservations
         """.format(sys.argv[0])
         if "-help" in sys.argv or "--help" in sys.argv or "-h" in sys.argv:
             print(help_text)
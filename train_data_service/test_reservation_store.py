@@ -0,0 +1,141 @@
+""" Use py.test to run this test """
+
+import errno
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from reservation_store import ReservationLog
+from train_data_service import TrainDataService
+
+TRAINS = """{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": "existing"} }}}"""
+
+def restart(directory, **options):
+    return TrainDataService(TRAINS, store=ReservationLog(str(directory), **options))
+
+def test_reservations_survive_a_restart(tmp_path):
+    service = restart(tmp_path)
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.store.close()
+
+    train_data = json.loads(restart(tmp_path).data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == "01234567"
+    assert train_data["version"] == 1
+
+def test_reset_survives_a_restart(tmp_path):
+    service = restart(tmp_path)
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.reset("foo_train")
+    service.store.close()
+
+    train_data = json.loads(restart(tmp_path).data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == ""
+    assert train_data["seats"]["2A"]["booking_reference"] == ""
+    assert train_data["version"] == 2
+
+def test_concurrent_reservations_are_group_committed(tmp_path, monkeypatch):
+    trains = {"train_{0}".format(n): {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}}} for n in range(20)}
+    service = TrainDataService(json.dumps(trains), store=ReservationLog(str(tmp_path), commit_delay=0.05))
+    fsyncs = []
+    real_fsync = os.fsync
+    def counting_fsync(descriptor):
+        fsyncs.append(descriptor)
+        real_fsync(descriptor)
+    monkeypatch.setattr(os, "fsync", counting_fsync)
+    threads = [threading.Thread(target=service.reserve, args=(train_id, json.dumps(["1A"]), "ref")) for train_id in trains]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    service.store.close()
+    assert len(fsyncs) < len(trains)
+
+    restarted = TrainDataService(json.dumps(trains), store=ReservationLog(str(tmp_path)))
+    for train_id in trains:
+        assert '"booking_reference": "ref"' in restarted.data_for_train(train_id)
+
+def test_log_is_compacted_into_a_snapshot(tmp_path):
+    service = restart(tmp_path, commit_delay=0, snapshot_every=2)
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.reset("foo_train")
+    service.reserve("foo_train", json.dumps(["2A"]), "89abcdef")
+    service.store.close()
+
+    assert os.path.exists(os.path.join(str(tmp_path), ReservationLog.SNAPSHOT_FILE))
+    assert not os.path.exists(os.path.join(str(tmp_path), ReservationLog.COMPACTING_FILE))
+    train_data = json.loads(restart(tmp_path).data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == ""
+    assert train_data["seats"]["2A"]["booking_reference"] == "89abcdef"
+    assert train_data["version"] == 3
+
+def test_torn_last_record_is_ignored(tmp_path):
+    service = restart(tmp_path)
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.store.close()
+    with open(os.path.join(str(tmp_path), ReservationLog.LOG_FILE), "a") as log:
+        log.write('{"train_id": "foo_train", "vers')
+
+    service = restart(tmp_path)
+    assert json.loads(service.data_for_train("foo_train"))["seats"]["1A"]["booking_reference"] == "01234567"
+    service.reset("foo_train")
+    service.store.close()
+
+    train_data = json.loads(restart(tmp_path).data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == ""
+    assert train_data["version"] == 2
+
+def test_log_left_by_a_failed_compaction_is_not_overwritten(tmp_path, monkeypatch):
+    trains = TRAINS.replace('"existing"', '""')
+    real_compact = ReservationLog.compact
+    calls = []
+    def failing_once(store):
+        calls.append(store)
+        if len(calls) > 1:
+            real_compact(store)
+    monkeypatch.setattr(ReservationLog, "compact", failing_once)
+    service = TrainDataService(trains, store=ReservationLog(str(tmp_path), commit_delay=0, snapshot_every=1))
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    # the log is rotated once its records are durable, after the reservation returned
+    while service.store.compactor is None:
+        time.sleep(0.001)
+    service.store.compactor.join()
+    assert os.path.exists(os.path.join(str(tmp_path), ReservationLog.COMPACTING_FILE))
+    service.reserve("foo_train", json.dumps(["2A"]), "89abcdef")
+    service.store.close()
+
+    restarted = TrainDataService(trains, store=ReservationLog(str(tmp_path)))
+    train_data = json.loads(restarted.data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == "01234567"
+    assert train_data["seats"]["2A"]["booking_reference"] == "89abcdef"
+    assert train_data["version"] == 2
+
+def test_reservation_that_cannot_be_made_durable_is_undone(tmp_path, monkeypatch):
+    service = restart(tmp_path)
+    def full_disk(descriptor):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(os, "fsync", full_disk)
+
+    with pytest.raises(OSError):
+        service.reserve("foo_train", json.dumps(["1A"]), "ref1")
+    assert json.loads(service.data_for_train("foo_train"))["seats"]["1A"]["booking_reference"] == ""
+    with pytest.raises(OSError):
+        service.reserve("foo_train", json.dumps(["1A"]), "ref2")
+    with pytest.raises(OSError):
+        service.reset("foo_train")
+    train_data = json.loads(service.data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == ""
+    assert train_data["seats"]["2A"]["booking_reference"] == "existing"
+    assert json.loads(service.availability("foo_train"))["free_seats"] == 1
+
+def test_unexpected_writer_error_fails_the_waiting_reservation(tmp_path, monkeypatch):
+    def corrupt_snapshot(store):
+        raise ValueError("corrupt snapshot")
+    monkeypatch.setattr(ReservationLog, "rotate", corrupt_snapshot)
+    service = restart(tmp_path, commit_delay=0, snapshot_every=1)
+
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    with pytest.raises(ValueError):
+        service.reserve("foo_train", json.dumps(["1A"]), "01234567")
@@ -0,0 +1,32 @@
+""" Use py.test to run this test """
+
+import json
+
+from generate_trains import generate_fleet
+from sharding import shard_for
+from train_data_service import TrainDataService
+
+def test_shards_split_a_fleet_between_them(tmp_path):
+    fleet_file = tmp_path / "fleet.jsonl"
+    with open(str(fleet_file), "w") as output:
+        generate_fleet(50, output, seed=1)
+    shards = [TrainDataService.from_file(str(fleet_file), shard=(shard_index, 3)) for shard_index in range(3)]
+
+    all_train_ids = set(TrainDataService.from_file(str(fleet_file)).trains)
+    assert sum(len(shard.trains) for shard in shards) == len(all_train_ids)
+    for shard_index, shard in enumerate(shards):
+        assert 0 < len(shard.trains) < len(all_train_ids)
+        assert all(shard_for(train_id, 3) == shard_index for train_id in shard.trains)
+
+def test_shard_only_serves_its_own_trains(tmp_path):
+    trains_file = tmp_path / "trains.json"
+    trains = {"train_{0}".format(n): {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}}} for n in range(10)}
+    trains_file.write_text(json.dumps(trains))
+    shard = TrainDataService.from_file(str(trains_file), shard=(1, 2))
+
+    for train_id in trains:
+        if shard_for(train_id, 2) == 1:
+            shard.reserve(train_id, json.dumps(["1A"]), "01234567")
+            assert '"booking_reference": "01234567"' in shard.data_for_train(train_id)
+        else:
+            assert shard.data_for_train(train_id) == "null"
@@ -1,8 +1,13 @@
 """ Use py.test to run this test """
 
 import json
+import threading
 
-from train_data_service import TrainDataService
+import pytest
+
+from generate_trains import generate_fleet
+from metrics import METRICS
+from train_data_service import ReservationRefused, TrainDataService
 
 def test_fetch_train_data():
     service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
@@ -27,7 +32,200 @@ def test_reserve_with_typo_in_seatid():
     response = service.reserve("foo_train", json.dumps(["typo"]), "01234567")
     assert "seat not found typo" in response
 
+def test_reserve_batch():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": ""} }}}""")
+    service.reserve_batch("foo_train", json.dumps({"ref1": ["1A"], "ref2": ["2A"]}))
+    train_data = json.loads(service.data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == "ref1"
+    assert train_data["seats"]["2A"]["booking_reference"] == "ref2"
+
+def test_reserve_batch_is_all_or_nothing():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": "existing"} }}}""")
+    response = service.reserve_batch("foo_train", json.dumps({"ref1": ["1A"], "ref2": ["2A"]}))
+    assert "already booked with reference: existing" in response
+    train_data = json.loads(service.data_for_train("foo_train"))
+    assert train_data["seats"]["1A"]["booking_reference"] == ""
+
+def test_version_goes_up_on_each_change():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
+    assert json.loads(service.data_for_train("foo_train"))["version"] == 0
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    assert json.loads(service.data_for_train("foo_train"))["version"] == 1
+    service.reset("foo_train")
+    assert json.loads(service.data_for_train("foo_train"))["version"] == 2
+
+def test_reserve_with_stale_expected_version():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": ""} }}}""")
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567", expected_version="0")
+    response = service.reserve("foo_train", json.dumps(["2A"]), "89abcdef", expected_version="0")
+    assert "stale train version: expected 0, current 1" in response
+    assert '"booking_reference": "89abcdef"' not in service.data_for_train("foo_train")
+
+def test_concurrent_reservations_of_the_same_seat_only_book_it_once():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
+    responses = []
+    def reserve(booking_reference):
+        responses.append(service.reserve("foo_train", json.dumps(["1A"]), booking_reference))
+    threads = [threading.Thread(target=reserve, args=("ref{0}".format(n),)) for n in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([response for response in responses if "already booked" not in response]) == 1
+    assert json.loads(service.data_for_train("foo_train"))["version"] == 1
+
+def test_serialized_train_is_reused_until_the_train_changes():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
+    first = service.data_for_train("foo_train")
+    assert service.data_for_train("foo_train") is first
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    assert '"booking_reference": "01234567"' in service.data_for_train("foo_train")
+
+def test_compact_reserve_response():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": ""} }}}""")
+    response = service.reserve("foo_train", json.dumps(["2A"]), "01234567", compact="1")
+    assert json.loads(response) == {"version": 1, "seats": {"2A": "01234567"}}
+
 def test_reset():
     service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": "existing"} }}}""")
     train_data = service.reset("foo_train")
     assert 'existing' not in train_data
+
+def test_requests_are_timed():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.data_for_train("foo_train")
+    rendered = METRICS.render()
+    assert "train_data_service_reserve_seconds_count" in rendered
+    assert "train_data_service_data_for_train_seconds_count" in rendered
+
+def test_generated_fleet_is_loaded_lazily(tmp_path):
+    fleet_file = tmp_path / "fleet.jsonl"
+    with open(str(fleet_file), "w") as output:
+        generate_fleet(50, output, seed=1)
+    service = TrainDataService.from_file(str(fleet_file))
+    assert len(service.trains) == 50
+    assert service.trains.loaded == {}
+
+    train_id = sorted(service.trains)[7]
+    train_data = json.loads(service.data_for_train(train_id))
+    assert list(service.trains.loaded) == [train_id]
+    assert len(train_data["seats"]) >= 2 * 40
+    assert "train_id" not in train_data
+
+def test_reserve_on_lazily_loaded_train(tmp_path):
+    fleet_file = tmp_path / "fleet.jsonl"
+    fleet_file.write_text('{"train_id": "foo_train", "seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}}}\n'
+                          '{"seats": {}, "train_id": "bar_train"}\n')
+    service = TrainDataService.from_file(str(fleet_file))
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    assert '"booking_reference": "01234567"' in service.data_for_train("foo_train")
+    assert "bar_train" in service.trains
+    assert service.data_for_train("unknown_train") == "null"
+
+def test_availability_counts_free_seats_per_coach():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": "existing"}, "1B": {"coach": "B", "seat_number": "1", "booking_reference": ""} }}}""")
+    availability = json.loads(service.availability("foo_train"))
+    assert availability == {"free_seats": 2, "total_seats": 3, "version": 0, "coaches": {
+        "A": {"free_seats": 1, "total_seats": 2}, "B": {"free_seats": 1, "total_seats": 1}}}
+    assert service.availability("unknown_train") == "null"
+
+def test_availability_follows_reservations_and_reset():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""}, "2A": {"coach": "A", "seat_number": "2", "booking_reference": "existing"}, "1B": {"coach": "B", "seat_number": "1", "booking_reference": ""} }}}""")
+    service.availability("foo_train")
+    service.reserve_batch("foo_train", json.dumps({"01234567": ["1A", "1B"], "existing": ["2A"]}))
+    availability = json.loads(service.availability("foo_train"))
+    assert (availability["free_seats"], availability["coaches"]["A"]["free_seats"], availability["coaches"]["B"]["free_seats"]) == (0, 0, 0)
+    assert availability["version"] == 1
+
+    service.reset("foo_train")
+    availability = json.loads(service.availability("foo_train"))
+    assert (availability["free_seats"], availability["coaches"]["A"]["free_seats"], availability["coaches"]["B"]["free_seats"]) == (3, 2, 1)
+
+def two_coach_train(booked_in_a, booked_in_b, seats_per_coach=10):
+    seats = {}
+    for coach, booked in (("A", booked_in_a), ("B", booked_in_b)):
+        for number in range(1, seats_per_coach + 1):
+            seats["{0}{1}".format(number, coach)] = {"coach": coach, "seat_number": str(number), "booking_reference": "existing" if number <= booked else ""}
+    return TrainDataService(json.dumps({"foo_train": {"seats": seats}}))
+
+def test_allocate_books_seats_in_least_occupied_coach():
+    service = two_coach_train(booked_in_a=3, booked_in_b=1)
+    allocation = json.loads(service.allocate("foo_train", "2", "01234567"))
+    assert allocation == {"version": 1, "seats": ["2B", "3B"]}
+    train_data = json.loads(service.data_for_train("foo_train"))
+    assert train_data["seats"]["2B"]["booking_reference"] == "01234567"
+    assert json.loads(service.availability("foo_train"))["coaches"]["B"]["free_seats"] == 7
+
+def test_allocate_keeps_the_train_under_70_percent():
+    service = two_coach_train(booked_in_a=7, booked_in_b=6)
+    assert json.loads(service.allocate("foo_train", "2", "01234567")) == {"version": 0, "seats": []}
+    assert json.loads(service.allocate("foo_train", "1", "01234567"))["seats"] == ["7B"]
+    assert service.allocate("unknown_train", "1", "01234567") == "null"
+
+def test_allocate_needs_one_coach_for_all_the_seats():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=3)
+    assert json.loads(service.allocate("foo_train", "4", "01234567"))["seats"] == []
+
+def test_changes_since_a_version():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=2)
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    service.reset("foo_train")
+    service.reserve_batch("foo_train", json.dumps({"89abcdef": ["2B"]}))
+
+    assert json.loads(service.changes("foo_train", "1")) == {"version": 3, "changes": [
+        {"version": 2, "reset": True}, {"version": 3, "seats": {"2B": "89abcdef"}}]}
+    assert json.loads(service.changes("foo_train", "3")) == {"version": 3, "changes": []}
+    assert service.changes("unknown_train", "0") == "null"
+
+def test_changes_no_longer_logged_ask_for_a_full_read():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=2)
+    service.CHANGE_LOG_SIZE = 2
+    for seat in ("1A", "2A", "1B"):
+        service.reserve("foo_train", json.dumps([seat]), "01234567")
+
+    assert json.loads(service.changes("foo_train", "1"))["changes"] == [
+        {"version": 2, "seats": {"2A": "01234567"}}, {"version": 3, "seats": {"1B": "01234567"}}]
+    assert json.loads(service.changes("foo_train", "0")) == {"version": 3, "changes": None}
+    assert json.loads(service.changes("foo_train", "7")) == {"version": 3, "changes": None}
+
+def test_changes_wait_for_the_next_reservation():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=2)
+    answers = []
+    waiter = threading.Thread(target=lambda: answers.append(json.loads(service.changes("foo_train", "0", "10"))))
+    waiter.start()
+    service.reserve("foo_train", json.dumps(["1A"]), "01234567")
+    waiter.join(5)
+
+    assert answers == [{"version": 1, "changes": [{"version": 1, "seats": {"1A": "01234567"}}]}]
+
+def test_native_calls_exchange_python_structures():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=2)
+    assert service.book_reservations("foo_train", {"01234567": ["1A"]}) == (1, {"1A": "01234567"})
+    assert service.allocate_and_book("foo_train", 1, "89abcdef") == {"version": 2, "seats": ["1B"]}
+    assert service.read_train("foo_train", lambda seats, version: (seats["1A"]["booking_reference"], version)) == ("01234567", 2)
+    assert service.seat_availability("foo_train")["coaches"] == {"A": {"free_seats": 1, "total_seats": 2}, "B": {"free_seats": 1, "total_seats": 2}}
+    assert service.reset_train("foo_train") == 3
+    assert service.changes_since("foo_train", 2) == {"version": 3, "changes": [{"version": 3, "reset": True}]}
+    assert service.read_train("unknown_train", dict) is None
+
+def test_native_reservation_is_refused_with_an_exception():
+    service = two_coach_train(booked_in_a=1, booked_in_b=0, seats_per_coach=2)
+    with pytest.raises(ReservationRefused, match="already booked with reference: existing"):
+        service.book_reservations("foo_train", {"01234567": ["1A"]})
+    assert service.reserve("foo_train", json.dumps(["1A"]), "01234567") == "already booked with reference: existing"
+
+def test_batch_reserving_a_seat_twice_is_refused():
+    service = two_coach_train(booked_in_a=0, booked_in_b=0, seats_per_coach=2)
+    answer = service.reserve_batch("foo_train", json.dumps({"r1": ["1A"], "r2": ["1A", "2A"]}), compact="1")
+    assert answer == "seat reserved twice in the batch: 1A"
+    seats = json.loads(service.data_for_train("foo_train"))["seats"]
+    assert seats["1A"]["booking_reference"] == seats["2A"]["booking_reference"] == ""
+    assert service.version_of("foo_train") == 0
+
+def test_unknown_trains_get_no_lock():
+    service = TrainDataService("""{ "foo_train": {"seats": {"1A": {"coach": "A", "seat_number": "1", "booking_reference": ""} }}}""")
+    assert service.data_for_train("unknown_train") == "null"
+    assert service.reserve("unknown_train", json.dumps(["1A"]), "01234567") == "train not found unknown_train"
+    assert service.reset("unknown_train") == "null"
+    assert "unknown_train" not in service.locks
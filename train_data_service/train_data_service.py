@@ -27,36 +27,464 @@ The "seats" field should be a json encoded list of seat ids, for example:
 
 The other two fields are ordinary strings. Note the server will prevent you from booking a seat that is already reserved with another booking reference.
 
+Several reservations on the same train can be made in one POST request to:
+
+    http://localhost:8081/reserve_batch
+
+with the form fields "train_id" and "reservations". The "reservations" field should be a json encoded object mapping each booking reference to its list of seat ids, for example:
+
+    '{"75bcd15": ["1A", "2A"], "75bcd16": ["3A"]}'
+
+Either all of the reservations are made, or none of them are.
+
+Every train document carries a "version" number, which goes up each time the train's reservations change. Both reserve methods accept an optional "expected_version" field: when it is given and the train has changed since that version, the reservation is refused with a "stale train version" message instead of being checked seat by seat.
+
+Both reserve methods answer with the whole train document. Add "compact=1" to the request to only get back the seats that were reserved and the new train version, for example:
+
+    {"version": 3, "seats": {"1A": "75bcd15", "2A": "75bcd15"}}
+
+The service can also choose the seats itself, with the ticket office rules: no reservation may take the train
+over 70% of its seats booked, and all the seats of a reservation are in the least occupied coach that can take
+them. Make a POST request to:
+
+    http://localhost:8081/allocate
+
+with the form fields "train_id", "seat_count" and "booking_reference". The seats are picked and booked in one go,
+so no other reservation can take them in between, and the answer names them:
+
+    {"version": 4, "seats": ["1A", "2A"]}
+
+The list of seats is empty when the train cannot take that many passengers, and the answer is null for an unknown
+train.
+
+To know how many seats are still free on a train, and in each of its coaches, without downloading the whole train, use:
+
+    http://localhost:8081/availability/express_2000
+
+which returns for example:
+
+    {"free_seats": 1, "total_seats": 2, "coaches": {"A": {"free_seats": 1, "total_seats": 2}}, "version": 1}
+
+To follow the changes made to a train since a version you know, use:
+
+    http://localhost:8081/changes/express_2000?since_version=3&timeout=20
+
+which waits up to "timeout" seconds (at most 30) for the train to move past that version, then returns the seat
+changes made since, oldest first:
+
+    {"version": 5, "changes": [{"version": 4, "seats": {"1A": "75bcd15"}}, {"version": 5, "reset": true}]}
+
+The list is empty if nothing changed before the timeout. Only the last 1000 changes of each train are kept: when
+"changes" is null, they do not go back far enough, and the whole train should be read again from data_for_train.
+Each waiting request holds one of the server's threads.
+
 The service has one additional method, that will remove all reservations on a particular train. Use it with care:
 
     http://localhost:8081/reset/express_2000
+
+Code running in the same process, such as a simulation, can skip the json: read_train, seat_availability,
+book_reservations, allocate_and_book, reset_train and changes_since take and return python structures.
+
+Requests are parsed with orjson when it is installed (see json_codec.py), which is much faster on large trains:
+
+    pip install orjson
+
+Request latencies are published in the Prometheus text format on:
+
+    http://localhost:8081/metrics
 """
 import json
+import re
+import threading
+from collections import deque
+from collections.abc import Mapping
+
+import json_codec
+from metrics import METRICS
+from reservation_store import MemoryStore
+from sharding import shard_for
+
+DATA_FOR_TRAIN_SECONDS = METRICS.histogram("train_data_service_data_for_train_seconds", "Time spent answering data_for_train")
+RESERVE_SECONDS = METRICS.histogram("train_data_service_reserve_seconds", "Time spent answering reserve and reserve_batch")
+RESET_SECONDS = METRICS.histogram("train_data_service_reset_seconds", "Time spent answering reset")
+ALLOCATE_SECONDS = METRICS.histogram("train_data_service_allocate_seconds", "Time spent answering allocate")
+CHANGES_SECONDS = METRICS.histogram("train_data_service_changes_seconds", "Time spent answering changes, waiting included")
+AVAILABILITY_SECONDS = METRICS.histogram("train_data_service_availability_seconds", "Time spent answering availability")
+
+# a fleet line starts with its train id, e.g. {"train_id": "express_2000", "seats": {...}}
+TRAIN_ID_PREFIX = re.compile(rb'\s*\{\s*"train_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+class LazyTrains(Mapping):
+    """The trains of a json-lines fleet file, each one parsed the first time it is used.
+
+    Opening the fleet only records where each train's line starts in the file, so startup time and memory
+    grow with the trains that are actually queried rather than with the size of the fleet.
+    """
+
+    def __init__(self, path, owns_train=None):
+        self.path = path
+        self.offsets = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+        with open(path, "rb") as fleet:
+            offset = 0
+            for line in fleet:
+                if line.strip():
+                    train_id = self.train_id_of(line)
+                    if owns_train is None or owns_train(train_id):
+                        self.offsets[train_id] = offset
+                offset += len(line)
+
+    @staticmethod
+    def train_id_of(line):
+        match = TRAIN_ID_PREFIX.match(line)
+        if match:
+            return json_codec.loads(b'"' + match.group(1) + b'"')
+        return json_codec.loads(line)["train_id"]
+
+    def __getitem__(self, train_id):
+        train = self.loaded.get(train_id)
+        if train is not None:
+            return train
+        offset = self.offsets[train_id]
+        with self.lock:
+            if train_id not in self.loaded:
+                with open(self.path, "rb") as fleet:
+                    fleet.seek(offset)
+                    train = json_codec.loads(fleet.readline())
+                del train["train_id"]
+                self.loaded[train_id] = train
+            return self.loaded[train_id]
+
+    def __contains__(self, train_id):
+        return train_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+class ReservationRefused(ValueError):
+    """A reservation that cannot be made as asked, e.g. because one of its seats is already booked"""
 
 class TrainDataService(object):
-    
-    def __init__(self, json_data):
-        self.trains = json.loads(json_data)
+    MAXIMUM_OCCUPATION_PERCENTAGE = 70
+    CHANGE_LOG_SIZE = 1000
+    MAXIMUM_CHANGES_TIMEOUT = 30
+
+    def __init__(self, json_data=None, trains=None, store=None):
+        self.trains = trains if trains is not None else json_codec.loads(json_data)
+        self.versions = {}
+        self.serialized = {}
+        self.seat_counters = {}
+        self.change_logs = {}
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+        self.store = store or MemoryStore()
+        self.store.replay(self)
+
+    @classmethod
+    def from_file(cls, path, store=None, shard=None):
+        """Load trains from a json file, or lazily from a json-lines fleet file (see generate_trains.py).
+
+        With shard=(shard_index, shard_count), only the trains owned by that shard are loaded, see sharding.py
+        """
+        owns_train = None
+        if shard is not None:
+            shard_index, shard_count = shard
+            owns_train = lambda train_id: shard_for(train_id, shard_count) == shard_index
+        if path.endswith(".jsonl"):
+            return cls(trains=LazyTrains(path, owns_train), store=store)
+        with open(path, "rb") as f:
+            trains = json_codec.loads(f.read())
+        if owns_train is not None:
+            trains = {train_id: train for train_id, train in trains.items() if owns_train(train_id)}
+        return cls(trains=trains, store=store)
+
+    def restore_train(self, train_id, train_state):
+        """Apply the reservations a store replays at startup, see reservation_store.py"""
+        train = self.trains.get(train_id)
+        if train is None:
+            return
+        if train_state["reset"]:
+            for seat in train["seats"].values():
+                seat["booking_reference"] = ""
+        for seat_id, booking_reference in train_state["seats"].items():
+            if seat_id in train["seats"]:
+                train["seats"][seat_id]["booking_reference"] = booking_reference
+        self.versions[train_id] = train_state["version"]
+        self.seat_counters.pop(train_id, None)
+        self.change_logs.pop(train_id, None)
+
+    def lock_for(self, train_id):
+        """Each train has its own lock, so reservations on different trains never wait on each other.
+
+        The lock is a condition, notified each time the train changes. Locks are kept for good, so callers check
+        that the train exists first: a KeyError is raised for an unknown train.
+        """
+        lock = self.locks.get(train_id)
+        if lock is None:
+            if train_id not in self.trains:
+                raise KeyError(train_id)
+            with self.locks_guard:
+                lock = self.locks.setdefault(train_id, threading.Condition(threading.Lock()))
+        return lock
+
+    def version_of(self, train_id):
+        return self.versions.get(train_id, 0)
     
     def data_for_train(self, train_id):
-        return json.dumps(self.trains.get(train_id))
+        with DATA_FOR_TRAIN_SECONDS.time():
+            return self.serialized_train(train_id)
+
+    def serialized_train(self, train_id):
+        if train_id not in self.trains:
+            return json_codec.dumps(None)
+        with self.lock_for(train_id):
+            # the json document is only rebuilt after the train has changed
+            serialized = self.serialized.get(train_id)
+            if serialized is None:
+                train = self.trains[train_id]
+                # the standard library writes the documented format, and the document is cached per version
+                serialized = self.serialized[train_id] = json.dumps(dict(train, version=self.version_of(train_id)))
+            return serialized
     
-    def reserve(self, train_id, seats, booking_reference):
+    def read_train(self, train_id, reader):
+        """Call reader(seats, version) with the train's seats held still, and return what it returns, or None for
+        an unknown train. Lets a caller in the same process read the train without a json round trip.
+        """
         train = self.trains.get(train_id)
-        seats = json.loads(seats)
-        for seat in seats:
-            if not seat in train["seats"]:
-                return "seat not found {0}".format(seat)
-            existing_reservation =  train["seats"][seat]["booking_reference"]
-            if existing_reservation and existing_reservation != booking_reference:
-                return "already booked with reference: {0}".format(existing_reservation)
-        for seat in seats:
-            train["seats"][seat]["booking_reference"] = booking_reference
-        return self.data_for_train(train_id)
+        if train is None:
+            return None
+        with self.lock_for(train_id):
+            return reader(train["seats"], self.version_of(train_id))
 
-    def reset(self, train_id):
+    def availability(self, train_id):
+        with AVAILABILITY_SECONDS.time():
+            return json_codec.dumps(self.seat_availability(train_id))
+
+    def seat_availability(self, train_id):
+        """The seat counters returned by availability, as a dict, or None for an unknown train"""
+        train = self.trains.get(train_id)
+        if train is None:
+            return None
+        with self.lock_for(train_id):
+            counters = self.counters_for(train_id, train)
+            coaches = {coach: dict(coach_counters) for coach, coach_counters in counters["coaches"].items()}
+            return dict(counters, coaches=coaches, version=self.version_of(train_id))
+
+    def counters_for(self, train_id, train):
+        """The free and total seat counts of a train and of each of its coaches.
+
+        They are counted the first time they are asked for, then kept up to date by reserve and reset.
+        Must be called with the train's lock held.
+        """
+        counters = self.seat_counters.get(train_id)
+        if counters is None:
+            counters = {"free_seats": 0, "total_seats": 0, "coaches": {}}
+            for seat in train["seats"].values():
+                coach = counters["coaches"].setdefault(seat["coach"], {"free_seats": 0, "total_seats": 0})
+                coach["total_seats"] += 1
+                counters["total_seats"] += 1
+                if not seat["booking_reference"]:
+                    coach["free_seats"] += 1
+                    counters["free_seats"] += 1
+            self.seat_counters[train_id] = counters
+        return counters
+
+    def reserve(self, train_id, seats, booking_reference, expected_version=None, compact=None):
+        with RESERVE_SECONDS.time():
+            return self.reserve_seats(train_id, {booking_reference: json_codec.loads(seats)}, expected_version, compact)
+
+    def reserve_batch(self, train_id, reservations, expected_version=None, compact=None):
+        with RESERVE_SECONDS.time():
+            return self.reserve_seats(train_id, json_codec.loads(reservations), expected_version, compact)
+
+    def reserve_seats(self, train_id, reservations, expected_version=None, compact=None):
+        """Reserve the seats of several booking references at once: either all of them are booked or none are.
+        The batch is refused when a seat is claimed twice, even by the same booking reference.
+
+        When expected_version is given, the reservation is refused unless the train is still at that version,
+        i.e. has not changed since the caller read it.
+
+        The whole train document is returned, unless compact is set: then only the reserved seats and the new
+        train version are, as in {"version": 3, "seats": {"1A": "75bcd15"}}.
+        """
+        try:
+            version, changed_seats = self.book_reservations(train_id, reservations, expected_version)
+        except ReservationRefused as refusal:
+            return str(refusal)
+        if compact in (True, "1", "true"):
+            return json_codec.dumps({"version": version, "seats": changed_seats})
+        return self.serialized_train(train_id)
+
+    def book_reservations(self, train_id, reservations, expected_version=None):
+        """Book reservations given as {booking_reference: [seat, ...]} and return the new train version and the
+        changed seats, or raise ReservationRefused, see reserve_seats
+        """
+        train = self.trains.get(train_id)
+        if train is None:
+            raise ReservationRefused("train not found {0}".format(train_id))
+        with self.lock_for(train_id):
+            if expected_version not in (None, "") and int(expected_version) != self.version_of(train_id):
+                raise ReservationRefused("stale train version: expected {0}, current {1}".format(expected_version, self.version_of(train_id)))
+            claimed = set()
+            for booking_reference, seats in reservations.items():
+                for seat in seats:
+                    if not seat in train["seats"]:
+                        raise ReservationRefused("seat not found {0}".format(seat))
+                    if seat in claimed:
+                        raise ReservationRefused("seat reserved twice in the batch: {0}".format(seat))
+                    claimed.add(seat)
+                    existing_reservation =  train["seats"][seat]["booking_reference"]
+                    if existing_reservation and existing_reservation != booking_reference:
+                        raise ReservationRefused("already booked with reference: {0}".format(existing_reservation))
+            version, changed_seats, previous_seats, sequence = self.book(train_id, train, reservations)
+        # other reservations can go on while this one is made durable, and share its fsync
+        self.make_durable(train_id, train, sequence, previous_seats)
+        return version, changed_seats
+
+    def allocate(self, train_id, seat_count, booking_reference):
+        """Pick seats for seat_count passengers with the ticket office rules and book them, see allocate_seats"""
+        with ALLOCATE_SECONDS.time():
+            return json_codec.dumps(self.allocate_and_book(train_id, int(seat_count), booking_reference))
+
+    def allocate_and_book(self, train_id, seat_count, booking_reference):
+        """The allocation returned by allocate, as a dict, or None for an unknown train"""
         train = self.trains.get(train_id)
+        if train is None:
+            return None
+        with self.lock_for(train_id):
+            seats = self.allocate_seats(train_id, train, seat_count)
+            if not seats:
+                return {"version": self.version_of(train_id), "seats": []}
+            version, changed_seats, previous_seats, sequence = self.book(train_id, train, {booking_reference: seats})
+        self.make_durable(train_id, train, sequence, previous_seats)
+        return {"version": version, "seats": seats}
+
+    def allocate_seats(self, train_id, train, seat_count):
+        """The seats TicketOffice.allocate_seats would pick, or None when the train cannot take seat_count passengers.
+
+        The seat counters give the train occupation and the least occupied coach, so only that coach's seats are
+        looked at. Must be called with the train's lock held.
+        """
+        counters = self.counters_for(train_id, train)
+        if seat_count <= 0 or not counters["total_seats"]:
+            return None
+        train_occupation = 100 * (1 - (counters["free_seats"] - seat_count) / counters["total_seats"])
+        if train_occupation > self.MAXIMUM_OCCUPATION_PERCENTAGE:
+            return None
+        best_coach = None
+        best_occupation = 100.0
+        for coach, coach_counters in counters["coaches"].items():
+            if seat_count <= coach_counters["free_seats"]:
+                occupation = 100 * (1 - coach_counters["free_seats"] / coach_counters["total_seats"])
+                if best_occupation > occupation:
+                    best_occupation = occupation
+                    best_coach = coach
+        if best_coach is None:
+            return None
+        seats = []
         for seat_id, seat in train["seats"].items():
-            seat["booking_reference"] = ""
-        return self.data_for_train(train_id)
-    
+            if seat["coach"] == best_coach and not seat["booking_reference"]:
+                seats.append(seat_id)
+                if len(seats) == seat_count:
+                    return seats
+
+    def book(self, train_id, train, reservations):
+        """Book checked reservations and queue them in the store. Must be called with the train's lock held.
+
+        The record is queued first, so that a store which can no longer write refuses the booking before the train
+        is changed. Returns the seats' previous booking references too, for make_durable to put back.
+        """
+        changed_seats = {}
+        for booking_reference, seats in reservations.items():
+            for seat in seats:
+                changed_seats[seat] = booking_reference
+        sequence = self.store.record({"train_id": train_id, "version": self.version_of(train_id) + 1, "seats": changed_seats})
+        previous_seats = {}
+        counters = self.seat_counters.get(train_id)
+        for seat, booking_reference in changed_seats.items():
+            seat_data = train["seats"][seat]
+            if counters is not None and not seat_data["booking_reference"]:
+                counters["free_seats"] -= 1
+                counters["coaches"][seat_data["coach"]]["free_seats"] -= 1
+            previous_seats[seat] = seat_data["booking_reference"]
+            seat_data["booking_reference"] = booking_reference
+        version = self.train_changed(train_id, {"seats": changed_seats})
+        return version, changed_seats, previous_seats, sequence
+
+    def make_durable(self, train_id, train, sequence, previous_seats):
+        """Wait until the store has made a change durable. When it cannot, the seats the change booked or freed get
+        their previous booking references back, as a new version of the train, so that the service never shows a
+        change it may have lost, and the store's error is raised.
+        """
+        try:
+            self.store.wait_until_durable(sequence)
+        except Exception:
+            with self.lock_for(train_id):
+                for seat, booking_reference in previous_seats.items():
+                    train["seats"][seat]["booking_reference"] = booking_reference
+                self.seat_counters.pop(train_id, None)
+                self.train_changed(train_id, {"seats": previous_seats})
+            raise
+
+    def reset(self, train_id):
+        with RESET_SECONDS.time():
+            self.reset_train(train_id)
+            return self.serialized_train(train_id)
+
+    def reset_train(self, train_id):
+        """Remove all the reservations on a train and return its new version, or None for an unknown train"""
+        train = self.trains.get(train_id)
+        if train is None:
+            return None
+        with self.lock_for(train_id):
+            sequence = self.store.record({"train_id": train_id, "version": self.version_of(train_id) + 1, "reset": True})
+            previous_seats = {}
+            for seat_id, seat in train["seats"].items():
+                if seat["booking_reference"]:
+                    previous_seats[seat_id] = seat["booking_reference"]
+                seat["booking_reference"] = ""
+            counters = self.seat_counters.get(train_id)
+            if counters is not None:
+                for coach in [counters] + list(counters["coaches"].values()):
+                    coach["free_seats"] = coach["total_seats"]
+            version = self.train_changed(train_id, {"reset": True})
+        self.make_durable(train_id, train, sequence, previous_seats)
+        return version
+
+    def changes(self, train_id, since_version, timeout=None):
+        """The changes made to a train after since_version, waiting up to timeout seconds for one if there are none"""
+        with CHANGES_SECONDS.time():
+            return json_codec.dumps(self.changes_since(train_id, int(since_version), float(timeout or 0)))
+
+    def changes_since(self, train_id, since_version, timeout=0):
+        """The changes returned by changes, as a dict, or None for an unknown train"""
+        if train_id not in self.trains:
+            return None
+        timeout = min(timeout, self.MAXIMUM_CHANGES_TIMEOUT)
+        condition = self.lock_for(train_id)
+        with condition:
+            condition.wait_for(lambda: self.version_of(train_id) != since_version, timeout)
+            version = self.version_of(train_id)
+            change_log = self.change_logs.get(train_id, ())
+            missed = version - since_version
+            if missed < 0 or missed > len(change_log):
+                return {"version": version, "changes": None}
+            return {"version": version, "changes": list(change_log)[len(change_log) - missed:]}
+
+    def train_changed(self, train_id, change):
+        """Give the train its next version, log the change for the changes feed and return the version.
+
+        Must be called with the train's lock held.
+        """
+        version = self.versions[train_id] = self.version_of(train_id) + 1
+        self.serialized.pop(train_id, None)
+        change_log = self.change_logs.get(train_id)
+        if change_log is None:
+            change_log = self.change_logs[train_id] = deque(maxlen=self.CHANGE_LOG_SIZE)
+        change_log.append(dict(change, version=version))
+        self.lock_for(train_id).notify_all()
+        return version
@@ -4,12 +4,24 @@ This module exposes a TrainDataService on http using Cherrypy
 import json
 import cherrypy
 
+from metrics import CONTENT_TYPE, METRICS
 
-def start(trains_data):
+class MetricsPage(object):
+    @cherrypy.expose
+    def index(self):
+        cherrypy.response.headers["Content-Type"] = CONTENT_TYPE
+        return METRICS.render()
+
+def start(train_data_service, port=8081):
     from train_data_service import TrainDataService
     TrainDataService.data_for_train.exposed = True
     TrainDataService.reserve.exposed = True
+    TrainDataService.reserve_batch.exposed = True
+    TrainDataService.allocate.exposed = True
     TrainDataService.reset.exposed = True
-    cherrypy.config.update({"server.socket_port" : 8081})
-    cherrypy.quickstart(TrainDataService(trains_data))
+    TrainDataService.availability.exposed = True
+    TrainDataService.changes.exposed = True
+    cherrypy.config.update({"server.socket_port" : port})
+    cherrypy.tree.mount(MetricsPage(), "/metrics", {"/": {"tools.trailing_slash.on": False}})
+    cherrypy.quickstart(train_data_service)
     
\ No newline at end of file
@@ -1,10 +1,11 @@
 """This module uses Flask to expose a TrainDataService to http requests"""
 
 from flask import Flask
+from flask import Response
 from flask import request
 app = Flask(__name__)
 
-from train_data_service import TrainDataService
+from metrics import CONTENT_TYPE, METRICS
 
 TRAIN_DATA = None
 
@@ -21,16 +22,45 @@ def reserve():
     train_id = request.form["train_id"]
     seat_ids = request.form["seats"]
     booking_reference = request.form["booking_reference"]
-    return TRAIN_DATA.reserve(train_id, seat_ids, booking_reference)
+    expected_version = request.form.get("expected_version")
+    compact = request.values.get("compact")
+    return TRAIN_DATA.reserve(train_id, seat_ids, booking_reference, expected_version, compact)
+
+@app.route('/reserve_batch', methods=["POST"])
+def reserve_batch():
+    train_id = request.form["train_id"]
+    reservations = request.form["reservations"]
+    expected_version = request.form.get("expected_version")
+    compact = request.values.get("compact")
+    return TRAIN_DATA.reserve_batch(train_id, reservations, expected_version, compact)
+
+@app.route('/allocate', methods=["POST"])
+def allocate():
+    train_id = request.form["train_id"]
+    seat_count = request.form["seat_count"]
+    booking_reference = request.form["booking_reference"]
+    return TRAIN_DATA.allocate(train_id, seat_count, booking_reference)
 
 @app.route('/reset/<train_id>')
 def reset(train_id):
     return TRAIN_DATA.reset(train_id)
 
-def start(trains_data):
+@app.route('/availability/<train_id>')
+def availability(train_id):
+    return TRAIN_DATA.availability(train_id)
+
+@app.route('/changes/<train_id>')
+def changes(train_id):
+    return TRAIN_DATA.changes(train_id, request.args["since_version"], request.args.get("timeout"))
+
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+def start(train_data_service, port=8081):
     global TRAIN_DATA
-    TRAIN_DATA = TrainDataService(trains_data)
+    TRAIN_DATA = train_data_service
 
-    app.config["SERVER_NAME"] = "127.0.0.1:8081"
+    app.config["SERVER_NAME"] = "127.0.0.1:{0}".format(port)
     app.config["DEBUG"] = True
     app.run()